@@ -0,0 +1,77 @@
+#
+# Diff two Azure DevOps process exports
+# =====================================
+#
+# Compares two processDict json files written by export_ado_process.py, for example
+# the same org on two dates or a dev and a prod org, and lists the processes, work
+# item types, fields, states, rules and behaviors that were added, removed or
+# changed:
+#
+#     python diff_ado_process.py -old dev_processes.json -new prd_processes.json
+#
+# Parts of the exports that are the same are skipped by comparing their hashes, see
+# zoyinc_process_tools.diffProcessExports().
+#
+# Exits with 0 if the exports are the same and 1 if there are differences.
+#
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+import zoyinc_process_tools
+import zoyinc_std_tools
+
+
+#
+# Diff the exports and return the exit code
+#
+def main(argv=None):
+
+    # Arguments
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument("-old", required=True, help="processDict json file to compare from")
+    parser.add_argument("-new", required=True, help="processDict json file to compare to")
+    parser.add_argument("-json", action='store_true', help="Print the differences as json rather than text")
+    zoyinc_std_tools.addProfileArguments(parser)
+    args = parser.parse_args(argv)
+
+    diffStart = time.perf_counter()
+    with open(args.old, 'r') as oldFile:
+        oldProcessDict = json.load(oldFile)
+    with open(args.new, 'r') as newFile:
+        newProcessDict = json.load(newFile)
+    loadSeconds = time.perf_counter() - diffStart
+    processDiff = zoyinc_process_tools.diffProcessExports(oldProcessDict, newProcessDict)
+    diffSeconds = time.perf_counter() - diffStart - loadSeconds
+
+    if args.json:
+        print(json.dumps(processDiff, indent=4))
+    else:
+        #
+        # Count the differences by what changed, and the type of item
+        #
+        diffCounts = collections.Counter((diffItem['change'], diffItem['path'][-1][0] if diffItem['path'] else 'export') for diffItem in processDiff)
+
+        print('#')
+        print('# Process export diff')
+        print('# ===================')
+        print('# Old:           ' + args.old)
+        print('# New:           ' + args.new)
+        print('# Differences:   ' + str(len(processDiff)))
+        for (diffChange, itemType), diffCount in sorted(diffCounts.items()):
+            print('#     ' + (itemType + ' ' + diffChange + ':').ljust(28) + str(diffCount))
+        print('# Time taken:    load %.3fs, diff %.3fs' % (loadSeconds, diffSeconds))
+        print('#')
+        for diffItem in processDiff:
+            print(zoyinc_process_tools.diffLineOf(diffItem))
+
+    if processDiff:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(zoyinc_std_tools.runScript('diff_ado_process', main))
@@ -2,13 +2,51 @@
 # Export an Azure DevOps process
 # ==============================
 #
+# Exports the processes of one organization, printed as json, or with '-config' of
+# many organizations at once, each to its own file.
+#
+# The config file is json:
+#
+#     {
+#         "defaults": {"deep": true, "workers": 8, "maxPerHost": 8, "maxRate": 200},
+#         "orgs": [
+#             {"org": "zoyinc", "projects": ["examples"]},
+#             {"org": "zoyinc-prd", "tokenEnv": "ZOYINC_PRD_TOKEN", "output": "prd.json"}
+#         ]
+#     }
+#
+# Each org can have:
+#
+#     org          = Organization name
+#     url          = Organization url, defaults to 'https://dev.azure.com/<org>/'
+#     projects     = Projects to look up, their ids and the process each uses are
+#                    added to the export under 'projects'
+#     output       = File to write the export to, defaults to
+#                    '<outputdir>/<org>_processes.json'
+#     tokenEnv     = Environment variable with the token for the org, defaults to
+#                    the '-azuretoken' token
+#     proxy        = Proxy server, 'none' for no proxy
+#     deep         = As '-deep'
+#     workers      = As '-workers'
+#     maxPerHost   = As '-maxperhost'
+#     maxRate      = Most requests a second to make to the org
+#     snapshotDir  = As '-snapshotdir', with '-snapshotdir' each org gets its own
+#                    directory under it
+#
+# and anything not given for an org is taken from "defaults", then the command line.
+#
+# The orgs are exported at the same time in a pool of '-orgworkers' threads, each org
+# with its own client, so its own connections and rate limit. An org that fails does
+# not stop the others, the script fails at the end if any did.
+#
 
 import argparse
-import logging
+import concurrent.futures
+import os
 import sys
 import json
-from re import T
 import zoyinc_std_tools
+import zoyinc_process_tools
 
 #
 # User defined variables
@@ -18,54 +56,195 @@ fileLogLevel = 'debug'
 logFilename = 'c:/temp/ado_process_logging.log'
 proxySvr = 'http://192.168.202.245:80'
 adoOrg = 'zoyinc'
-adoProjectRaw = 'examples'
-scriptOk = True
-
-# Arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-azuretoken", required=True, help="Azure personal access token PAL")
-
-args = parser.parse_args()
-azureToken = args.azuretoken
-processDict = {}
-
-
-#
-# Misc variables
-#
-proxySvr = {'http':proxySvr, 'https':proxySvr}
-logger = zoyinc_std_tools.enableLogging(consoleLogLevel,fileLogLevel,logFilename)
-adoProject = adoProjectRaw.lower().strip()
-
-# # Get list of projects in org
-# adoApiUrl = 'https://dev.azure.com/' + adoOrg + '/_apis/projects?api-version=6.0'
-# projectDetails = zoyinc_std_tools.adoAPICall(logger, adoApiUrl, 'get', None, None, None, proxySvr, azureToken, True)
-# projectID = -1
-# for curProject in projectDetails['json']['value']:
-#     if adoProject == curProject['name'].lower().strip():
-#             projectID = curProject['id']
-#             logger.debug('Project ID for \'' + adoProjectRaw + '\' = \'' + projectID + '\'.')
-# if projectID == -1:
-#     errorMsg = 'Given project name, \'' + adoProjectRaw + '\', does not exist in the \'' + adoOrg + '\' organization.'
-#     scriptOk = False
-
-# Get list of processes in org
-adoApiUrl = 'https://dev.azure.com/' + adoOrg + '/_apis/work/processes?api-version=6.0-preview.2'
-processDetails = zoyinc_std_tools.adoAPICall(logger, adoApiUrl, 'get', None, None, None, proxySvr, azureToken, True)
-processDict.update({'process':{}})
-for curProcess in processDetails['json']['value']:
-    processDict['process'].update({curProcess['name'].lower():curProcess})
-print( json.dumps(processDict, indent=4, sort_keys=True))
-
-
-if scriptOk:
-    logger.info('Script completed successfully.')
-else:
-    logger.error('#')
-    logger.error('# Script failed with the following error')
-    logger.error('#')
-    for currLine in errorMsg.splitlines():
-        logger.error(currLine)
-    logger.error('')
-    sys.stdout.flush()
-    exit(1)
+
+#
+# Proxies for requests from a proxy server, or None for 'none'
+#
+def proxiesOf(proxyStr):
+    if (proxyStr is None) or (proxyStr.lower() == 'none'):
+        return None
+    return {'http':proxyStr, 'https':proxyStr}
+
+
+#
+# Export one organization
+#
+# orgSettings is the org's entry from the config, or built from the command line,
+# with everything filled in. Returns (processDict, errorMsg), errorMsg is None if
+# the export worked.
+#
+def exportOrg(orgSettings, args, logger, responseCache, responseArchive):
+
+    orgLogger = logger
+    if args.config:
+        orgLogger = zoyinc_process_tools.OrgLoggerAdapter(logger, {'org': orgSettings['org']})
+    orgToken = args.azuretoken
+    if orgSettings.get('tokenEnv'):
+        orgToken = os.environ.get(orgSettings['tokenEnv'])
+    if not orgToken:
+        return None, 'No token for organization \'' + orgSettings['org'] + '\', give \'-azuretoken\' or set ' + str(orgSettings.get('tokenEnv'))
+
+    orgProxies = proxiesOf(orgSettings['proxy'])
+    exportWorkers = max(1, orgSettings['workers'])
+    rateLimitScheduler = zoyinc_std_tools.RateLimitScheduler(maxRate=orgSettings['maxRate'])
+    adoClient = zoyinc_std_tools.AdoClient(orgToken, orgProxies, poolMaxSize=exportWorkers, responseCache=responseCache, maxPerHost=orgSettings['maxPerHost'], rateLimitScheduler=rateLimitScheduler, responseArchive=responseArchive)
+    exportContext = zoyinc_process_tools.ProcessExportContext(orgLogger, adoClient, orgSettings['url'], orgProxies, orgToken)
+
+    # The api calls exit on an error, for one of many orgs that only fails that org
+    try:
+        # Get list of processes in org, and for a deep export everything in them
+        snapshotStore = None
+        if orgSettings['snapshotDir']:
+            snapshotStore = zoyinc_process_tools.ProcessSnapshotStore(orgSettings['snapshotDir'], args.refreshdays * 24 * 60 * 60, args.fullrefresh)
+        processDict = zoyinc_process_tools.exportProcesses(exportContext, orgSettings['deep'], exportWorkers, snapshotStore)
+
+        # Look up the projects, and the process each uses
+        if orgSettings['projects']:
+            processDict['projects'], missingProjects = zoyinc_process_tools.fetchProjects(exportContext, orgSettings['projects'])
+            for projectName in missingProjects:
+                orgLogger.error('Given project name, \'' + projectName + '\', does not exist in the \'' + orgSettings['org'] + '\' organization.')
+            if missingProjects:
+                return processDict, 'Projects not found in the \'' + orgSettings['org'] + '\' organization: ' + ', '.join(missingProjects)
+    except SystemExit:
+        return None, 'Export of organization \'' + orgSettings['org'] + '\' failed, see the log for the error'
+    finally:
+        adoClient.close()
+
+    return processDict, None
+
+
+#
+# Settings for an org, what the org gives, then the config defaults, then the
+# command line
+#
+def orgSettingsOf(orgConfig, configDefaults, args):
+    orgSettings = {'proxy': args.proxy or proxySvr,
+                   'deep': args.deep,
+                   'workers': args.workers,
+                   'maxPerHost': args.maxperhost,
+                   'maxRate': 200.0,
+                   'projects': args.project or [],
+                   'tokenEnv': None,
+                   'snapshotDir': args.snapshotdir}
+    orgSettings.update(configDefaults)
+    orgSettings.update(orgConfig)
+    if not orgSettings.get('url'):
+        orgSettings['url'] = 'https://dev.azure.com/' + orgSettings['org'] + '/'
+    orgSettings['url'] = orgSettings['url'].rstrip('/') + '/'
+    if args.config and args.snapshotdir and ('snapshotDir' not in orgConfig) and ('snapshotDir' not in configDefaults):
+        orgSettings['snapshotDir'] = os.path.join(args.snapshotdir, orgSettings['org'])
+    return orgSettings
+
+
+#
+# Write an export atomically, so a failed run never leaves half a file
+#
+def writeExport(processDict, outputFilename):
+    outputDir = os.path.dirname(os.path.abspath(outputFilename))
+    os.makedirs(outputDir, exist_ok=True)
+    tempFilename = outputFilename + '.tmp'
+    with open(tempFilename, 'w') as outputFile:
+        json.dump(processDict, outputFile, indent=4, sort_keys=True)
+    os.replace(tempFilename, outputFilename)
+
+
+#
+# Export the processes and return the exit code
+#
+def main(argv=None):
+
+    # Arguments
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument("-azuretoken", help="Azure personal access token PAL, required unless every org in '-config' has a 'tokenEnv'")
+    parser.add_argument("-org", default=adoOrg, help="Organization to export, defaults to '" + adoOrg + "'")
+    parser.add_argument("-orgurl", help="Organization url, defaults to 'https://dev.azure.com/<org>/'")
+    parser.add_argument("-project", action='append', help="Project to look up, its id and process are added to the export. Can be given more than once")
+    parser.add_argument("-config", help="Json file of organizations to export, each to its own file, see the top of this script")
+    parser.add_argument("-outputdir", default='.', help="Directory for the export files of '-config' orgs that do not give an 'output'")
+    parser.add_argument("-orgworkers", type=int, default=4, help="Number of '-config' organizations to export at the same time")
+    parser.add_argument("-proxy", help="Proxy server, defaults to '" + proxySvr + "', use 'none' for no proxy")
+    parser.add_argument("-logfile", default=logFilename, help="Log file, defaults to '" + logFilename + "'")
+    parser.add_argument("-logmaxbytes", type=int, default=50 * 1024 * 1024, help="Rotate the log file once it reaches this size, 0 to never rotate")
+    parser.add_argument("-logpayloadbytes", type=int, default=4096, help="Max bytes of each api response to write to the debug log")
+    parser.add_argument("-cachedir", help="Directory to cache Azure DevOps responses in between runs")
+    parser.add_argument("-deep", action='store_true', help="Also export the work item types, fields, states, rules, layouts and behaviors of each process")
+    parser.add_argument("-workers", type=int, default=16, help="Number of api calls to make at the same time for a deep export")
+    parser.add_argument("-maxperhost", type=int, default=8, help="Max number of api calls in progress to one host at the same time")
+    parser.add_argument("-snapshotdir", help="Snapshot store directory, the layout and behaviors of work item types whose other parts have not changed since the last export are taken from it rather than fetched, so a change to only a layout or behaviors is exported once they are '-refreshdays' old. Implies -deep")
+    parser.add_argument("-refreshdays", type=float, default=7, help="Fetch the layout and behaviors of work item types again once they are this many days old in the snapshot store, whether they have changed or not")
+    parser.add_argument("-fullrefresh", action='store_true', help="Fetch everything and rebuild the snapshot store")
+    parser.add_argument("-telemetrydir", help="Write request and phase timings, as json and a Prometheus textfile, to this directory")
+
+    parser.add_argument("-recordarchive", help="Record the Azure DevOps responses to this archive file, adding to it if it exists")
+    parser.add_argument("-replayarchive", help="Answer every Azure DevOps request from this archive file, recorded with -recordarchive, with no network")
+    zoyinc_std_tools.addProfileArguments(parser)
+    args = parser.parse_args(argv)
+
+    #
+    # Misc variables
+    #
+    logger = zoyinc_std_tools.enableLogging(consoleLogLevel,fileLogLevel,args.logfile, queueLogging=True, maxLogBytes=args.logmaxbytes, maxPayloadBytes=args.logpayloadbytes)
+    if args.telemetrydir:
+        zoyinc_std_tools.enableTelemetry('export_ado_process', args.telemetrydir)
+    responseCache = None
+    if args.cachedir:
+        responseCache = zoyinc_std_tools.AdoResponseCache(args.cachedir)
+    responseArchive = zoyinc_std_tools.openResponseArchive(args.recordarchive, args.replayarchive)
+    scriptOk = True
+
+    if not args.config:
+
+        #
+        # A single organization, printed
+        #
+        orgConfig = {'org': args.org, 'url': args.orgurl}
+        processDict, errorMsg = exportOrg(orgSettingsOf(orgConfig, {}, args), args, logger, responseCache, responseArchive)
+        if processDict is not None:
+            print( json.dumps(processDict, indent=4, sort_keys=True))
+        if errorMsg is not None:
+            scriptOk = False
+
+    else:
+
+        #
+        # Many organizations, in parallel, each to its own file
+        #
+        with open(args.config, 'r') as configFile:
+            exportConfig = json.load(configFile)
+        configDefaults = exportConfig.get('defaults', {})
+        orgSettingsList = [orgSettingsOf(orgConfig, configDefaults, args) for orgConfig in exportConfig.get('orgs', [])]
+
+        orgErrors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.orgworkers)) as orgPool:
+            orgFutures = {orgPool.submit(exportOrg, orgSettings, args, logger, responseCache, responseArchive): orgSettings for orgSettings in orgSettingsList}
+            for currFuture in concurrent.futures.as_completed(orgFutures):
+                orgSettings = orgFutures[currFuture]
+                processDict, orgError = currFuture.result()
+                if processDict is not None:
+                    outputFilename = orgSettings.get('output') or os.path.join(args.outputdir, orgSettings['org'] + '_processes.json')
+                    writeExport(processDict, outputFilename)
+                    logger.info('Exported \'' + orgSettings['org'] + '\' to \'' + outputFilename + '\'.')
+                if orgError is not None:
+                    orgErrors.append(orgError)
+
+        if orgErrors:
+            scriptOk = False
+            errorMsg = '\n'.join(orgErrors)
+
+    if scriptOk:
+        logger.info('Script completed successfully.')
+    else:
+        logger.error('#')
+        logger.error('# Script failed with the following error')
+        logger.error('#')
+        for currLine in errorMsg.splitlines():
+            logger.error(currLine)
+        logger.error('')
+        sys.stdout.flush()
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(zoyinc_std_tools.runScript('export_ado_process', main))
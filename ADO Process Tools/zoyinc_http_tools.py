@@ -0,0 +1,177 @@
+#
+# HTTP tools
+# ==========
+#
+# The requests based transport of AdoClient, kept apart from zoyinc_std_tools so
+# requests, and everything it imports, is only loaded by the scripts that use it.
+# zoyinc_std_tools imports this the first time an AdoClient with the 'requests'
+# transport is created. Nothing here imports zoyinc_std_tools, what is needed from
+# it is passed in.
+#
+
+import io
+import json
+import threading
+import time
+import requests
+import requests.adapters
+import requests.structures
+import urllib3.connection
+import urllib3.connectionpool
+
+#
+# Errors the requests transport raises when the proxy can not be reached
+#
+proxyErrors = (requests.exceptions.ProxyError,)
+
+
+#
+# Connections that record how long connecting took
+#
+# connect() is the http.client method urllib3 calls to open the connection, it
+# resolves the host, connects, goes through any proxy tunnel and does the TLS
+# handshake, so all of that is in connectSeconds. The connection is made by the
+# thread sending the request, so the time is left in connectionTimings for
+# AdoClient.sendRequest() to pick up.
+#
+connectionTimings = threading.local()
+
+class TimedConnectionMixin:
+
+    def connect(self):
+        connectStart = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            connectionTimings.connectSeconds = time.perf_counter() - connectStart
+
+
+class TimedHTTPConnection(TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+timedPoolClasses = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+#
+# HTTPAdapter whose connections, direct or through a http(s) proxy, are timed
+#
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = timedPoolClasses
+
+    def proxy_manager_for(self, proxy, **proxyKwargs):
+        proxyManager = super().proxy_manager_for(proxy, **proxyKwargs)
+        if not proxy.lower().startswith('socks'):
+            proxyManager.pool_classes_by_scheme = timedPoolClasses
+        return proxyManager
+
+
+#
+# Transport adapter that sends requests with innerAdapter and records the responses
+# to GETs in the archive, other than those with a status in skipStatusCodes
+#
+# The body is read in full to record it, the headers are changed to those of the
+# decoded body as that is what is recorded.
+#
+class RecordingHTTPAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, archiveWriter, innerAdapter, skipStatusCodes=()):
+        super().__init__()
+        self.archiveWriter = archiveWriter
+        self.innerAdapter = innerAdapter
+        self.skipStatusCodes = skipStatusCodes
+
+    def send(self, request, **sendKwargs):
+        adoResponse = self.innerAdapter.send(request, **sendKwargs)
+        if (request.method == 'GET') and (adoResponse.status_code not in self.skipStatusCodes):
+            body = adoResponse.content
+            recordedHeaders = {headerName: headerValue for headerName, headerValue in adoResponse.headers.items()
+                               if headerName.lower() not in ['content-encoding', 'transfer-encoding', 'content-length']}
+            recordedHeaders['Content-Length'] = str(len(body))
+            self.archiveWriter.add(request.method, request.url, adoResponse.status_code, adoResponse.reason, recordedHeaders, body)
+        return adoResponse
+
+    def close(self):
+        self.innerAdapter.close()
+
+
+#
+# Transport adapter that answers requests from the archive, never the network
+#
+# Requests not in the archive get a 404, and anything other than a GET a 405, so a
+# replayed script fails the same way it would if Azure DevOps said no.
+#
+class ReplayHTTPAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, responseArchive):
+        super().__init__()
+        self.responseArchive = responseArchive
+
+    def send(self, request, **sendKwargs):
+        archivedResponse = None
+        if request.method == 'GET':
+            archivedResponse = self.responseArchive.get(request.method, request.url)
+        if archivedResponse is not None:
+            recordMeta, body = archivedResponse
+        elif request.method == 'GET':
+            recordMeta = {'status_code': 404, 'reason': 'Not Found', 'headers': {'Content-Type': 'application/json'}}
+            body = json.dumps({'message': 'Not in the response archive: ' + request.url}).encode('utf-8')
+        else:
+            recordMeta = {'status_code': 405, 'reason': 'Method Not Allowed', 'headers': {'Content-Type': 'application/json'}}
+            body = json.dumps({'message': 'The response archive is read only, ' + request.method + ' ' + request.url}).encode('utf-8')
+
+        adoResponse = requests.Response()
+        adoResponse.status_code = recordMeta['status_code']
+        adoResponse.reason = recordMeta['reason']
+        adoResponse.url = request.url
+        adoResponse.request = request
+        adoResponse.connection = self
+        adoResponse.headers = requests.structures.CaseInsensitiveDict(recordMeta['headers'])
+        adoResponse.encoding = requests.utils.get_encoding_from_headers(adoResponse.headers)
+        adoResponse.raw = io.BytesIO(body)
+        return adoResponse
+
+    def close(self):
+        pass
+
+
+#
+# requests.Session for an AdoClient
+#
+# The connections are timed, into connectionTimings, when there is telemetry. With a
+# responseArchive the responses are recorded to it, other than those with a status
+# in skipStatusCodes, or answered from it.
+#
+def pooledSession(azureToken, requestProxies=None, poolConnections=10, poolMaxSize=10, timedConnections=False, responseArchive=None, skipStatusCodes=()):
+    adoSession = requests.Session()
+    adoSession.auth = ('', azureToken)
+    adoSession.headers.update({'Connection': 'keep-alive'})
+    if requestProxies:
+        adoSession.proxies.update(requestProxies)
+
+    if timedConnections:
+        poolAdapter = TimedHTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxSize)
+    else:
+        poolAdapter = requests.adapters.HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxSize)
+    if responseArchive is not None:
+        if responseArchive.isOffline:
+            poolAdapter = ReplayHTTPAdapter(responseArchive)
+        else:
+            poolAdapter = RecordingHTTPAdapter(responseArchive, poolAdapter, skipStatusCodes)
+    adoSession.mount('https://', poolAdapter)
+    adoSession.mount('http://', poolAdapter)
+    return adoSession
@@ -0,0 +1,582 @@
+#
+# Process tools
+# =============
+#
+# Shared code for exporting Azure DevOps processes.
+#
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+import zoyinc_std_tools
+
+#
+# Api versions for the process apis
+#
+processApiVersion = '6.0-preview.2'
+witSubApiVersions = {'fields': '6.0-preview.2',
+                     'states': '6.0-preview.1',
+                     'rules': '6.0-preview.2',
+                     'layout': '6.0-preview.1',
+                     'behaviors': '6.0-preview.1'}
+
+#
+# How the lists returned for each part of a work item type are keyed in processDict,
+# so the same item can be found between exports. The layout is a single document.
+#
+witSubKeys = {'fields': 'referenceName',
+              'states': 'name',
+              'rules': 'id'}
+
+
+#
+# Export context
+#
+# Holds what is needed to make api calls for an organization so it can be passed
+# around the export functions and their threads.
+#
+class ProcessExportContext:
+
+    def __init__(self, logger, adoClient, orgURL, requestProxies, azureToken):
+        self.logger = logger
+        self.adoClient = adoClient
+        self.orgURL = orgURL
+        self.requestProxies = requestProxies
+        self.azureToken = azureToken
+
+    def apiGet(self, apiPath):
+        requestURL = self.orgURL + apiPath
+        return zoyinc_std_tools.adoAPICall(self.logger, requestURL, 'get', None, None, None, self.requestProxies, self.azureToken, True, adoClient=self.adoClient)['json']
+
+    #
+    # All the items of a list api, following continuation tokens, fails the export
+    # the same way as apiGet() if a page can not be fetched
+    #
+    def apiList(self, apiPath):
+        requestURL = self.orgURL + apiPath
+        adoClient = self.adoClient
+        if adoClient is None:
+            adoClient = zoyinc_std_tools.getAdoClient(self.azureToken, self.requestProxies)
+        try:
+            return list(zoyinc_std_tools.iterAdoItems(adoClient, requestURL, prefetch=True))
+        except zoyinc_std_tools.AdoRequestError as e:
+            self.logger.error('#')
+            self.logger.error('# Error listing ' + requestURL)
+            self.logger.error('#')
+            self.logger.error(str(e))
+            self.logger.error('The response was:')
+            self.logger.error(str(e.content))
+            sys.stdout.flush()
+            exit(1)
+
+
+#
+# Logger for one organization when several are exported at once, each message is
+# prefixed with the organization so they can be told apart
+#
+class OrgLoggerAdapter(logging.LoggerAdapter):
+
+    def process(self, msg, kwargs):
+        return '[' + self.extra['org'] + '] ' + str(msg), kwargs
+
+
+#
+# Turn a list of items into a dict keyed by the given item field
+#
+def keyedItems(itemList, keyField):
+    return {str(currItem[keyField]).lower(): currItem for currItem in itemList}
+
+
+def quotePath(pathPart):
+    return urllib.parse.quote(pathPart, safe='')
+
+
+#
+# Process level calls
+#
+def fetchProcessList(exportContext):
+    return exportContext.apiList('_apis/work/processes?api-version=' + processApiVersion)
+
+
+def fetchWorkItemTypes(exportContext, processId):
+    return exportContext.apiList('_apis/work/processes/' + processId + '/workitemtypes?api-version=' + processApiVersion)
+
+
+def fetchProcessBehaviors(exportContext, processId):
+    return exportContext.apiList('_apis/work/processes/' + processId + '/behaviors?api-version=' + processApiVersion)
+
+
+#
+# Look up projects in the organization
+#
+# Returns a dict keyed by the project name in lower case of:
+#
+#     {'id', 'name', 'processTemplate': {'templateName', 'templateTypeId'}}
+#
+# where processTemplate is the process the project uses, and a list of the project
+# names that were not found.
+#
+def fetchProjects(exportContext, projectNames):
+    orgProjects = keyedItems(exportContext.apiList('_apis/projects?api-version=6.0'), 'name')
+    projectsDict = {}
+    missingProjects = []
+    for projectName in projectNames:
+        projectKey = projectName.lower().strip()
+        if projectKey not in orgProjects:
+            missingProjects.append(projectName)
+            continue
+        projectJson = exportContext.apiGet('_apis/projects/' + orgProjects[projectKey]['id'] + '?includeCapabilities=true&api-version=6.0')
+        projectsDict[projectKey] = {'id': projectJson['id'],
+                                    'name': projectJson['name'],
+                                    'processTemplate': projectJson.get('capabilities', {}).get('processTemplate')}
+    return projectsDict, missingProjects
+
+
+#
+# Work item type level calls, witSubName is one of the witSubApiVersions
+#
+def fetchWitSub(exportContext, processId, witRefName, witSubName):
+    apiVersion = witSubApiVersions[witSubName]
+    if witSubName == 'behaviors':
+        apiPath = '_apis/work/processes/' + processId + '/workitemtypesbehaviors/' + quotePath(witRefName) + '/behaviors?api-version=' + apiVersion
+    else:
+        apiPath = '_apis/work/processes/' + processId + '/workitemtypes/' + quotePath(witRefName) + '/' + witSubName + '?api-version=' + apiVersion
+    if witSubName == 'layout':
+        return exportContext.apiGet(apiPath)
+    witSubItems = exportContext.apiList(apiPath)
+    if witSubName == 'behaviors':
+        return {str(currItem['behavior']['id']).lower(): currItem for currItem in witSubItems}
+    return keyedItems(witSubItems, witSubKeys[witSubName])
+
+
+#
+# The parts of a work item type that are always fetched, they are lists and cheap,
+# and the detail that is only fetched when the rest of the work item type has changed
+#
+witListSubs = ['fields', 'states', 'rules']
+witDetailSubs = ['layout', 'behaviors']
+
+
+#
+# Hash of a work item type without its detail, as listed with its fields, states
+# and rules
+#
+def witListHash(curWit):
+    return zoyinc_std_tools.contentHash({currKey: currValue for currKey, currValue in curWit.items() if currKey not in witDetailSubs})
+
+
+#
+# Content addressed snapshot store
+# --------------------------------
+#
+# Keeps the last deep export of each process in snapshotDir so later exports can
+# skip fetching the layout and behaviors of work item types that have not changed.
+#
+# Azure DevOps gives processes and work item types no revision or changed date, so
+# nothing tells us what has changed without fetching it. Every export lists the
+# processes, their behaviors and work item types, and the fields, states and rules
+# of every work item type, so new work item types and rule, state and field changes
+# are always in the export. Only the layout and behaviors of a work item type,
+# the biggest and slowest parts, are taken from the store, and only while the
+# hash of the rest of the work item type, witListHash(), is the same as when they
+# were fetched and they were fetched less than refreshAfterSeconds ago.
+#
+# Each process, process behaviors list, work item type, field, state, rule, layout
+# and work item type behavior is saved once, under the hash of its content, in:
+#
+#     <snapshotDir>/objects/<first 2 characters of hash>/<hash>.json
+#
+# <snapshotDir>/manifest.json records the hashes of the parts of each process and
+# work item type, and for each work item type its witListHash() and when its
+# layout and behaviors were fetched:
+#
+#     {'processes': {<process key>: {'info', 'behaviors',
+#                                    'workItemTypes': {<wit key>: {'listHash', 'fetchedAt', 'info',
+#                                                                  'fields', 'states', 'rules',
+#                                                                  'layout', 'behaviors'}}}}}
+#
+# 'info' and 'layout' are the hash of a single object, the others are dicts of
+# key: hash.
+#
+# Once the new manifest is written the objects it does not refer to are removed,
+# so the store only holds the last export. The store is for one export at a time,
+# an object that has gone missing is fetched again.
+#
+class ProcessSnapshotStore:
+
+    def __init__(self, snapshotDir, refreshAfterSeconds=7 * 24 * 60 * 60, fullRefresh=False):
+        self.snapshotDir = snapshotDir
+        self.refreshAfterSeconds = refreshAfterSeconds
+        self.fullRefresh = fullRefresh
+        self.manifestFilename = os.path.join(snapshotDir, 'manifest.json')
+        self.blobCache = {}
+        self.storeLock = threading.Lock()
+        os.makedirs(os.path.join(snapshotDir, 'objects'), exist_ok=True)
+
+        self.manifest = {'processes': {}}
+        if os.path.exists(self.manifestFilename):
+            with open(self.manifestFilename, 'r') as manifestFile:
+                self.manifest = json.load(manifestFile)
+
+    def blobFilename(self, blobHash):
+        return os.path.join(self.snapshotDir, 'objects', blobHash[:2], blobHash + '.json')
+
+    def writeBlob(self, jsonValue):
+        blobHash = zoyinc_std_tools.contentHash(jsonValue)
+        blobFilename = self.blobFilename(blobHash)
+        if not os.path.exists(blobFilename):
+            os.makedirs(os.path.dirname(blobFilename), exist_ok=True)
+            tempFilename = blobFilename + '.tmp' + str(threading.get_ident())
+            with open(tempFilename, 'w') as blobFile:
+                json.dump(jsonValue, blobFile, sort_keys=True, separators=(',', ':'))
+            os.replace(tempFilename, blobFilename)
+        return blobHash
+
+    def readBlob(self, blobHash):
+        with self.storeLock:
+            if blobHash in self.blobCache:
+                return self.blobCache[blobHash]
+        with open(self.blobFilename(blobHash), 'r') as blobFile:
+            jsonValue = json.load(blobFile)
+        with self.storeLock:
+            self.blobCache[blobHash] = jsonValue
+        return jsonValue
+
+    def writeBlobs(self, keyedValues):
+        return {currKey: self.writeBlob(currValue) for currKey, currValue in keyedValues.items()}
+
+    def readBlobs(self, keyedHashes):
+        return {currKey: self.readBlob(currHash) for currKey, currHash in keyedHashes.items()}
+
+    def witEntry(self, processKey, witKey):
+        processEntry = self.manifest['processes'].get(processKey)
+        if processEntry is None:
+            return None
+        return processEntry['workItemTypes'].get(witKey)
+
+    #
+    # The stored layout and behaviors of a work item type, fetched with its fields,
+    # states and rules, or None if they have to be fetched
+    #
+    def witDetail(self, processKey, curWit):
+        if self.fullRefresh:
+            return None
+        witEntry = self.witEntry(processKey, curWit['referenceName'].lower())
+        if (witEntry is None) or (witEntry.get('listHash') != witListHash(curWit)):
+            return None
+        if (time.time() - witEntry.get('fetchedAt', 0)) >= self.refreshAfterSeconds:
+            return None
+        try:
+            return {'layout': self.readBlob(witEntry['layout']),
+                    'behaviors': self.readBlobs(witEntry['behaviors'])}
+        except (OSError, ValueError):
+            return None
+
+    #
+    # Hashes of every object a manifest refers to
+    #
+    def manifestHashes(self, snapshotManifest):
+        blobHashes = set()
+        for processEntry in snapshotManifest['processes'].values():
+            blobHashes.add(processEntry['info'])
+            blobHashes.update(processEntry['behaviors'].values())
+            for witEntry in processEntry['workItemTypes'].values():
+                blobHashes.update([witEntry['info'], witEntry['layout']])
+                for witSubName in list(witSubKeys) + ['behaviors']:
+                    blobHashes.update(witEntry[witSubName].values())
+        return blobHashes
+
+    #
+    # Remove the objects the manifest does not refer to, returns the number removed
+    #
+    def sweep(self):
+        keepHashes = self.manifestHashes(self.manifest)
+        removedCount = 0
+        objectsDir = os.path.join(self.snapshotDir, 'objects')
+        for dirPath, dirNames, fileNames in os.walk(objectsDir):
+            for fileName in fileNames:
+                if fileName.endswith('.json') and (fileName[:-5] not in keepHashes):
+                    try:
+                        os.remove(os.path.join(dirPath, fileName))
+                        removedCount += 1
+                    except OSError:
+                        pass
+        with self.storeLock:
+            self.blobCache = {blobHash: jsonValue for blobHash, jsonValue in self.blobCache.items() if blobHash in keepHashes}
+        return removedCount
+
+    #
+    # Save the export, fetchedAt is only updated for the work item types whose
+    # detail was fetched this time. Returns the number of old objects removed
+    #
+    def save(self, processDict, fetchedKeys):
+
+        newManifest = {'processes': {}}
+        saveTime = time.time()
+        for processKey, curProcess in processDict['process'].items():
+            processInfo = {currKey: currValue for currKey, currValue in curProcess.items() if currKey not in ['behaviors', 'workItemTypes']}
+            processEntry = {'info': self.writeBlob(processInfo),
+                            'behaviors': self.writeBlobs(curProcess.get('behaviors', {})),
+                            'workItemTypes': {}}
+
+            for witKey, curWit in curProcess.get('workItemTypes', {}).items():
+                oldWitEntry = self.witEntry(processKey, witKey) or {}
+                witInfo = {currKey: currValue for currKey, currValue in curWit.items() if currKey not in witSubApiVersions}
+                witEntry = {'listHash': witListHash(curWit),
+                            'fetchedAt': saveTime if (processKey, witKey) in fetchedKeys else oldWitEntry.get('fetchedAt', saveTime),
+                            'info': self.writeBlob(witInfo),
+                            'layout': self.writeBlob(curWit.get('layout', {}))}
+                for witSubName in witSubKeys:
+                    witEntry[witSubName] = self.writeBlobs(curWit.get(witSubName, {}))
+                witEntry['behaviors'] = self.writeBlobs(curWit.get('behaviors', {}))
+                processEntry['workItemTypes'][witKey] = witEntry
+
+            newManifest['processes'][processKey] = processEntry
+
+        tempFilename = self.manifestFilename + '.tmp'
+        with open(tempFilename, 'w') as manifestFile:
+            json.dump(newManifest, manifestFile, indent=1, sort_keys=True)
+        os.replace(tempFilename, self.manifestFilename)
+        self.manifest = newManifest
+        return self.sweep()
+
+
+#
+# Export processes
+#
+# Returns processDict, with each process keyed by its name in lower case:
+#
+#     {'process': {<name>: <process>}}
+#
+# For a deep export each process also has its 'behaviors' and 'workItemTypes', and
+# each work item type its 'fields', 'states', 'rules', 'layout' and 'behaviors'.
+#
+# The deep export calls are made in a pool of exportWorkers threads. The work item
+# types for a process are requested as soon as the process list is back, and the
+# fields, states and rules of each work item type as soon as its process' work item
+# type list is back. The layout and behaviors of each work item type are requested
+# once its fields, states and rules are all back.
+#
+# If a snapshotStore is given the export is deep, and the layout and behaviors of
+# work item types that have not changed are taken from the store instead of Azure
+# DevOps, see ProcessSnapshotStore. The store is then updated with the export.
+#
+def exportProcesses(exportContext, deepExport=False, exportWorkers=8, snapshotStore=None):
+
+    processDict = {'process': {}}
+    for curProcess in fetchProcessList(exportContext):
+        processDict['process'].update({curProcess['name'].lower(): curProcess})
+    if not (deepExport or snapshotStore):
+        return processDict
+
+    fetchedKeys = set()
+    exportStats = {'witCalls': 0, 'witsReused': 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=exportWorkers) as exportPool:
+
+        processFutures = {}
+        for processKey, curProcess in processDict['process'].items():
+            processId = curProcess['typeId']
+            processFutures[exportPool.submit(fetchWorkItemTypes, exportContext, processId)] = (processKey, 'workItemTypes')
+            processFutures[exportPool.submit(fetchProcessBehaviors, exportContext, processId)] = (processKey, 'behaviors')
+
+        listFutures = {}
+        for currFuture in concurrent.futures.as_completed(processFutures):
+            processKey, processSubName = processFutures[currFuture]
+            curProcess = processDict['process'][processKey]
+            if processSubName == 'behaviors':
+                curProcess['behaviors'] = keyedItems(currFuture.result(), 'referenceName')
+                continue
+
+            curProcess['workItemTypes'] = keyedItems(currFuture.result(), 'referenceName')
+            for curWit in curProcess['workItemTypes'].values():
+                for witSubName in witListSubs:
+                    listFuture = exportPool.submit(fetchWitSub, exportContext, curProcess['typeId'], curWit['referenceName'], witSubName)
+                    listFutures[listFuture] = (processKey, curWit, witSubName)
+
+        #
+        # Once a work item type has its fields, states and rules the store can say
+        # whether its detail has to be fetched
+        #
+        witListsLeft = {}
+        detailFutures = {}
+        for currFuture in concurrent.futures.as_completed(listFutures):
+            processKey, curWit, witSubName = listFutures[currFuture]
+            curWit[witSubName] = currFuture.result()
+            witId = (processKey, curWit['referenceName'].lower())
+            witListsLeft[witId] = witListsLeft.get(witId, len(witListSubs)) - 1
+            if witListsLeft[witId] > 0:
+                continue
+
+            witDetail = None
+            if snapshotStore is not None:
+                witDetail = snapshotStore.witDetail(processKey, curWit)
+            if witDetail is not None:
+                curWit.update(witDetail)
+                exportStats['witsReused'] += 1
+                continue
+            fetchedKeys.add(witId)
+            for witSubName in witDetailSubs:
+                detailFuture = exportPool.submit(fetchWitSub, exportContext, processDict['process'][processKey]['typeId'], curWit['referenceName'], witSubName)
+                detailFutures[detailFuture] = (curWit, witSubName)
+
+        for currFuture in concurrent.futures.as_completed(detailFutures):
+            curWit, witSubName = detailFutures[currFuture]
+            curWit[witSubName] = currFuture.result()
+
+    exportStats['witCalls'] = len(listFutures) + len(detailFutures)
+    exportContext.logger.info('Exported ' + str(len(processDict['process'])) + ' processes, ' + str(exportStats['witCalls']) + ' work item type calls.')
+    if snapshotStore is not None:
+        removedCount = snapshotStore.save(processDict, fetchedKeys)
+        exportContext.logger.info('Snapshot: reused the layout and behaviors of ' + str(exportStats['witsReused']) + ' work item types from \'' + snapshotStore.snapshotDir + '\', removed ' + str(removedCount) + ' old objects.')
+    return processDict
+
+
+#
+# Process export diff
+# -------------------
+#
+# Compares two processDicts, for example the same org on two dates or a dev and a
+# prod org, without dumping and diffing their json.
+#
+# Each is treated as a tree of ProcessHashNode, one for the export, each process,
+# work item type, and each field, state, rule and behavior. Hashes are built from
+# the bottom up: only a node's properties are hashed as json, and a node's hash is
+# the hash of its sorted (key, hash) pairs, the hash of a group being that of its
+# items. So hashing a node hashes each leaf once, however deep it is, and the nodes
+# under it keep their hashes for the diff to compare. Where two nodes have the same
+# hash everything under them is the same, so they are not looked into.
+#
+# The groups of each level that hold keyed items, None where the items are compared
+# as a whole. Everything else, such as a work item type's layout, is a property of
+# the node it is in.
+#
+witDiffLevels = dict({witSubName: None for witSubName in witSubKeys}, behaviors=None)
+processDiffLevels = {'behaviors': None, 'workItemTypes': witDiffLevels}
+exportDiffLevels = {'process': processDiffLevels}
+
+# What the items of each group are called in the diff
+diffItemTypes = {'process': 'process',
+                 'workItemTypes': 'workItemType',
+                 'behaviors': 'behavior',
+                 'fields': 'field',
+                 'states': 'state',
+                 'rules': 'rule'}
+
+
+class ProcessHashNode:
+
+    def __init__(self, jsonValue, diffLevels):
+        self.jsonValue = jsonValue
+        self.diffLevels = diffLevels
+        self.cachedHash = None
+        self.cachedGroups = None
+
+    def nodeHash(self):
+        if self.cachedHash is None:
+            if not isinstance(self.jsonValue, dict):
+                self.cachedHash = zoyinc_std_tools.contentHash(self.jsonValue)
+            else:
+                nodeGroups = self.groups()
+                hashPairs = []
+                for currKey in sorted(self.jsonValue):
+                    if currKey in nodeGroups:
+                        groupPairs = [[itemKey, itemNode.nodeHash()] for itemKey, itemNode in sorted(nodeGroups[currKey].items())]
+                        hashPairs.append([currKey, zoyinc_std_tools.contentHash(groupPairs)])
+                    else:
+                        hashPairs.append([currKey, zoyinc_std_tools.contentHash(self.jsonValue[currKey])])
+                self.cachedHash = zoyinc_std_tools.contentHash(hashPairs)
+        return self.cachedHash
+
+    def isGroup(self, currKey):
+        return (self.diffLevels is not None) and (currKey in self.diffLevels) and isinstance(self.jsonValue[currKey], dict)
+
+    def properties(self):
+        if not isinstance(self.jsonValue, dict):
+            return {'value': self.jsonValue}
+        return {currKey: currValue for currKey, currValue in self.jsonValue.items() if not self.isGroup(currKey)}
+
+    def groups(self):
+        if self.cachedGroups is None:
+            if not isinstance(self.jsonValue, dict):
+                self.cachedGroups = {}
+            else:
+                self.cachedGroups = {currKey: {itemKey: ProcessHashNode(itemValue, self.diffLevels[currKey]) for itemKey, itemValue in currValue.items()}
+                                     for currKey, currValue in self.jsonValue.items() if self.isGroup(currKey)}
+        return self.cachedGroups
+
+
+#
+# Diff two nodes, appending the differences to processDiff
+#
+# Each difference is a dict of:
+#
+#     change     = 'added', 'removed' or 'changed'
+#     path       = List of [item type, key] down to the item, for example
+#                  [['process', 'agile'], ['workItemType', 'bug'], ['field', 'system.title']]
+#     properties = For 'changed', the names of the item's own properties that differ
+#
+# An item is only 'changed' if its own properties differ, changes to the items under
+# it are listed separately.
+#
+# With compareHashes False the nodes are not hashed, they are gone straight into.
+#
+def diffProcessNodes(oldNode, newNode, nodePath, processDiff, compareHashes=True):
+    if compareHashes and (oldNode.nodeHash() == newNode.nodeHash()):
+        return
+
+    missingValue = object()
+    oldProperties = oldNode.properties()
+    newProperties = newNode.properties()
+    changedProperties = sorted(propertyName for propertyName in set(oldProperties) | set(newProperties)
+                               if oldProperties.get(propertyName, missingValue) != newProperties.get(propertyName, missingValue))
+    if changedProperties:
+        processDiff.append({'change': 'changed', 'path': nodePath, 'properties': changedProperties})
+
+    oldGroups = oldNode.groups()
+    newGroups = newNode.groups()
+    for groupKey in sorted(set(oldGroups) | set(newGroups)):
+        oldItems = oldGroups.get(groupKey, {})
+        newItems = newGroups.get(groupKey, {})
+        itemType = diffItemTypes.get(groupKey, groupKey)
+        for itemKey in sorted(set(oldItems) | set(newItems)):
+            itemPath = nodePath + [[itemType, itemKey]]
+            if itemKey not in newItems:
+                processDiff.append({'change': 'removed', 'path': itemPath})
+            elif itemKey not in oldItems:
+                processDiff.append({'change': 'added', 'path': itemPath})
+            else:
+                diffProcessNodes(oldItems[itemKey], newItems[itemKey], itemPath, processDiff)
+
+
+#
+# Diff two processDicts, returns the list of differences, see diffProcessNodes()
+#
+# The exports as a whole are not hashed, they would have to be hashed again a
+# process at a time whenever they differ.
+#
+def diffProcessExports(oldProcessDict, newProcessDict):
+    processDiff = []
+    diffProcessNodes(ProcessHashNode(oldProcessDict, exportDiffLevels), ProcessHashNode(newProcessDict, exportDiffLevels), [], processDiff, compareHashes=False)
+    return processDiff
+
+
+#
+# A difference as a line of text:
+#
+#     + process 'agile' / workItemType 'bug' / field 'custom.severity'
+#     ~ process 'agile' / workItemType 'bug'  (layout, name)
+#
+diffChangeMarks = {'added': '+', 'removed': '-', 'changed': '~'}
+
+def diffLineOf(diffItem):
+    diffLine = diffChangeMarks[diffItem['change']] + ' ' + (' / '.join(itemType + ' \'' + str(itemKey) + '\'' for itemType, itemKey in diffItem['path']) or 'export')
+    if diffItem['change'] == 'changed':
+        diffLine += '  (' + ', '.join(diffItem['properties']) + ')'
+    return diffLine
@@ -3,45 +3,1648 @@
 # ==============
 #
 
+import collections
+import collections.abc
+import contextlib
+import datetime
+import hashlib
+import io
 import logging
-import requests
+import os
+import re
 import sys
 import json
+import threading
+import time
+import urllib.parse
+
+#
+# Request types supported by the Azure DevOps client
+#
+supportedRequestTypes = ['GET', 'PUT', 'PATCH', 'POST']
+
+#
+# Raised by AdoClient.getJson() when Azure DevOps does not return a 200
+#
+class AdoRequestError(Exception):
+
+    def __init__(self, requestURL, statusCode, reason, content=None):
+        self.requestURL = requestURL
+        self.statusCode = statusCode
+        self.reason = reason
+        self.content = content
+        super().__init__('Request to \'' + requestURL + '\' returned ' + str(statusCode) + ' (' + str(reason) + ')')
+
+
+#
+# Per host concurrency limit
+#
+# Limits the number of requests in progress to each host at the same time, no
+# matter how many threads are making calls.
+#
+class HostConcurrencyLimiter:
+
+    def __init__(self, maxPerHost):
+        self.maxPerHost = maxPerHost
+        self.hostSemaphores = {}
+        self.limiterLock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self, requestURL):
+        requestHost = urllib.parse.urlsplit(requestURL).netloc.lower()
+        with self.limiterLock:
+            if requestHost not in self.hostSemaphores:
+                self.hostSemaphores[requestHost] = threading.BoundedSemaphore(self.maxPerHost)
+            hostSemaphore = self.hostSemaphores[requestHost]
+        with hostSemaphore:
+            yield
+
+
+#
+# Azure DevOps rate limit scheduler
+# ---------------------------------
+#
+# Azure DevOps tells us when we are getting close to, or over, its rate limits with
+# these response headers:
+#
+#     Retry-After            = Seconds to wait before making another request, sent with
+#                              a 429 when we have been blocked
+#     X-RateLimit-Delay      = Seconds Azure DevOps delayed this request by
+#     X-RateLimit-Limit      = Size of the current limit
+#     X-RateLimit-Remaining  = How much of the limit is left
+#     X-RateLimit-Reset      = When, in epoch seconds, the limit resets
+#
+# Requests are paced with a token bucket per host and organization. Each bucket
+# starts at maxRate requests a second, is halved when Azure DevOps delays or blocks
+# us, slowed as the remaining limit runs low, and is put back up by increaseRate
+# each request nothing is said. A Retry-After stops all requests to the bucket until
+# that time is up.
+#
+# Every throttled 429, or 503 with a Retry-After, is retried up to maxRetries times.
+#
+class TokenBucket:
+
+    def __init__(self, tokenRate, tokenCapacity):
+        self.tokenRate = tokenRate
+        self.tokenCapacity = tokenCapacity
+        self.tokens = tokenCapacity
+        self.updatedAt = time.monotonic()
+        self.blockedUntil = 0.0
+        self.rateLimitResource = None
+
+    #
+    # Take a token and return the seconds to wait before it can be used, tokens can
+    # go below zero so those waiting are spaced out one after the other
+    #
+    def reserve(self):
+        currTime = time.monotonic()
+        self.tokens = min(self.tokenCapacity, self.tokens + (currTime - self.updatedAt) * self.tokenRate)
+        self.updatedAt = currTime
+        self.tokens -= 1
+        waitSeconds = max(0.0, self.blockedUntil - currTime)
+        if self.tokens < 0:
+            waitSeconds = max(waitSeconds, -self.tokens / self.tokenRate)
+        return waitSeconds
+
+
+def parseRetryAfter(retryAfterValue):
+    if not retryAfterValue:
+        return None
+    try:
+        return max(0.0, float(retryAfterValue))
+    except ValueError:
+        pass
+    try:
+        import email.utils
+        return max(0.0, email.utils.parsedate_to_datetime(retryAfterValue).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def parseFloatHeader(adoResponse, headerName):
+    try:
+        return float(adoResponse.headers[headerName])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class RateLimitScheduler:
+
+    throttledStatusCodes = [429, 503]
+
+    def __init__(self, maxRate=200.0, minRate=0.5, increaseRate=0.5, slowDownFraction=0.2, maxRetries=5, defaultRetryAfter=10.0):
+        self.maxRate = maxRate
+        self.minRate = minRate
+        self.increaseRate = increaseRate
+        self.slowDownFraction = slowDownFraction
+        self.maxRetries = maxRetries
+        self.defaultRetryAfter = defaultRetryAfter
+        self.buckets = {}
+        self.schedulerLock = threading.Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'retries': 0, 'waitSeconds': 0.0}
+
+    #
+    # Bucket key, the host and the organization, which is the first part of the path
+    #
+    def bucketKey(self, requestURL):
+        splitURL = urllib.parse.urlsplit(requestURL)
+        return (splitURL.netloc.lower(), splitURL.path.strip('/').split('/')[0].lower())
+
+    def bucket(self, requestURL):
+        bucketKey = self.bucketKey(requestURL)
+        if bucketKey not in self.buckets:
+            self.buckets[bucketKey] = TokenBucket(self.maxRate, self.maxRate)
+        return self.buckets[bucketKey]
+
+    #
+    # Wait until a request can be made
+    #
+    def acquire(self, requestURL):
+        with self.schedulerLock:
+            waitSeconds = self.bucket(requestURL).reserve()
+            self.stats['requests'] += 1
+            self.stats['waitSeconds'] += waitSeconds
+        if waitSeconds > 0:
+            time.sleep(waitSeconds)
+
+    #
+    # Update the bucket from the response headers, returns the seconds to wait before
+    # retrying if the request was throttled, otherwise None
+    #
+    def observe(self, requestURL, adoResponse):
+        retryAfter = parseRetryAfter(adoResponse.headers.get('Retry-After'))
+        rateLimitDelay = parseFloatHeader(adoResponse, 'X-RateLimit-Delay')
+        rateLimitLimit = parseFloatHeader(adoResponse, 'X-RateLimit-Limit')
+        rateLimitRemaining = parseFloatHeader(adoResponse, 'X-RateLimit-Remaining')
+        isThrottled = (adoResponse.status_code == 429) or ((adoResponse.status_code == 503) and (retryAfter is not None))
+        if isThrottled and (retryAfter is None):
+            retryAfter = self.defaultRetryAfter
+
+        with self.schedulerLock:
+            currBucket = self.bucket(requestURL)
+            currBucket.rateLimitResource = adoResponse.headers.get('X-RateLimit-Resource', currBucket.rateLimitResource)
+            if isThrottled:
+                self.stats['throttled'] += 1
+                currBucket.blockedUntil = max(currBucket.blockedUntil, time.monotonic() + retryAfter)
+                currBucket.tokenRate = max(self.minRate, currBucket.tokenRate / 2)
+            elif rateLimitDelay:
+                currBucket.tokenRate = max(self.minRate, currBucket.tokenRate / 2)
+            elif rateLimitRemaining is not None and rateLimitLimit:
+                remainingFraction = rateLimitRemaining / rateLimitLimit
+                if remainingFraction < self.slowDownFraction:
+                    currBucket.tokenRate = max(self.minRate, self.maxRate * remainingFraction / self.slowDownFraction)
+                else:
+                    currBucket.tokenRate = min(self.maxRate, currBucket.tokenRate + self.increaseRate)
+            else:
+                currBucket.tokenRate = min(self.maxRate, currBucket.tokenRate + self.increaseRate)
+
+            if retryAfter is not None and not isThrottled:
+                currBucket.blockedUntil = max(currBucket.blockedUntil, time.monotonic() + retryAfter)
+
+        if isThrottled:
+            return retryAfter
+        return None
+
+
+#
+# Request telemetry
+# -----------------
+#
+# When telemetry is enabled every request AdoClient sends is recorded as a span:
+#
+#     host, endpoint  = Host and url path, with ids replaced by '{id}' so requests
+#                       for different releases, processes etc. group together
+#     method, status
+#     proxy           = True if the request went through a proxy
+#     waitSeconds     = Time held back by the rate limit scheduler
+#     connectSeconds  = Time resolving the host, the TCP connect, proxy tunnel and TLS
+#                       handshake, 0 if a pooled connection was used
+#     ttfbSeconds     = Time from sending the request to the response headers
+#     totalSeconds    = Time for the whole call including retries, and the body
+#                       unless the response is streamed
+#     responseBytes, retryCount
+#
+# Scripts can also time their own phases, such as fetch, parse, validate and update,
+# with phaseTimer(). Phases are timed exclusively, time spent in a phase started
+# inside another phase is only counted against the inner one, so the phase times
+# add up to the time the script spent in them.
+#
+# At exit a json summary, and a Prometheus textfile for the node_exporter textfile
+# collector, are written to the telemetry directory.
+#
+endpointIdPattern = re.compile(r'^(?:[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|.*[0-9.].*)$')
+
+#
+# Endpoint template for a url, everything before '_apis' is the organization and
+# project so is dropped
+#
+def endpointTemplate(requestURL):
+    urlPath = urllib.parse.urlsplit(requestURL).path
+    pathParts = [currPart for currPart in urlPath.split('/') if currPart]
+    if '_apis' in pathParts:
+        pathParts = pathParts[pathParts.index('_apis'):]
+    return '/' + '/'.join('{id}' if endpointIdPattern.match(urllib.parse.unquote(currPart)) else currPart for currPart in pathParts)
+
+
+class AdoTelemetry:
+
+    spanTimings = ['waitSeconds', 'connectSeconds', 'ttfbSeconds', 'totalSeconds']
+
+    def __init__(self, jobName, telemetryDir=None, maxSpans=100000):
+        self.jobName = jobName
+        self.telemetryDir = telemetryDir
+        self.maxSpans = maxSpans
+        self.spans = []
+        self.droppedSpans = 0
+        self.endpointTotals = {}
+        self.phaseTotals = {}
+        self.startTime = time.time()
+        self.startCounter = time.perf_counter()
+        self.telemetryLock = threading.Lock()
+        self.threadState = threading.local()
+
+    def recordSpan(self, requestSpan):
+        endpointKey = (requestSpan['method'], requestSpan['host'], requestSpan['endpoint'], requestSpan['status'], requestSpan['proxy'])
+        with self.telemetryLock:
+            if len(self.spans) < self.maxSpans:
+                self.spans.append(requestSpan)
+            else:
+                self.droppedSpans += 1
+            if endpointKey not in self.endpointTotals:
+                self.endpointTotals[endpointKey] = dict({'requests': 0, 'responseBytes': 0, 'retries': 0, 'maxTotalSeconds': 0.0},
+                                                        **{currTiming: 0.0 for currTiming in self.spanTimings})
+            endpointTotal = self.endpointTotals[endpointKey]
+            endpointTotal['requests'] += 1
+            endpointTotal['responseBytes'] += requestSpan['responseBytes']
+            endpointTotal['retries'] += requestSpan['retryCount']
+            endpointTotal['maxTotalSeconds'] = max(endpointTotal['maxTotalSeconds'], requestSpan['totalSeconds'])
+            for currTiming in self.spanTimings:
+                endpointTotal[currTiming] += requestSpan[currTiming]
+
+    def addPhaseTime(self, phaseName, phaseSeconds, phaseCalls):
+        with self.telemetryLock:
+            if phaseName not in self.phaseTotals:
+                self.phaseTotals[phaseName] = {'seconds': 0.0, 'calls': 0}
+            self.phaseTotals[phaseName]['seconds'] += phaseSeconds
+            self.phaseTotals[phaseName]['calls'] += phaseCalls
+
+    #
+    # Time a phase, the time of the phase this one is inside is paused until it ends
+    #
+    @contextlib.contextmanager
+    def phase(self, phaseName):
+        phaseStack = self.threadState.__dict__.setdefault('phaseStack', [])
+        currTime = time.perf_counter()
+        if phaseStack:
+            self.addPhaseTime(phaseStack[-1][0], currTime - phaseStack[-1][1], 0)
+        phaseStack.append([phaseName, currTime])
+        try:
+            yield
+        finally:
+            currTime = time.perf_counter()
+            currPhaseName, phaseStart = phaseStack.pop()
+            self.addPhaseTime(currPhaseName, currTime - phaseStart, 1)
+            if phaseStack:
+                phaseStack[-1][1] = currTime
+
+    #
+    # Summary of the spans by endpoint, with percentiles of the total time
+    #
+    def summary(self):
+        with self.telemetryLock:
+            totalsByEndpoint = sorted(self.endpointTotals.items(), key=lambda currItem: -currItem[1]['totalSeconds'])
+            spanTotalsByEndpoint = {}
+            for currSpan in self.spans:
+                endpointKey = (currSpan['method'], currSpan['host'], currSpan['endpoint'], currSpan['status'], currSpan['proxy'])
+                spanTotalsByEndpoint.setdefault(endpointKey, []).append(currSpan['totalSeconds'])
+
+            endpointSummaries = []
+            for endpointKey, endpointTotal in totalsByEndpoint:
+                endpointSummary = dict(zip(['method', 'host', 'endpoint', 'status', 'proxy'], endpointKey), **endpointTotal)
+                spanTotals = sorted(spanTotalsByEndpoint.get(endpointKey, []))
+                if spanTotals:
+                    endpointSummary['p50TotalSeconds'] = spanTotals[int(0.50 * (len(spanTotals) - 1))]
+                    endpointSummary['p95TotalSeconds'] = spanTotals[int(0.95 * (len(spanTotals) - 1))]
+                endpointSummaries.append(endpointSummary)
+
+            return {'job': self.jobName,
+                    'startTime': self.startTime,
+                    'runSeconds': time.perf_counter() - self.startCounter,
+                    'requests': sum(currTotal['requests'] for currTotal in self.endpointTotals.values()),
+                    'endpoints': endpointSummaries,
+                    'phases': dict(self.phaseTotals),
+                    'spans': list(self.spans),
+                    'droppedSpans': self.droppedSpans}
+
+    #
+    # Prometheus text format, one gauge per metric as the values are for this run
+    #
+    def prometheusText(self, telemetrySummary):
+
+        def labelStr(labelValues):
+            return '{' + ','.join(labelName + '="' + str(labelValue).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                                  for labelName, labelValue in labelValues) + '}'
+
+        jobLabel = [('job', self.jobName)]
+        metricLines = []
+
+        def addMetric(metricName, metricHelp, metricValues):
+            metricLines.append('# HELP ' + metricName + ' ' + metricHelp)
+            metricLines.append('# TYPE ' + metricName + ' gauge')
+            for labelValues, metricValue in metricValues:
+                metricLines.append(metricName + labelStr(jobLabel + labelValues) + ' ' + repr(float(metricValue)))
+
+        endpointLabels = [([('method', currEndpoint['method']), ('host', currEndpoint['host']), ('endpoint', currEndpoint['endpoint']),
+                            ('status', currEndpoint['status']), ('proxy', str(currEndpoint['proxy']).lower())], currEndpoint)
+                          for currEndpoint in telemetrySummary['endpoints']]
+
+        addMetric('ado_requests', 'Azure DevOps requests made in the last run',
+                  [(currLabels, currEndpoint['requests']) for currLabels, currEndpoint in endpointLabels])
+        addMetric('ado_request_seconds', 'Time spent on Azure DevOps requests in the last run, by timing',
+                  [(currLabels + [('timing', currTiming[:-len('Seconds')])], currEndpoint[currTiming])
+                   for currLabels, currEndpoint in endpointLabels for currTiming in self.spanTimings])
+        addMetric('ado_request_max_seconds', 'Slowest Azure DevOps request in the last run',
+                  [(currLabels, currEndpoint['maxTotalSeconds']) for currLabels, currEndpoint in endpointLabels])
+        addMetric('ado_response_bytes', 'Bytes received from Azure DevOps in the last run',
+                  [(currLabels, currEndpoint['responseBytes']) for currLabels, currEndpoint in endpointLabels])
+        addMetric('ado_request_retries', 'Throttled Azure DevOps requests retried in the last run',
+                  [(currLabels, currEndpoint['retries']) for currLabels, currEndpoint in endpointLabels])
+        addMetric('ado_phase_seconds', 'Time spent in each phase in the last run',
+                  [([('phase', phaseName)], phaseTotal['seconds']) for phaseName, phaseTotal in sorted(telemetrySummary['phases'].items())])
+        addMetric('ado_phase_calls', 'Number of times each phase was entered in the last run',
+                  [([('phase', phaseName)], phaseTotal['calls']) for phaseName, phaseTotal in sorted(telemetrySummary['phases'].items())])
+        addMetric('ado_run_seconds', 'Wall time of the last run', [([], telemetrySummary['runSeconds'])])
+        addMetric('ado_run_timestamp_seconds', 'When the last run finished', [([], time.time())])
+        return '\n'.join(metricLines) + '\n'
+
+    #
+    # Write <job>.telemetry.json and <job>.prom to the telemetry directory
+    #
+    # The files are written to a temp file and renamed so node_exporter never reads
+    # a partly written file.
+    #
+    def write(self):
+        if not self.telemetryDir:
+            return
+        os.makedirs(self.telemetryDir, exist_ok=True)
+        telemetrySummary = self.summary()
+        for fileName, fileContent in [(self.jobName + '.telemetry.json', json.dumps(telemetrySummary, indent=4)),
+                                      (self.jobName + '.prom', self.prometheusText(telemetrySummary))]:
+            filePath = os.path.join(self.telemetryDir, fileName)
+            with open(filePath + '.tmp', 'w') as telemetryFile:
+                telemetryFile.write(fileContent)
+            os.replace(filePath + '.tmp', filePath)
+
+
+#
+# Telemetry that AdoClients without their own telemetry record to
+#
+activeTelemetry = None
+
+#
+# Turn on telemetry for this run, the files are written at exit
+#
+def enableTelemetry(jobName, telemetryDir):
+    import atexit
+    global activeTelemetry
+    activeTelemetry = AdoTelemetry(jobName, telemetryDir)
+    atexit.register(activeTelemetry.write)
+    return activeTelemetry
+
+
+#
+# Time a phase against the active telemetry, does nothing if telemetry is off
+#
+def phaseTimer(phaseName):
+    if activeTelemetry is None:
+        return contextlib.nullcontext()
+    return activeTelemetry.phase(phaseName)
+
+
+#
+# Iterate over an iterable timing the wait for each item as phaseName, used to count
+# the time reading a streamed response as fetch time
+#
+def timedPhaseIterator(iterable, phaseName):
+    currIterator = iter(iterable)
+    while True:
+        with phaseTimer(phaseName):
+            try:
+                currItem = next(currIterator)
+            except StopIteration:
+                return
+        yield currItem
+
+
+#
+# Profile a run of a script
+# =========================
+#
+# Writes to profileDir, each file named <script>_<yyyymmdd_hhmmss>:
+#
+#     .pstats      cProfile stats of the script and of every thread it started, for
+#                  pstats, snakeviz etc
+#     .top.txt     The topCount functions by cumulative and by own time
+#     .alloc.txt   The topCount lines allocating the most memory, when the traced
+#                  memory was near its peak and when the script finished
+#     .collapsed   Stacks of every thread, sampled every sampleInterval seconds, as
+#                  'frame;frame;frame count' lines for flamegraph.pl or speedscope
+#
+# cProfile only profiles the thread it is enabled in, so while profiling the threads
+# started are each given their own profile, added to the stats when the thread ends.
+# Threads still running when the script finishes are only in the sampled stacks.
+# This is done by replacing threading.Thread.run, which restoreThreads() puts back.
+# stop() always calls it, even if writing the files fails, and runScript() calls it
+# whatever happens to the script, so the patch never outlives the profiled run.
+#
+# The collapsed stacks are of wall time, so include time waiting on Azure DevOps.
+#
+# cProfile, pstats and tracemalloc are only imported when profiling.
+#
+class ScriptProfiler:
+
+    def __init__(self, scriptName, profileDir, topCount=25, sampleInterval=0.005, allocFrames=1):
+        self.scriptName = scriptName
+        self.profileDir = profileDir
+        self.topCount = topCount
+        self.sampleInterval = sampleInterval
+        self.allocFrames = allocFrames
+        self.threadProfiles = []
+        self.profilesLock = threading.Lock()
+        self.stackCounts = collections.Counter()
+        self.peakSnapshot = None
+        self.peakTime = 0.0
+        self.stopSampling = threading.Event()
+        self.threadRun = None
+        self.filePrefix = os.path.join(profileDir, scriptName + '_' + time.strftime('%Y%m%d_%H%M%S'))
+
+    def start(self):
+        import cProfile
+        import tracemalloc
+
+        self.startCounter = time.perf_counter()
+        tracemalloc.start(self.allocFrames)
+
+        # Give each thread started its own profile
+        self.threadRun = threading.Thread.run
+        scriptProfiler = self
+
+        def profiledRun(currThread):
+            threadProfile = cProfile.Profile()
+            threadProfile.enable()
+            try:
+                scriptProfiler.threadRun(currThread)
+            finally:
+                threadProfile.disable()
+                with scriptProfiler.profilesLock:
+                    scriptProfiler.threadProfiles.append(threadProfile)
+
+        threading.Thread.run = profiledRun
+        try:
+            self.samplerThread = threading.Thread(target=self.sampleStacks, name='ScriptProfilerSampler', daemon=True)
+            self.samplerThread.run = lambda: self.threadRun(self.samplerThread)
+            self.samplerThread.start()
+
+            self.mainProfile = cProfile.Profile()
+            self.mainProfile.enable()
+        except BaseException:
+            self.stopSampling.set()
+            self.restoreThreads()
+            raise
+        return self
+
+    #
+    # Put threading.Thread.run back, does nothing if it already has been
+    #
+    def restoreThreads(self):
+        if self.threadRun is not None:
+            threading.Thread.run = self.threadRun
+            self.threadRun = None
+
+    #
+    # Sample the stack of every thread, and snapshot the allocations each time the
+    # traced memory grows past the last snapshot by a tenth
+    #
+    def sampleStacks(self):
+        import tracemalloc
+
+        samplerId = threading.get_ident()
+        snapshotSize = 0
+        nextMemoryCheck = 0.0
+        while not self.stopSampling.wait(self.sampleInterval):
+            for threadId, threadFrame in sys._current_frames().items():
+                if threadId == samplerId:
+                    continue
+                stackFrames = []
+                while threadFrame is not None:
+                    frameCode = threadFrame.f_code
+                    stackFrames.append(frameCode.co_name + ' (' + os.path.basename(frameCode.co_filename) + ':' + str(frameCode.co_firstlineno) + ')')
+                    threadFrame = threadFrame.f_back
+                self.stackCounts[';'.join(reversed(stackFrames))] += 1
+
+            currTime = time.perf_counter()
+            if currTime >= nextMemoryCheck:
+                nextMemoryCheck = currTime + 0.5
+                tracedSize = tracemalloc.get_traced_memory()[0]
+                if tracedSize > snapshotSize * 1.1:
+                    self.peakSnapshot = tracemalloc.take_snapshot()
+                    self.peakTime = currTime - self.startCounter
+                    snapshotSize = tracedSize
+
+    #
+    # Stop profiling and write the files, returns the file names
+    #
+    def stop(self):
+        try:
+            self.mainProfile.disable()
+            runSeconds = time.perf_counter() - self.startCounter
+            self.stopSampling.set()
+            self.samplerThread.join()
+        finally:
+            self.restoreThreads()
+
+        import pstats
+        import tracemalloc
+
+        endSnapshot = tracemalloc.take_snapshot()
+        peakTraced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        os.makedirs(self.profileDir, exist_ok=True)
+        profileFiles = []
+
+        profileStats = pstats.Stats(self.mainProfile)
+        with self.profilesLock:
+            for threadProfile in self.threadProfiles:
+                profileStats.add(threadProfile)
+        profileStats.dump_stats(self.filePrefix + '.pstats')
+        profileFiles.append(self.filePrefix + '.pstats')
+
+        with open(self.filePrefix + '.top.txt', 'w') as topFile:
+            topFile.write('# ' + self.scriptName + ' ran for %.3fs, profiled %d threads\n' % (runSeconds, len(self.threadProfiles) + 1))
+            profileStats.stream = topFile
+            for sortKey in ['cumulative', 'tottime']:
+                profileStats.sort_stats(sortKey).print_stats(self.topCount)
+        profileFiles.append(self.filePrefix + '.top.txt')
+
+        allocFilters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')]
+        with open(self.filePrefix + '.alloc.txt', 'w') as allocFile:
+            allocFile.write('# ' + self.scriptName + ', peak traced memory %.1f MB\n' % (peakTraced / (1024.0 * 1024.0)))
+            allocSnapshots = [('at %.3fs, near the peak' % self.peakTime, self.peakSnapshot), ('at %.3fs, when the script finished' % runSeconds, endSnapshot)]
+            for snapshotName, allocSnapshot in allocSnapshots:
+                if allocSnapshot is None:
+                    continue
+                allocStats = allocSnapshot.filter_traces(allocFilters).statistics('lineno')
+                allocFile.write('\n# Top ' + str(self.topCount) + ' allocations ' + snapshotName + ', %.1f MB in total\n' % (sum(currStat.size for currStat in allocStats) / (1024.0 * 1024.0)))
+                for allocIndex, currStat in enumerate(allocStats[:self.topCount]):
+                    allocFrame = currStat.traceback[0]
+                    allocFile.write('%3d  %10.1f KB  %9d blocks  %s:%d\n' % (allocIndex + 1, currStat.size / 1024.0, currStat.count, allocFrame.filename, allocFrame.lineno))
+        profileFiles.append(self.filePrefix + '.alloc.txt')
+
+        with open(self.filePrefix + '.collapsed', 'w') as collapsedFile:
+            for currStack, stackCount in sorted(self.stackCounts.items()):
+                collapsedFile.write(currStack + ' ' + str(stackCount) + '\n')
+        profileFiles.append(self.filePrefix + '.collapsed')
+
+        return profileFiles
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, excTraceback):
+        self.profileFiles = self.stop()
+        return False
+
+
+#
+# Add the profiling arguments to a script's parser, so they are in its help, they are
+# taken off the command line by runScript() before the script sees them
+#
+def addProfileArguments(parser):
+    parser.add_argument('-profile', metavar='PROFILEDIR', help='Profile the run with cProfile and tracemalloc, writing the stats, allocations and collapsed stacks to this directory')
+    parser.add_argument('-profiletop', type=int, default=25, help='Number of functions and allocations to list in the -profile reports')
+
+
+#
+# Take '-profile <dir>' and '-profiletop <n>' off the command line, returns
+# (profileDir, topCount, remaining argv)
+#
+def splitProfileArgs(argv):
+    profileDir = None
+    topCount = 25
+    scriptArgv = []
+    argIndex = 0
+    while argIndex < len(argv):
+        argName, equalsSign, argValue = argv[argIndex].partition('=')
+        if argName in ['-profile', '-profiletop']:
+            if not equalsSign:
+                argIndex += 1
+                argValue = argv[argIndex] if argIndex < len(argv) else ''
+            if argName == '-profile':
+                profileDir = argValue
+            else:
+                topCount = int(argValue)
+        else:
+            scriptArgv.append(argv[argIndex])
+        argIndex += 1
+    return profileDir, topCount, scriptArgv
+
+
+#
+# Run a script's main(argv), profiled with ScriptProfiler if the command line has
+# '-profile <dir>', and return its exit code
+#
+def runScript(scriptName, scriptMain, argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    profileDir, topCount, scriptArgv = splitProfileArgs(argv)
+    if not profileDir:
+        return scriptMain(scriptArgv)
+
+    scriptProfiler = ScriptProfiler(scriptName, profileDir, topCount)
+    try:
+        with scriptProfiler:
+            exitCode = scriptMain(scriptArgv)
+    finally:
+        scriptProfiler.restoreThreads()
+        sys.stdout.flush()
+        print('# Profile written to ' + scriptProfiler.filePrefix + '.*', file=sys.stderr)
+    return exitCode
+
+
+#
+# Transports AdoClient can send requests with
+#
+#     requests = A pooled requests.Session, connections are kept alive and re-used
+#                between calls. Use this for anything that makes more than a few calls
+#     urllib   = Only the standard library, urllib.request. Nothing extra is
+#                imported so the script starts quicker, but every request makes a
+#                new connection. Use this for scripts that make a call or two
+#
+# The default is 'requests', or the ZOYINC_ADO_TRANSPORT environment variable.
+#
+adoTransports = ['requests', 'urllib']
+adoTransportEnv = 'ZOYINC_ADO_TRANSPORT'
+
+def defaultAdoTransport(environ=None):
+    if environ is None:
+        environ = os.environ
+    adoTransport = environ.get(adoTransportEnv, '').lower()
+    if adoTransport in adoTransports:
+        return adoTransport
+    return 'requests'
+
+
+#
+# Response headers, a dict with case insensitive names
+#
+class ResponseHeaders(collections.abc.MutableMapping):
+
+    def __init__(self, headerItems=None):
+        self.headerStore = {}
+        if headerItems is not None:
+            self.update(headerItems)
+
+    def __getitem__(self, headerName):
+        return self.headerStore[headerName.lower()][1]
+
+    def __setitem__(self, headerName, headerValue):
+        self.headerStore[headerName.lower()] = (headerName, headerValue)
+
+    def __delitem__(self, headerName):
+        del self.headerStore[headerName.lower()]
+
+    def __iter__(self):
+        return (headerName for headerName, headerValue in self.headerStore.values())
+
+    def __len__(self):
+        return len(self.headerStore)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+#
+# Text encoding from the Content-Type header, as requests works it out
+#
+def encodingOfHeaders(responseHeaders):
+    contentType = responseHeaders.get('Content-Type')
+    if not contentType:
+        return None
+    typeParts = [currPart.strip() for currPart in contentType.split(';')]
+    for currPart in typeParts[1:]:
+        paramName, sepStr, paramValue = currPart.partition('=')
+        if sepStr and (paramName.strip().lower() == 'charset'):
+            return paramValue.strip(' \'"')
+    if typeParts[0].lower().startswith('text'):
+        return 'ISO-8859-1'
+    if 'json' in typeParts[0].lower():
+        return 'utf-8'
+    return None
+
+
+#
+# Response that is not from a requests.Session, those of the urllib transport and
+# the response cache
+#
+# Has the parts of requests.Response the tools use. The body is read from bodyFile
+# the first time 'content' is used, or a chunk at a time with iter_content().
+#
+class AdoResponse:
+
+    def __init__(self, statusCode, reason, url, headerItems, bodyFile, elapsedSeconds=0.0):
+        self.status_code = statusCode
+        self.reason = reason
+        self.url = url
+        self.headers = ResponseHeaders(headerItems)
+        self.encoding = encodingOfHeaders(self.headers)
+        self.raw = bodyFile
+        self.elapsed = datetime.timedelta(seconds=elapsedSeconds)
+        self.cacheStatus = None
+        self.retryCount = 0
+        self.bodyBytes = None
+
+    @property
+    def content(self):
+        if self.bodyBytes is None:
+            try:
+                self.bodyBytes = self.raw.read()
+            finally:
+                self.raw.close()
+        return self.bodyBytes
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        if self.bodyBytes is not None:
+            for chunkStart in range(0, len(self.bodyBytes), chunk_size):
+                yield self.bodyBytes[chunkStart:chunkStart + chunk_size]
+            return
+        try:
+            while True:
+                currChunk = self.raw.read(chunk_size)
+                if not currChunk:
+                    return
+                yield currChunk
+        finally:
+            self.raw.close()
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        self.close()
+
+
+#
+# Decompresses a gzip body as it is read, closing it closes the response
+#
+class GzipBodyFile:
+
+    def __init__(self, rawFile):
+        import zlib
+        self.rawFile = rawFile
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pendingBytes = b''
+
+    def read(self, readSize=-1):
+        while (readSize < 0) or (len(self.pendingBytes) < readSize):
+            rawChunk = self.rawFile.read(65536)
+            if not rawChunk:
+                self.pendingBytes += self.decompressor.flush()
+                break
+            self.pendingBytes += self.decompressor.decompress(rawChunk)
+        if readSize < 0:
+            readSize = len(self.pendingBytes)
+        readBytes = self.pendingBytes[:readSize]
+        self.pendingBytes = self.pendingBytes[readSize:]
+        return readBytes
+
+    def close(self):
+        self.rawFile.close()
+
+
+#
+# Session for the urllib transport
+#
+# Takes the same request() arguments as a requests.Session and returns AdoResponses.
+# Without requestProxies the proxies in the environment, http_proxy and so on, are
+# used, as requests does. There is no connection pool, each request opens and closes
+# its own connection.
+#
+class UrllibSession:
+
+    # urllib raises an OSError for a proxy it can not reach, as it does for any
+    # other host, so they are not told apart
+    proxyErrors = ()
+
+    def __init__(self, azureToken, requestProxies=None):
+        import base64
+        import urllib.request
+        self.proxies = dict(requestProxies or {})
+        if requestProxies:
+            proxyHandler = urllib.request.ProxyHandler(requestProxies)
+        else:
+            proxyHandler = urllib.request.ProxyHandler()
+        self.opener = urllib.request.build_opener(proxyHandler)
+        self.authHeader = 'Basic ' + base64.b64encode((':' + azureToken).encode('utf-8')).decode('ascii')
+
+    def request(self, requestType, requestURL, params=None, data=None, headers=None, timeout=None, stream=False):
+        import socket
+        import urllib.error
+        import urllib.request
+        if params:
+            requestURL += ('&' if urllib.parse.urlsplit(requestURL).query else '?') + urllib.parse.urlencode(params, doseq=True)
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(data, doseq=True)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        urlRequest = urllib.request.Request(requestURL, data=data, method=requestType)
+        urlRequest.add_header('Accept-Encoding', 'gzip')
+        for headerName, headerValue in (headers or {}).items():
+            urlRequest.add_header(headerName, headerValue)
+        # Not sent on to another host if we are redirected
+        urlRequest.add_unredirected_header('Authorization', self.authHeader)
+
+        sendStart = time.perf_counter()
+        try:
+            urlResponse = self.opener.open(urlRequest, timeout=timeout if timeout is not None else socket.getdefaulttimeout())
+        except urllib.error.HTTPError as e:
+            urlResponse = e
+        elapsedSeconds = time.perf_counter() - sendStart
+
+        bodyFile = urlResponse
+        if urlResponse.headers.get('Content-Encoding', '').lower() == 'gzip':
+            bodyFile = GzipBodyFile(urlResponse)
+        adoResponse = AdoResponse(urlResponse.status, urlResponse.reason, urlResponse.url, urlResponse.headers.items(), bodyFile, elapsedSeconds)
+        if not stream:
+            adoResponse.content
+        return adoResponse
+
+    def close(self):
+        pass
+
+
+#
+# Pooled Azure DevOps client
+#
+# Holds a single requests.Session so the TCP/TLS connection to Azure DevOps, and
+# through any proxy, is kept alive and re-used between calls instead of a new
+# handshake being done for every request.
+#
+# poolConnections = Number of hosts to keep connection pools for
+# poolMaxSize     = Max number of connections kept open per host, this should be at
+#                   least the number of threads making calls with this client
+# maxPerHost      = If set, the max number of requests in progress to a host at once
+# transport       = 'requests' or 'urllib', see adoTransports, the urllib transport
+#                   has no pool so poolConnections and poolMaxSize are not used
+#
+# Each client has its own RateLimitScheduler unless one is given, to share rate
+# limits between clients pass the same scheduler to them.
+#
+# Requests are recorded to the telemetry given, or if none is given the telemetry
+# turned on with enableTelemetry() before the client was created. Connect times are
+# only recorded with the requests transport.
+#
+# With a responseArchive the responses are recorded to a ResponseArchiveWriter, or
+# answered from a ResponseArchive with no network and no rate limiting. This always
+# uses the requests transport.
+#
+# requests is imported, from zoyinc_http_tools, when the first client using it is
+# created, so scripts that only use the urllib transport never load it.
+#
+class AdoClient:
+
+    def __init__(self, azureToken, requestProxies=None, poolConnections=10, poolMaxSize=10, timeout=None, responseCache=None, maxPerHost=None, rateLimitScheduler=None, telemetry=None, responseArchive=None, transport=None):
+        self.azureToken = azureToken
+        self.requestProxies = requestProxies
+        self.timeout = timeout
+        self.responseCache = responseCache
+        self.responseArchive = responseArchive
+        if rateLimitScheduler is None:
+            rateLimitScheduler = RateLimitScheduler()
+        self.rateLimitScheduler = rateLimitScheduler
+        self.hostLimiter = None
+        if maxPerHost:
+            self.hostLimiter = HostConcurrencyLimiter(maxPerHost)
+        if telemetry is None:
+            telemetry = activeTelemetry
+        self.telemetry = telemetry
+
+        if transport is None:
+            transport = defaultAdoTransport()
+        if transport not in adoTransports:
+            raise ValueError('Transport \'' + str(transport) + '\' is not supported by AdoClient, use one of ' + ', '.join(adoTransports) + '.')
+        if responseArchive is not None:
+            transport = 'requests'
+        self.transport = transport
+
+        if transport == 'urllib':
+            self.session = UrllibSession(azureToken, requestProxies)
+            self.proxyErrors = UrllibSession.proxyErrors
+            self.connectionTimings = None
+        else:
+            import zoyinc_http_tools
+            self.session = zoyinc_http_tools.pooledSession(azureToken, requestProxies, poolConnections, poolMaxSize, telemetry is not None, responseArchive, archivedStatusCodes)
+            self.proxyErrors = zoyinc_http_tools.proxyErrors
+            self.connectionTimings = zoyinc_http_tools.connectionTimings
+
+    #
+    # Make a request, GETs go through the response cache if the client has one
+    #
+    # The response has a 'cacheStatus' attribute of 'hit', 'revalidated' or 'miss'
+    # when it came through the cache, otherwise it is None.
+    #
+    def request(self, requestTypeRaw, requestURL, requestParams=None, requestData=None, requestHeaders=None, stream=False):
+        requestType = requestTypeRaw.upper()
+        if requestType not in supportedRequestTypes:
+            raise ValueError('Request type \'' + requestType + '\' is not supported by AdoClient.')
+        if (self.responseCache is not None) and (requestType == 'GET'):
+            return self.responseCache.get(self, requestURL, requestParams, requestHeaders, stream)
+        adoResponse = self.sendRequest(requestType, requestURL, requestParams, requestData, requestHeaders, stream)
+        adoResponse.cacheStatus = None
+        return adoResponse
+
+    #
+    # Send the request to Azure DevOps, no caching
+    #
+    # Requests are paced by the rate limit scheduler and throttled requests are
+    # retried once the time Azure DevOps asked us to wait is up. The number of retries
+    # is in the response's 'retryCount' attribute.
+    #
+    def sendRequest(self, requestType, requestURL, requestParams=None, requestData=None, requestHeaders=None, stream=False):
+        retryCount = 0
+        waitSeconds = 0.0
+        sendStart = time.perf_counter()
+        while True:
+            waitStart = time.perf_counter()
+            if (self.responseArchive is None) or not self.responseArchive.isOffline:
+                self.rateLimitScheduler.acquire(requestURL)
+            waitSeconds += time.perf_counter() - waitStart
+            if self.connectionTimings is not None:
+                self.connectionTimings.connectSeconds = 0.0
+            if self.hostLimiter is None:
+                adoResponse = self.session.request(requestType, requestURL, params=requestParams, data=requestData, headers=requestHeaders, timeout=self.timeout, stream=stream)
+            else:
+                with self.hostLimiter.slot(requestURL):
+                    adoResponse = self.session.request(requestType, requestURL, params=requestParams, data=requestData, headers=requestHeaders, timeout=self.timeout, stream=stream)
+
+            retryAfter = self.rateLimitScheduler.observe(requestURL, adoResponse)
+            if (retryAfter is None) or (retryCount >= self.rateLimitScheduler.maxRetries):
+                adoResponse.retryCount = retryCount
+                if self.telemetry is not None:
+                    self.recordSpan(requestType, requestURL, adoResponse, stream, retryCount, waitSeconds, time.perf_counter() - sendStart)
+                return adoResponse
+
+            # The scheduler holds back the next request until retryAfter is up
+            adoResponse.close()
+            retryCount += 1
+            with self.rateLimitScheduler.schedulerLock:
+                self.rateLimitScheduler.stats['retries'] += 1
+
+    #
+    # Record the request to the telemetry, the connect time is for the last attempt
+    #
+    def recordSpan(self, requestType, requestURL, adoResponse, stream, retryCount, waitSeconds, totalSeconds):
+        connectSeconds = getattr(self.connectionTimings, 'connectSeconds', 0.0)
+        if stream:
+            responseBytes = int(adoResponse.headers.get('Content-Length', 0) or 0)
+        else:
+            responseBytes = len(adoResponse.content)
+        self.telemetry.recordSpan({'method': requestType,
+                                   'host': urllib.parse.urlsplit(requestURL).netloc.lower(),
+                                   'endpoint': endpointTemplate(requestURL),
+                                   'status': adoResponse.status_code,
+                                   'proxy': bool(self.session.proxies.get(urllib.parse.urlsplit(requestURL).scheme)),
+                                   'waitSeconds': waitSeconds,
+                                   'connectSeconds': connectSeconds,
+                                   'ttfbSeconds': max(0.0, adoResponse.elapsed.total_seconds() - connectSeconds),
+                                   'totalSeconds': totalSeconds,
+                                   'responseBytes': responseBytes,
+                                   'retryCount': retryCount})
+
+    def get(self, requestURL, **kwargs):
+        return self.request('GET', requestURL, **kwargs)
+
+    def put(self, requestURL, **kwargs):
+        return self.request('PUT', requestURL, **kwargs)
+
+    def patch(self, requestURL, **kwargs):
+        return self.request('PATCH', requestURL, **kwargs)
+
+    def post(self, requestURL, **kwargs):
+        return self.request('POST', requestURL, **kwargs)
+
+    #
+    # GET a url and return the json response, raises AdoRequestError if the
+    # response is not a 200
+    #
+    def getJson(self, requestURL, requestParams=None):
+        with phaseTimer('fetch'):
+            adoResponse = self.get(requestURL, requestParams=requestParams)
+        if adoResponse.status_code != 200:
+            raise AdoRequestError(requestURL, adoResponse.status_code, adoResponse.reason, adoResponse.content)
+        with phaseTimer('parse'):
+            return json.loads(adoResponse.content)
+
+    def close(self):
+        self.session.close()
+
+
+#
+# Azure DevOps response cache
+#
+# Caches the responses to GET requests, keyed by the token, url and parameters, in
+# memory and optionally on disk in cacheDir.
+#
+# How long a response can be used without asking Azure DevOps again depends on the
+# endpoint, see defaultEndpointTTLs. Once that time is up the request is made again
+# with the ETag/Last-Modified we have, if nothing has changed Azure DevOps returns a
+# 304 and the cached response is used.
+#
+# Both the memory and disk tiers are size bounded and the least recently used
+# responses are evicted first. Responses bigger than maxMemoryEntryBytes are only
+# kept on disk, and when streamed are written straight to disk so they are not held
+# in memory.
+#
+# The status of each response is:
+#
+#     hit         = Used the cached response without asking Azure DevOps
+#     revalidated = Azure DevOps returned a 304 so the cached response was used
+#     miss        = The response came from Azure DevOps
+#
+
+#
+# Time to live, in seconds, for endpoints. The first pattern found in the url is used.
+#
+defaultEndpointTTLs = [
+    (r'/_apis/work/processes', 3600),
+    (r'/_apis/projects', 3600),
+    (r'/_apis/release/definitions', 300),
+    (r'/_apis/release/releases', 0),
+]
+
+#
+# Headers that are not kept with a cached response, every other header is kept so a
+# cached response has the headers the caller would have read from Azure DevOps, such
+# as the x-ms-continuationtoken of a page. These describe the connection or how the
+# body was sent, which do not apply to the cached body, or the throttling and
+# cookies of the moment the response was sent.
+#
+uncachedHeaders = {'connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length', 'date', 'set-cookie',
+                   'retry-after', 'x-ratelimit-resource', 'x-ratelimit-delay', 'x-ratelimit-limit', 'x-ratelimit-remaining', 'x-ratelimit-reset'}
+
+
+def cachedHeadersOf(adoResponse):
+    return {currHeader: headerValue for currHeader, headerValue in adoResponse.headers.items() if currHeader.lower() not in uncachedHeaders}
+
+
+class AdoResponseCache:
+
+    def __init__(self, cacheDir=None, maxMemoryBytes=64 * 1024 * 1024, maxDiskBytes=512 * 1024 * 1024, maxMemoryEntryBytes=8 * 1024 * 1024, endpointTTLs=None, defaultTTL=0):
+        self.cacheDir = cacheDir
+        self.maxMemoryBytes = maxMemoryBytes
+        self.maxDiskBytes = maxDiskBytes
+        self.maxMemoryEntryBytes = maxMemoryEntryBytes
+        self.defaultTTL = defaultTTL
+        if endpointTTLs is None:
+            endpointTTLs = defaultEndpointTTLs
+        self.endpointTTLs = [(re.compile(currPattern), currTTL) for currPattern, currTTL in endpointTTLs]
+        self.cacheLock = threading.Lock()
+
+        # key: (meta, body), in least to most recently used order
+        self.memoryEntries = collections.OrderedDict()
+        self.memoryBytes = 0
+
+        # key: body size, in least to most recently used order
+        self.diskEntries = collections.OrderedDict()
+        self.diskBytes = 0
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            self.loadDiskEntries()
+
+        self.stats = {'hit': 0, 'revalidated': 0, 'miss': 0}
+
+    #
+    # Build the list of entries already on disk, oldest used first
+    #
+    def loadDiskEntries(self):
+        diskFiles = []
+        for currEntry in os.scandir(self.cacheDir):
+            if currEntry.name.endswith('.body'):
+                currStat = currEntry.stat()
+                diskFiles.append((currStat.st_mtime, currEntry.name[:-5], currStat.st_size))
+        for currMtime, currKey, currSize in sorted(diskFiles):
+            self.diskEntries[currKey] = currSize
+            self.diskBytes += currSize
+
+    def countStatus(self, cacheStatus):
+        with self.cacheLock:
+            self.stats[cacheStatus] += 1
+
+    def cacheKey(self, azureToken, requestURL, requestParams):
+        keySource = json.dumps([hashlib.sha256(azureToken.encode()).hexdigest(), requestURL, sorted((requestParams or {}).items())])
+        return hashlib.sha256(keySource.encode()).hexdigest()
+
+    def ttlFor(self, requestURL):
+        for currPattern, currTTL in self.endpointTTLs:
+            if currPattern.search(requestURL):
+                return currTTL
+        return self.defaultTTL
+
+    def diskPath(self, cacheKey, fileExt):
+        return os.path.join(self.cacheDir, cacheKey + fileExt)
+
+    #
+    # Find an entry, returns (meta, body) where body is bytes for an in memory
+    # entry or None if the body is on disk
+    #
+    def lookup(self, cacheKey):
+        with self.cacheLock:
+            if cacheKey in self.memoryEntries:
+                self.memoryEntries.move_to_end(cacheKey)
+                return self.memoryEntries[cacheKey]
+            if cacheKey not in self.diskEntries:
+                return None
+            self.diskEntries.move_to_end(cacheKey)
+        try:
+            with open(self.diskPath(cacheKey, '.json'), 'r') as metaFile:
+                cacheMeta = json.load(metaFile)
+            os.utime(self.diskPath(cacheKey, '.body'))
+        except (OSError, ValueError):
+            self.removeDiskEntry(cacheKey)
+            return None
+        return cacheMeta, None
+
+    def removeDiskEntry(self, cacheKey):
+        with self.cacheLock:
+            if cacheKey in self.diskEntries:
+                self.diskBytes -= self.diskEntries.pop(cacheKey)
+        for fileExt in ['.body', '.json']:
+            try:
+                os.remove(self.diskPath(cacheKey, fileExt))
+            except OSError:
+                pass
+
+    #
+    # Store a response, bodyFilename is used when the body has already been written
+    # to a temporary file in the cache directory
+    #
+    def store(self, cacheKey, cacheMeta, body=None, bodyFilename=None):
+        if bodyFilename is not None:
+            bodySize = os.path.getsize(bodyFilename)
+        else:
+            bodySize = len(body)
+        cacheMeta['size'] = bodySize
+
+        if self.cacheDir is not None:
+            if bodyFilename is None:
+                bodyFilename = self.diskPath(cacheKey, '.tmp' + str(threading.get_ident()))
+                with open(bodyFilename, 'wb') as bodyFile:
+                    bodyFile.write(body)
+            os.replace(bodyFilename, self.diskPath(cacheKey, '.body'))
+            self.writeMeta(cacheKey, cacheMeta)
+
+        evictKeys = []
+        with self.cacheLock:
+            if cacheKey in self.memoryEntries:
+                self.memoryBytes -= len(self.memoryEntries.pop(cacheKey)[1])
+            if (body is not None) and (bodySize <= self.maxMemoryEntryBytes):
+                self.memoryEntries[cacheKey] = (cacheMeta, body)
+                self.memoryBytes += bodySize
+                while self.memoryBytes > self.maxMemoryBytes:
+                    oldKey, oldEntry = self.memoryEntries.popitem(last=False)
+                    self.memoryBytes -= len(oldEntry[1])
+
+            if self.cacheDir is not None:
+                if cacheKey in self.diskEntries:
+                    self.diskBytes -= self.diskEntries.pop(cacheKey)
+                self.diskEntries[cacheKey] = bodySize
+                self.diskBytes += bodySize
+                while (self.diskBytes > self.maxDiskBytes) and (len(self.diskEntries) > 1):
+                    oldKey = next(iter(self.diskEntries))
+                    self.diskBytes -= self.diskEntries.pop(oldKey)
+                    evictKeys.append(oldKey)
+        for oldKey in evictKeys:
+            self.removeDiskEntry(oldKey)
+
+    def writeMeta(self, cacheKey, cacheMeta):
+        if self.cacheDir is not None:
+            tempFilename = self.diskPath(cacheKey, '.jsontmp' + str(threading.get_ident()))
+            with open(tempFilename, 'w') as metaFile:
+                json.dump(cacheMeta, metaFile)
+            os.replace(tempFilename, self.diskPath(cacheKey, '.json'))
+
+    #
+    # Build a response from a cached entry
+    #
+    def cachedResponse(self, cacheKey, cacheMeta, body, cacheStatus):
+        if body is not None:
+            bodyFile = io.BytesIO(body)
+        else:
+            bodyFile = open(self.diskPath(cacheKey, '.body'), 'rb')
+        adoResponse = AdoResponse(cacheMeta['status_code'], cacheMeta['reason'], cacheMeta['url'], cacheMeta['headers'], bodyFile)
+        adoResponse.cacheStatus = cacheStatus
+        return adoResponse
+
+    #
+    # GET a url through the cache
+    #
+    def get(self, adoClient, requestURL, requestParams=None, requestHeaders=None, stream=False):
+
+        cacheKey = self.cacheKey(adoClient.azureToken, requestURL, requestParams)
+        cacheEntry = self.lookup(cacheKey)
+        conditionalHeaders = dict(requestHeaders or {})
+
+        if cacheEntry is not None:
+            cacheMeta, body = cacheEntry
+            if time.time() - cacheMeta['storedAt'] < self.ttlFor(requestURL):
+                self.countStatus('hit')
+                return self.cachedResponse(cacheKey, cacheMeta, body, 'hit')
+            if cacheMeta['etag']:
+                conditionalHeaders['If-None-Match'] = cacheMeta['etag']
+            if cacheMeta['lastModified']:
+                conditionalHeaders['If-Modified-Since'] = cacheMeta['lastModified']
+
+        adoResponse = adoClient.sendRequest('GET', requestURL, requestParams, None, conditionalHeaders, stream=True)
+
+        if (adoResponse.status_code == 304) and (cacheEntry is not None):
+            adoResponse.close()
+            cacheMeta['storedAt'] = time.time()
+            self.writeMeta(cacheKey, cacheMeta)
+            self.countStatus('revalidated')
+            return self.cachedResponse(cacheKey, cacheMeta, body, 'revalidated')
+
+        self.countStatus('miss')
+        adoResponse.cacheStatus = 'miss'
+        if (adoResponse.status_code != 200) or ('no-store' in adoResponse.headers.get('Cache-Control', '')):
+            if not stream:
+                adoResponse.content
+            return adoResponse
+
+        cacheMeta = {'url': requestURL,
+                     'status_code': adoResponse.status_code,
+                     'reason': adoResponse.reason,
+                     'headers': cachedHeadersOf(adoResponse),
+                     'etag': adoResponse.headers.get('ETag'),
+                     'lastModified': adoResponse.headers.get('Last-Modified'),
+                     'storedAt': time.time()}
+
+        #
+        # Streamed responses are written straight to disk and then read back from
+        # there, if there is no disk tier they have to be read into memory
+        #
+        if stream and (self.cacheDir is not None):
+            bodyFilename = self.diskPath(cacheKey, '.tmp' + str(threading.get_ident()))
+            with open(bodyFilename, 'wb') as bodyFile:
+                for currChunk in adoResponse.iter_content(chunk_size=65536):
+                    bodyFile.write(currChunk)
+            self.store(cacheKey, cacheMeta, bodyFilename=bodyFilename)
+            return self.cachedResponse(cacheKey, cacheMeta, None, 'miss')
+
+        self.store(cacheKey, cacheMeta, body=adoResponse.content)
+        return adoResponse
+
+
+#
+# Lock file shared between processes
+#
+# Holds an exclusive lock on lockFilename, with fcntl.flock() or on Windows
+# msvcrt.locking(), so only one process on the host is in the 'with' block at a
+# time. The lock goes when the file is closed, so a process that dies does not leave
+# it held. Raises TimeoutError if the lock is not got within timeout seconds, None
+# waits for ever.
+#
+class FileLock:
+
+    def __init__(self, lockFilename, timeout=None, pollInterval=0.02):
+        self.lockFilename = lockFilename
+        self.timeout = timeout
+        self.pollInterval = pollInterval
+        self.lockFile = None
+        self.waitSeconds = 0.0
+
+    def tryLock(self):
+        if os.name == 'nt':
+            import msvcrt
+            self.lockFile.seek(0)
+            msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def acquire(self):
+        self.lockFile = open(self.lockFilename, 'a+b')
+        waitStart = time.perf_counter()
+        while True:
+            try:
+                self.tryLock()
+                self.waitSeconds = time.perf_counter() - waitStart
+                return self
+            except OSError:
+                if (self.timeout is not None) and (time.perf_counter() - waitStart >= self.timeout):
+                    self.lockFile.close()
+                    self.lockFile = None
+                    raise TimeoutError('Timed out after ' + str(self.timeout) + 's waiting for the lock \'' + self.lockFilename + '\'')
+                time.sleep(self.pollInterval)
+
+    def release(self):
+        if self.lockFile is None:
+            return
+        if os.name == 'nt':
+            import msvcrt
+            self.lockFile.seek(0)
+            msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+        self.lockFile.close()
+        self.lockFile = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, excType, excValue, excTraceback):
+        self.release()
+
+
+#
+# Response archive
+# ================
+#
+# Records the responses to GET requests into a single compressed file, so scripts can
+# be run again later against the archive with no network, for example to check new
+# global variable rules against every release that was recorded.
+#
+# The archive file is:
+#
+#     archiveMagic
+#     Records, each:  key hash (16 bytes), length (8 bytes), zlib compressed
+#                     '<json meta>\n<body>'
+#     Index:          (key hash, record offset, record length) for every record,
+#                     sorted by key hash, 32 bytes each
+#     Trailer:        index offset (8 bytes), index count (8 bytes), archiveMagic
+#
+# The key is the method and the url, with the query parameters sorted, and the key
+# hash the first 16 bytes of its sha256. Replay memory maps the file and binary
+# searches the index in place, so opening an archive takes the same time however
+# many responses are in it, and a response is only read and decompressed when it is
+# asked for.
+#
+# Recording to an existing archive adds to it, a response recorded again replaces
+# the earlier one. If a recording is stopped before the index is written the index
+# is rebuilt from the records the next time the archive is recorded to.
+#
+archiveMagic = b'ZOYINCARCHIVE01\n'
+archivedStatusCodes = RateLimitScheduler.throttledStatusCodes
+
+#
+# (record header, index entry, trailer) structs, struct is only imported by the
+# scripts that use an archive
+#
+def archiveStructs():
+    import struct
+    return struct.Struct('>16sQ'), struct.Struct('>16sQQ'), struct.Struct('>QQ16s')
+
+#
+# Key of a request in the archive, and its hash
+#
+def archiveKeyOf(requestMethod, requestURL):
+    splitURL = urllib.parse.urlsplit(requestURL)
+    sortedQuery = '&'.join(sorted(currParam for currParam in splitURL.query.split('&') if currParam))
+    archiveKey = requestMethod.upper() + ' ' + splitURL.scheme.lower() + '://' + splitURL.netloc.lower() + splitURL.path + '?' + sortedQuery
+    return archiveKey, hashlib.sha256(archiveKey.encode('utf-8')).digest()[:16]
+
+
+class ResponseArchiveWriter:
+
+    isOffline = False
+
+    def __init__(self, archiveFilename, compressLevel=6):
+        self.archiveFilename = archiveFilename
+        self.compressLevel = compressLevel
+        self.recordHeader, self.indexEntry, self.trailer = archiveStructs()
+        self.indexEntries = {}
+        self.archiveLock = threading.Lock()
+        self.stats = {'recorded': 0, 'bodyBytes': 0}
+
+        if os.path.exists(archiveFilename) and os.path.getsize(archiveFilename) >= len(archiveMagic):
+            self.archiveFile = open(archiveFilename, 'r+b')
+            self.readExisting()
+        else:
+            self.archiveFile = open(archiveFilename, 'w+b')
+            self.archiveFile.write(archiveMagic)
+
+    #
+    # Load the index of an existing archive and drop it, and the trailer, from the
+    # end of the file so new records are written after the existing ones
+    #
+    def readExisting(self):
+        if self.archiveFile.read(len(archiveMagic)) != archiveMagic:
+            raise ValueError('\'' + self.archiveFilename + '\' is not a response archive.')
+        fileSize = self.archiveFile.seek(0, os.SEEK_END)
+        recordsEnd = None
+        if fileSize >= len(archiveMagic) + self.trailer.size:
+            self.archiveFile.seek(fileSize - self.trailer.size)
+            indexOffset, indexCount, trailerMagic = self.trailer.unpack(self.archiveFile.read(self.trailer.size))
+            if (trailerMagic == archiveMagic) and (indexOffset + indexCount * self.indexEntry.size + self.trailer.size == fileSize):
+                self.archiveFile.seek(indexOffset)
+                indexBytes = self.archiveFile.read(indexCount * self.indexEntry.size)
+                for keyHash, recordOffset, recordLength in self.indexEntry.iter_unpack(indexBytes):
+                    self.indexEntries[keyHash] = (recordOffset, recordLength)
+                recordsEnd = indexOffset
+
+        # No index, rebuild it from the records, dropping a record only partly written
+        if recordsEnd is None:
+            recordsEnd = len(archiveMagic)
+            while recordsEnd + self.recordHeader.size <= fileSize:
+                self.archiveFile.seek(recordsEnd)
+                keyHash, recordLength = self.recordHeader.unpack(self.archiveFile.read(self.recordHeader.size))
+                if recordsEnd + self.recordHeader.size + recordLength > fileSize:
+                    break
+                self.indexEntries[keyHash] = (recordsEnd, recordLength)
+                recordsEnd += self.recordHeader.size + recordLength
+
+        self.archiveFile.truncate(recordsEnd)
+        self.archiveFile.seek(recordsEnd)
+
+    def add(self, requestMethod, requestURL, statusCode, reason, responseHeaders, body):
+        import zlib
+        archiveKey, keyHash = archiveKeyOf(requestMethod, requestURL)
+        recordMeta = {'key': archiveKey, 'url': requestURL, 'status_code': statusCode, 'reason': reason, 'headers': responseHeaders}
+        recordBytes = zlib.compress(json.dumps(recordMeta).encode('utf-8') + b'\n' + body, self.compressLevel)
+        with self.archiveLock:
+            recordOffset = self.archiveFile.tell()
+            self.archiveFile.write(self.recordHeader.pack(keyHash, len(recordBytes)))
+            self.archiveFile.write(recordBytes)
+            self.indexEntries[keyHash] = (recordOffset, len(recordBytes))
+            self.stats['recorded'] += 1
+            self.stats['bodyBytes'] += len(body)
+
+    #
+    # Write the index and trailer
+    #
+    def close(self):
+        with self.archiveLock:
+            if self.archiveFile.closed:
+                return
+            indexOffset = self.archiveFile.tell()
+            for keyHash in sorted(self.indexEntries):
+                self.archiveFile.write(self.indexEntry.pack(keyHash, *self.indexEntries[keyHash]))
+            self.archiveFile.write(self.trailer.pack(indexOffset, len(self.indexEntries), archiveMagic))
+            self.archiveFile.close()
+
+
+class ResponseArchive:
+
+    isOffline = True
+
+    def __init__(self, archiveFilename):
+        import mmap
+        self.archiveFilename = archiveFilename
+        self.recordHeader, self.indexEntry, self.trailer = archiveStructs()
+        self.stats = {'replayed': 0, 'missing': 0}
+        self.statsLock = threading.Lock()
+        with open(archiveFilename, 'rb') as archiveFile:
+            self.archiveMap = mmap.mmap(archiveFile.fileno(), 0, access=mmap.ACCESS_READ)
+        if (len(self.archiveMap) < len(archiveMagic) + self.trailer.size) or (self.archiveMap[:len(archiveMagic)] != archiveMagic):
+            raise ValueError('\'' + archiveFilename + '\' is not a response archive.')
+        self.indexOffset, self.indexCount, trailerMagic = self.trailer.unpack_from(self.archiveMap, len(self.archiveMap) - self.trailer.size)
+        if trailerMagic != archiveMagic:
+            raise ValueError('Response archive \'' + archiveFilename + '\' has no index, record to it again to rebuild the index.')
+
+    def __len__(self):
+        return self.indexCount
+
+    #
+    # Binary search the index for the key hash, returns (record offset, record length)
+    # or None
+    #
+    def findRecord(self, keyHash):
+        lowIndex = 0
+        highIndex = self.indexCount
+        while lowIndex < highIndex:
+            midIndex = (lowIndex + highIndex) // 2
+            midHash, recordOffset, recordLength = self.indexEntry.unpack_from(self.archiveMap, self.indexOffset + midIndex * self.indexEntry.size)
+            if midHash < keyHash:
+                lowIndex = midIndex + 1
+            elif midHash > keyHash:
+                highIndex = midIndex
+            else:
+                return recordOffset, recordLength
+        return None
+
+    #
+    # Look up a response, returns (meta, body) or None if it was not recorded
+    #
+    def get(self, requestMethod, requestURL):
+        import zlib
+        archiveKey, keyHash = archiveKeyOf(requestMethod, requestURL)
+        foundRecord = self.findRecord(keyHash)
+        recordMeta = None
+        if foundRecord is not None:
+            recordOffset, recordLength = foundRecord
+            recordStart = recordOffset + self.recordHeader.size
+            recordMetaBytes, body = zlib.decompress(self.archiveMap[recordStart:recordStart + recordLength]).split(b'\n', 1)
+            recordMeta = json.loads(recordMetaBytes)
+        with self.statsLock:
+            if (recordMeta is None) or (recordMeta['key'] != archiveKey):
+                self.stats['missing'] += 1
+                return None
+            self.stats['replayed'] += 1
+        return recordMeta, body
+
+    def close(self):
+        self.archiveMap.close()
+
+
+#
+# Open the archive for '-recordarchive' or '-replayarchive', returns None if neither
+# is given. A recorded archive is closed, writing its index, at exit.
+#
+def openResponseArchive(recordFilename=None, replayFilename=None):
+    if recordFilename and replayFilename:
+        raise ValueError('Only one of -recordarchive and -replayarchive can be given.')
+    if replayFilename:
+        return ResponseArchive(replayFilename)
+    if recordFilename:
+        import atexit
+        archiveWriter = ResponseArchiveWriter(recordFilename)
+        atexit.register(archiveWriter.close)
+        return archiveWriter
+    return None
+
+
+#
+# Shared clients
+#
+# adoAPICall() is called with a token and proxies each time, rather than a client, so
+# keep one client per token/proxy combination and hand that back on each call.
+#
+adoClients = {}
+adoClientsLock = threading.Lock()
+
+def getAdoClient(azureToken, requestProxies=None):
+
+    if requestProxies:
+        clientKey = (azureToken, tuple(sorted(requestProxies.items())))
+    else:
+        clientKey = (azureToken, None)
+    with adoClientsLock:
+        if clientKey not in adoClients:
+            adoClients[clientKey] = AdoClient(azureToken, requestProxies)
+        return adoClients[clientKey]
+
 
 #
 # Azure DevOps REST api call
 #
 # Requests docs: https://requests.readthedocs.io/en/latest/api/
 #
-def adoAPICall(logger, requestURL, requestTypeRaw, requestParams, requestData, requestHeaders, requestProxies, azureToken, failOnError):
+# If no adoClient is given the shared client for the token/proxies is used.
+#
+def adoAPICall(logger, requestURL, requestTypeRaw, requestParams, requestData, requestHeaders, requestProxies, azureToken, failOnError, adoClient=None):
 
     currFunction = __name__ + '.adoAPICall()'
-    logger.debug('running function ' + currFunction)
+    logger.debug('running function %s', currFunction)
     errorsFound = False
+    adoResponse = None
+    responseJson = None
 
     requestType = requestTypeRaw.upper()
-    if requestType not in ['GET', ]:
+    if requestType not in supportedRequestTypes:
         logger.error('#')
         logger.error('# Request type \'' + requestType + '\' not currently supported in this function \'' + currFunction + '\'.')
         logger.error('#')
         sys.stdout.flush()
         exit(1)
 
-    if requestType == 'GET':
-        logger.debug('Making request.' + requestType.lower() + '() call')
-        logger.debug('URL: ' + requestURL)
-        try:
-            adoResponse = requests.get(requestURL, params=requestParams, data=requestData, headers=requestHeaders, proxies = requestProxies, auth=('', azureToken), )
-            logger.debug('Response.content: ' + str(adoResponse.content))
-        except requests.exceptions.ProxyError as e:
-            errorsFound = True
-            errorMsg = 'Failed to load json response.\nError:' + str(e)       
+    if adoClient is None:
+        adoClient = getAdoClient(azureToken, requestProxies)
+
+    logger.debug('Making request.%s() call', requestType.lower())
+    logger.debug('URL: %s', requestURL)
+    try:
+        with phaseTimer('fetch'):
+            adoResponse = adoClient.request(requestType, requestURL, requestParams=requestParams, requestData=requestData, requestHeaders=requestHeaders)
+        logger.debug('Cache status: %s', adoResponse.cacheStatus)
+        logger.debug('Response.content: %s', LogPayload(adoResponse.content))
+    except adoClient.proxyErrors as e:
+        errorsFound = True
+        errorMsg = 'Failed to load json response.\nError:' + str(e)       
 
     # Check the response
     if not errorsFound: 
         if adoResponse.status_code == 200:        
             try:
-                responseJson = json.loads(adoResponse.content)
+                with phaseTimer('parse'):
+                    responseJson = json.loads(adoResponse.content)
             except ValueError as e:
                 errorsFound = True
                 errorMsg = 'Failed to load json response.\nError:' + str(e)
@@ -72,32 +1675,364 @@ def adoAPICall(logger, requestURL, requestTypeRaw, requestParams, requestData, r
             logger.error('#')
             for currLine in errorMsg.splitlines():
                 logger.error(currLine)
-            logger.error()
+            logger.error('')
             sys.stdout.flush()
     
     if errorsFound:
         adoApiReturn = {'json':None,
-                    'status_code':adoResponse.status_code,
-                    'content':adoResponse.content,
+                    'status_code':adoResponse.status_code if adoResponse is not None else None,
+                    'content':adoResponse.content if adoResponse is not None else None,
                     'errorMsg':errorMsg,
+                    'cacheStatus':getattr(adoResponse, 'cacheStatus', None),
+                    'continuationToken':None,
                     'success':False}
     else:
         adoApiReturn = {'json':responseJson,
                     'status_code':adoResponse.status_code,
                     'content':adoResponse.content,
                     'errorMsg':None,
+                    'cacheStatus':adoResponse.cacheStatus,
+                    'continuationToken':adoResponse.headers.get(continuationTokenHeader),
                     'success':True}
     
     return adoApiReturn
 
 
+#
+# Paged Azure DevOps lists
+# ------------------------
+#
+# List apis return a page of {'count': n, 'value': [...]} and, if there are more,
+# an x-ms-continuationtoken header. The token is sent back as the continuationToken
+# parameter to get the next page. adoAPICall() only makes the one request, the
+# token is returned in its 'continuationToken' so the caller can see there is more.
+#
+# iterAdoPages() follows the tokens and yields each page, iterAdoItems() the items
+# in them, so only a page is held at a time however long the list is. With prefetch
+# the next page is requested in the background while the caller works through the
+# current one.
+#
+# Raise AdoRequestError if a page can not be fetched.
+#
+continuationTokenHeader = 'x-ms-continuationtoken'
+
+#
+# Get a page, returns (page json, continuation token or None)
+#
+def fetchAdoPage(adoClient, requestURL, requestParams, continuationToken):
+    pageParams = dict(requestParams or {})
+    if continuationToken is not None:
+        pageParams['continuationToken'] = continuationToken
+    with phaseTimer('fetch'):
+        adoResponse = adoClient.get(requestURL, requestParams=pageParams or None)
+    if adoResponse.status_code != 200:
+        raise AdoRequestError(requestURL, adoResponse.status_code, adoResponse.reason, adoResponse.content)
+    with phaseTimer('parse'):
+        pageJson = json.loads(adoResponse.content)
+    return pageJson, adoResponse.headers.get(continuationTokenHeader) or None
+
+
+def iterAdoPages(adoClient, requestURL, requestParams=None, prefetch=False):
+    pagePool = None
+    if prefetch:
+        import concurrent.futures
+        pagePool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        continuationToken = None
+        nextPage = None
+        while True:
+            if nextPage is None:
+                pageJson, continuationToken = fetchAdoPage(adoClient, requestURL, requestParams, continuationToken)
+            else:
+                pageJson, continuationToken = nextPage.result()
+                nextPage = None
+            if continuationToken and (pagePool is not None):
+                nextPage = pagePool.submit(fetchAdoPage, adoClient, requestURL, requestParams, continuationToken)
+            yield pageJson
+            if not continuationToken:
+                return
+    finally:
+        if pagePool is not None:
+            pagePool.shutdown(wait=False)
+
+
+def iterAdoItems(adoClient, requestURL, requestParams=None, prefetch=False):
+    for pageJson in iterAdoPages(adoClient, requestURL, requestParams, prefetch):
+        yield from pageJson.get('value', [])
+
+
+#
+# Hash of a json document's content
+#
+# Keys are sorted so the same content always gives the same hash, whatever order
+# Azure DevOps returned it in.
+#
+def contentHash(jsonValue):
+    return hashlib.sha256(json.dumps(jsonValue, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+#
+# Project a json document down to the parts that are needed
+#
+# keepPaths are dotted key paths, arrays are passed through so 'environments.name'
+# keeps the name of every stage. Everything not on a kept path is dropped, so it can
+# be freed straight after parsing rather than held for the life of the document.
+#
+#     projectJson(releaseDetail, ['variables', 'environments.name', 'environments.deploySteps'])
+#
+def projectJson(jsonValue, keepPaths):
+    keepTree = {}
+    for currPath in keepPaths:
+        pathKeys = currPath.split('.')
+        treeNode = keepTree
+        for pathKey in pathKeys[:-1]:
+            # An earlier path already keeps all of this
+            if (pathKey in treeNode) and (treeNode[pathKey] is None):
+                break
+            treeNode = treeNode.setdefault(pathKey, {})
+        else:
+            treeNode[pathKeys[-1]] = None
+    return projectJsonTree(jsonValue, keepTree)
+
+
+#
+# keepTree is a dict of the keys to keep, each with the keepTree for its value or
+# None to keep all of it
+#
+def projectJsonTree(jsonValue, keepTree):
+    if keepTree is None:
+        return jsonValue
+    if isinstance(jsonValue, list):
+        return [projectJsonTree(currItem, keepTree) for currItem in jsonValue]
+    if isinstance(jsonValue, dict):
+        return {currKey: projectJsonTree(currValue, keepTree[currKey]) for currKey, currValue in jsonValue.items() if currKey in keepTree}
+    return jsonValue
+
+
+#
+# Decode a streamed response into text chunks
+#
+# Used with AdoClient.get(..., stream=True) so the response body is never held in
+# memory all at once.
+#
+def iterResponseText(adoResponse, chunkSize=65536):
+    import codecs
+    textDecoder = codecs.getincrementaldecoder(adoResponse.encoding or 'utf-8')(errors='replace')
+    for currChunk in adoResponse.iter_content(chunk_size=chunkSize):
+        currText = textDecoder.decode(currChunk)
+        if currText:
+            yield currText
+    currText = textDecoder.decode(b'', final=True)
+    if currText:
+        yield currText
+
+
+#
+# Incremental JSON parser
+#
+# Parses JSON from an iterable of text chunks and yields (prefix, event, value) for
+# each item as it is read, without building the document in memory. The events are
+# the same as the ijson library:
+#
+#     start_map, map_key, end_map, start_array, end_array,
+#     string, number, boolean, null
+#
+# prefix is the path to the item with 'item' for array entries, for example the name
+# of each release stage is reported as:
+#
+#     ('environments.item.name', 'string', 'PRD')
+#
+# With indexedPaths the prefix is instead a tuple of the keys and array indexes,
+# which tells the items of an array apart:
+#
+#     (('environments', 0, 'name'), 'string', 'PRD')
+#
+jsonTokenPattern = re.compile(r'[ \t\r\n]*(?:([\[\]{},:])|"([^"\\]*(?:\\.[^"\\]*)*)"|(-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)|(true|false|null))')
+jsonWhitespacePattern = re.compile(r'[ \t\r\n]*')
+jsonNumberTailPattern = re.compile(r'[0-9.eE+-]*')
+jsonLiterals = {'true': ('boolean', True), 'false': ('boolean', False), 'null': ('null', None)}
+
+def iterJsonEvents(textChunks, indexedPaths=False):
+
+    textChunks = iter(textChunks)
+    textBuffer = ''
+    bufferPos = 0
+    endOfText = False
+
+    # containerStack holds True for a map and False for an array, path holds the
+    # current key, or 'item' or the index, for each of them
+    containerStack = []
+    path = []
+    expectKey = False
+    if indexedPaths:
+        joinPath = tuple
+        arrayItem = -1
+    else:
+        joinPath = '.'.join
+        arrayItem = 'item'
+
+    while True:
+
+        tokenMatch = jsonTokenPattern.match(textBuffer, bufferPos)
+
+        #
+        # A token that runs to the end of the buffer may carry on in the next chunk
+        # so read more before using it, numbers like '2.' are only complete once
+        # something other than a digit, '.', 'e' or sign follows them
+        #
+        needMoreText = (tokenMatch is None) or (tokenMatch.end() == len(textBuffer))
+        if (not needMoreText) and (tokenMatch.group(3) is not None):
+            needMoreText = jsonNumberTailPattern.match(textBuffer, tokenMatch.end()).end() == len(textBuffer)
+        if needMoreText and not endOfText:
+            nextChunk = next(textChunks, None)
+            if nextChunk is None:
+                endOfText = True
+            else:
+                textBuffer = textBuffer[bufferPos:] + nextChunk
+                bufferPos = 0
+            continue
+
+        if tokenMatch is None:
+            if jsonWhitespacePattern.match(textBuffer, bufferPos).end() == len(textBuffer):
+                if containerStack:
+                    raise ValueError('Incomplete JSON, the text ended inside ' + ('a map' if containerStack[-1] else 'an array'))
+                return
+            raise ValueError('Invalid JSON at: ' + textBuffer[bufferPos:bufferPos + 40])
+        bufferPos = tokenMatch.end()
+
+        punctuation, stringValue, numberValue, literalValue = tokenMatch.groups()
+
+        # Array items are numbered as they start
+        if indexedPaths and containerStack and (not containerStack[-1]) and (punctuation not in (',', ']')):
+            path[-1] += 1
+
+        if punctuation is not None:
+            if punctuation == '{':
+                yield joinPath(path), 'start_map', None
+                containerStack.append(True)
+                path.append(None)
+                expectKey = True
+            elif punctuation == '[':
+                yield joinPath(path), 'start_array', None
+                containerStack.append(False)
+                path.append(arrayItem)
+                expectKey = False
+            elif punctuation == '}':
+                containerStack.pop()
+                path.pop()
+                yield joinPath(path), 'end_map', None
+                expectKey = False
+            elif punctuation == ']':
+                containerStack.pop()
+                path.pop()
+                yield joinPath(path), 'end_array', None
+                expectKey = False
+            elif punctuation == ',':
+                expectKey = containerStack[-1]
+            continue
+
+        if stringValue is not None:
+            if '\\' in stringValue:
+                stringValue = json.loads('"' + stringValue + '"')
+            if expectKey:
+                path[-1] = stringValue
+                yield joinPath(path[:-1]), 'map_key', stringValue
+                expectKey = False
+            else:
+                yield joinPath(path), 'string', stringValue
+        elif numberValue is not None:
+            if '.' in numberValue or 'e' in numberValue or 'E' in numberValue:
+                yield joinPath(path), 'number', float(numberValue)
+            else:
+                yield joinPath(path), 'number', int(numberValue)
+        else:
+            literalEvent, literalPyValue = jsonLiterals[literalValue]
+            yield joinPath(path), literalEvent, literalPyValue
+
+
+#
+# Payload that is only turned into a string when a log record is written
+#
+# Log with '%s' and a LogPayload, rather than concatenating the payload into the
+# message, and nothing is done with the payload unless the record is written. When
+# it is, only the first maxBytes are written followed by how much was left out. A
+# str payload is measured in its utf-8 bytes.
+#
+# The handlers of enableLogging() write up to their own maxPayloadBytes, see
+# PayloadFormatter, other handlers up to defaultMaxBytes.
+#
+class LogPayload:
+
+    defaultMaxBytes = 4096
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def truncated(self, maxBytes):
+        if (self.payload is None) or (maxBytes is None):
+            return str(self.payload)
+        if isinstance(self.payload, str):
+            payloadBytes = self.payload.encode('utf-8')
+            if len(payloadBytes) <= maxBytes:
+                return self.payload
+            return payloadBytes[:maxBytes].decode('utf-8', errors='ignore') + '... (' + str(len(payloadBytes) - maxBytes) + ' more bytes not logged)'
+        if len(self.payload) <= maxBytes:
+            return str(self.payload)
+        return str(self.payload[:maxBytes]) + '... (' + str(len(self.payload) - maxBytes) + ' more bytes not logged)'
+
+    def __str__(self):
+        return self.truncated(self.defaultMaxBytes)
+
+
+#
+# Formatter that writes the LogPayloads of a record up to its own maxPayloadBytes
+#
+class PayloadFormatter(logging.Formatter):
+
+    def __init__(self, logFormat, dateFormat=None, maxPayloadBytes=LogPayload.defaultMaxBytes):
+        super().__init__(logFormat, dateFormat)
+        self.maxPayloadBytes = maxPayloadBytes
+
+    def format(self, record):
+        if isinstance(record.args, tuple) and any(isinstance(currArg, LogPayload) for currArg in record.args):
+            # A copy, the record goes to the other handlers as it is
+            record = logging.makeLogRecord(record.__dict__)
+            record.args = tuple(currArg.truncated(self.maxPayloadBytes) if isinstance(currArg, LogPayload) else currArg for currArg in record.args)
+        return super().format(record)
+
+
+#
+# Queue handler that leaves formatting to the listener thread
+#
+# The standard QueueHandler formats the message on the calling thread before it is
+# queued, the records here stay in this process so can be queued as they are.
+# logging.handlers brings in socket, struct and queue so is only imported when
+# queue logging or log rotation is asked for.
+#
+def deferredQueueHandler(logQueue):
+    import logging.handlers
+
+    class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+        def prepare(self, record):
+            return record
+
+    return DeferredQueueHandler(logQueue)
+
+
 #
 # Enable logging
 #
-def enableLogging(consoleLogLevelRaw, fileLogLevelRaw, logFilename):
+# queueLogging    = Log records are put on a queue and written by a background
+#                   thread, so the calling thread does not wait on the console or
+#                   the log file. The queue is emptied at exit
+# maxLogBytes     = If set the log file is rotated once it reaches this size,
+#                   keeping logBackups old files
+# maxPayloadBytes = Max bytes of a LogPayload to write, None for all of it
+#
+def enableLogging(consoleLogLevelRaw, fileLogLevelRaw, logFilename, queueLogging=False, maxLogBytes=0, logBackups=5, maxPayloadBytes=4096):
 
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
 
     # Misc
     consoleLogLevel = consoleLogLevelRaw.upper().strip()
@@ -106,11 +2041,15 @@ def enableLogging(consoleLogLevelRaw, fileLogLevelRaw, logFilename):
 
     # Enable logging handlers
     consoleLogHandler = logging.StreamHandler()
-    fileLogHandler = logging.FileHandler(logFilename, mode='a', encoding=None, delay=False, errors=None)
+    if maxLogBytes:
+        from logging.handlers import RotatingFileHandler
+        fileLogHandler = RotatingFileHandler(logFilename, mode='a', maxBytes=maxLogBytes, backupCount=logBackups, encoding=None, delay=False, errors=None)
+    else:
+        fileLogHandler = logging.FileHandler(logFilename, mode='a', encoding=None, delay=False, errors=None)
 
     # Log formatters
-    consoleLogHandler.setFormatter(logging.Formatter('%(message)s'))
-    fileLogHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%Y/%m/%d %H:%M:%S'))
+    consoleLogHandler.setFormatter(PayloadFormatter('%(message)s', maxPayloadBytes=maxPayloadBytes))
+    fileLogHandler.setFormatter(PayloadFormatter('%(asctime)s %(levelname)s %(message)s', '%Y/%m/%d %H:%M:%S', maxPayloadBytes))
     
     # Set logging levels
     if consoleLogLevel in validLogLevels:
@@ -128,8 +2067,21 @@ def enableLogging(consoleLogLevelRaw, fileLogLevelRaw, logFilename):
         print('#', flush=True)
         exit(1)
 
+    # Records below both handler levels are dropped before they are created
+    logger.setLevel(min(consoleLogHandler.level, fileLogHandler.level))
+
     # Add handlers to logger
-    logger.addHandler(consoleLogHandler)
-    logger.addHandler(fileLogHandler)
+    if queueLogging:
+        import atexit
+        import queue
+        from logging.handlers import QueueListener
+        logQueue = queue.SimpleQueue()
+        logListener = QueueListener(logQueue, consoleLogHandler, fileLogHandler, respect_handler_level=True)
+        logListener.start()
+        atexit.register(logListener.stop)
+        logger.addHandler(deferredQueueHandler(logQueue))
+    else:
+        logger.addHandler(consoleLogHandler)
+        logger.addHandler(fileLogHandler)
 
-    return logger
\ No newline at end of file
+    return logger
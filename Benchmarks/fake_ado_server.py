@@ -0,0 +1,426 @@
+#
+# Fake Azure DevOps server
+# ========================
+#
+# A local stand in for the vsrm.dev.azure.com and dev.azure.com endpoints used by
+# healthCheck.py, processCodeDeployApproval.py and export_ado_process.py, serving
+# synthetic releases and processes so the scripts can be benchmarked without Azure.
+#
+# The release management apis are served under '/vsrm/<org>/' and the organization
+# apis under '/<org>/' (the projects list is also under '/vsrm/<org>/'), so for an
+# org of 'zoyinc' use:
+#
+#     SYSTEM_TEAMFOUNDATIONSERVERURI = http://127.0.0.1:<port>/vsrm/zoyinc/
+#     export_ado_process.py -orgurl    http://127.0.0.1:<port>/zoyinc/
+#
+# Faults can be injected:
+#
+#     latencyMs       = Added to every request
+#     conflictPuts    = Number of release PUTs to reject with 'old copy of release'
+#     throttleEvery   = Every n'th request gets a 429 with a Retry-After
+#
+# Lists are returned pageSize items at a time, with an x-ms-continuationtoken header
+# while there are more, when pageSize is not 0. The release list takes a
+# releaseIdFilter, as Azure DevOps does.
+#
+# PUTs of a release whose 'modifiedOn' is not the current one are also rejected with
+# 'old copy of release', the same as Azure DevOps.
+#
+# Can be run on its own:
+#
+#     python fake_ado_server.py -port 8080 -stages 20
+#
+
+import argparse
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+oldCopyOfReleaseMsg = 'VS402946: You are using an old copy of release. Refresh your copy and try again.'
+
+#
+# Shape of the synthetic data
+#
+defaultShape = {'projects': 2,
+                'releases': 20,
+                'definitions': 5,
+                'stages': 5,
+                'phases': 2,
+                'tasks': 4,
+                'deploySteps': 3,
+                'interventions': 1,
+                'historyBytes': 2000,
+                'processes': 3,
+                'wits': 8,
+                'witItems': 20,
+                'pageSize': 0}
+shapeHelps = {'pageSize': 'Items in each page of a list, 0 to return lists in one page'}
+
+interventionName = 'Code Deployment Approval'
+
+
+def stageName(stageIndex):
+    return 'STAGE' + str(stageIndex + 1).zfill(2)
+
+
+def deploymentIdOf(releaseId, stageIndex, deployStepIndex):
+    return (releaseId * 10000) + (stageIndex * 100) + deployStepIndex + 1
+
+
+#
+# Hyphenated stage name, as the approval script expects in the comments
+#
+def hyphenatedName(nameStr):
+    return '-'.join(nameStr.upper())
+
+
+#
+# Build a synthetic release, or release definition
+#
+# Every stage has phases with a condition and tasks, some with 'instructions',
+# using the stage's global variables. The last stage uses one from the stage before
+# it so healthCheck.py has something to report. Each deploy step carries
+# historyBytes of log text to stand in for the deploy history of a real release.
+#
+def buildRelease(releaseId, releaseShape, isDefinition=False):
+    environments = []
+    for stageIndex in range(releaseShape['stages']):
+        currStageName = stageName(stageIndex)
+        varStageName = currStageName
+        if (stageIndex == releaseShape['stages'] - 1) and (stageIndex > 0):
+            varStageName = stageName(stageIndex - 1)
+
+        phases = []
+        for phaseIndex in range(releaseShape['phases']):
+            workflowTasks = []
+            for taskIndex in range(releaseShape['tasks']):
+                taskInputs = {'script': 'echo task ' + str(taskIndex)}
+                if taskIndex == 0:
+                    taskInputs['instructions'] = 'Approve using $(GLOBALVAR_' + varStageName + '_MIMSG2) please'
+                workflowTasks.append({'name': 'Task ' + str(taskIndex + 1), 'taskId': 'task-' + str(taskIndex), 'enabled': True, 'inputs': taskInputs})
+            phases.append({'name': 'Phase ' + str(phaseIndex + 1),
+                           'rank': phaseIndex + 1,
+                           'deploymentInput': {'condition': 'eq(variables[\'GLOBALVAR_' + currStageName + '_DEPLOYAPPROVALOK\'], \'TRUE\')'},
+                           'workflowTasks': workflowTasks})
+
+        deploySteps = []
+        for deployStepIndex in range(releaseShape['deploySteps']):
+            releaseDeployPhases = []
+            for phaseIndex in range(releaseShape['phases']):
+                manualInterventions = []
+                for interventionIndex in range(releaseShape['interventions']):
+                    manualInterventions.append({'id': interventionIndex + 1,
+                                                'name': interventionName if interventionIndex == 0 else interventionName + ' ' + str(interventionIndex + 1),
+                                                'comments': 'Approved for ' + hyphenatedName(currStageName)})
+                releaseDeployPhases.append({'phaseId': str(deploymentIdOf(releaseId, stageIndex, deployStepIndex)) + '-' + str(phaseIndex + 1),
+                                            'name': 'Phase ' + str(phaseIndex + 1),
+                                            'manualInterventions': manualInterventions,
+                                            'deploymentJobs': [{'tasks': [{'name': 'Task', 'logUrl': 'x' * releaseShape['historyBytes']}]}]})
+            deploySteps.append({'deploymentId': deploymentIdOf(releaseId, stageIndex, deployStepIndex),
+                                'attempt': deployStepIndex + 1,
+                                'releaseDeployPhases': releaseDeployPhases})
+
+        currStage = {'id': stageIndex + 1, 'name': currStageName, 'variables': {}}
+        if isDefinition:
+            currStage['deployPhases'] = phases
+        else:
+            currStage['deployPhasesSnapshot'] = phases
+            currStage['deploySteps'] = deploySteps
+        environments.append(currStage)
+
+    return {'id': releaseId,
+            'name': ('Definition-' if isDefinition else 'Release-') + str(releaseId),
+            'modifiedOn': datetime.now(timezone.utc).isoformat(),
+            'environments': environments,
+            'variables': {}}
+
+
+#
+# Synthetic processes, work item types and their parts
+#
+def processList(releaseShape):
+    return [{'typeId': 'process-' + str(processIndex), 'name': 'Process ' + str(processIndex), 'referenceName': 'Custom.Process' + str(processIndex), 'customizationType': 'inherited'}
+            for processIndex in range(releaseShape['processes'])]
+
+
+def witList(processId, releaseShape):
+    return [{'referenceName': processId + '.Wit' + str(witIndex), 'name': 'Work Item Type ' + str(witIndex), 'customization': 'inherited'}
+            for witIndex in range(releaseShape['wits'])]
+
+
+def witSubList(witRefName, witSubName, releaseShape):
+    if witSubName == 'layout':
+        return {'pages': [{'id': 'page-' + str(pageIndex), 'label': 'Page ' + str(pageIndex), 'sections': [{'id': 'section-1', 'groups': []}]} for pageIndex in range(3)]}
+    if witSubName == 'behaviors':
+        return {'count': 1, 'value': [{'behavior': {'id': 'System.RequirementBacklogBehavior'}, 'isDefault': True}]}
+    witSubKey = {'fields': 'referenceName', 'states': 'name', 'rules': 'id'}[witSubName]
+    return {'count': releaseShape['witItems'],
+            'value': [{witSubKey: witRefName + '.' + witSubName + '.' + str(itemIndex), 'description': 'Synthetic ' + witSubName} for itemIndex in range(releaseShape['witItems'])]}
+
+
+#
+# Request handler
+#
+class FakeAdoHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def sendJson(self, statusCode, jsonValue, extraHeaders=None):
+        self.sendBody(statusCode, json.dumps(jsonValue).encode(), extraHeaders)
+
+    #
+    # Send a list, a page at a time if the shape has a pageSize, the continuation
+    # token is the index of the first item of the next page
+    #
+    def sendList(self, listItems):
+        pageSize = self.server.releaseShape['pageSize']
+        if not pageSize:
+            self.sendJson(200, {'count': len(listItems), 'value': listItems})
+            return
+        queryParams = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        pageStart = int(queryParams.get('continuationToken', ['0'])[0])
+        pageItems = listItems[pageStart:pageStart + pageSize]
+        extraHeaders = {}
+        if pageStart + pageSize < len(listItems):
+            extraHeaders['x-ms-continuationtoken'] = str(pageStart + pageSize)
+        self.sendJson(200, {'count': len(pageItems), 'value': pageItems}, extraHeaders)
+
+    def sendBody(self, statusCode, responseBody, extraHeaders=None):
+        self.send_response(statusCode)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(responseBody)))
+        for headerName, headerValue in (extraHeaders or {}).items():
+            self.send_header(headerName, headerValue)
+        self.end_headers()
+        # Counted before it is sent, so the stats include it once the client has it
+        self.server.countRequest(self.command, self.path, len(responseBody), 0)
+        self.wfile.write(responseBody)
+
+    #
+    # Latency and throttling common to all requests, returns True if the request was
+    # throttled and has been answered
+    #
+    def injectFaults(self):
+        if self.server.latencyMs:
+            time.sleep(self.server.latencyMs / 1000.0)
+        if self.server.shouldThrottle():
+            self.sendJson(429, {'message': 'Request was blocked due to exceeding usage of resource.'}, {'Retry-After': '1', 'X-RateLimit-Resource': 'Core'})
+            return True
+        return False
+
+    def do_GET(self):
+        if self.injectFaults():
+            return
+        requestPath = self.path.split('?')[0]
+        releaseShape = self.server.releaseShape
+
+        # Release management apis
+        releaseMatch = re.match(r'^/vsrm/[^/]+/([^/]+)/_apis/release/(releases|definitions)(?:/(\d+))?$', requestPath)
+        if releaseMatch:
+            projectName, itemType, itemId = releaseMatch.groups()
+            if itemId is None:
+                itemCount = releaseShape['releases'] if itemType == 'releases' else releaseShape['definitions']
+                if itemType == 'releases':
+                    releaseIds = range(1, itemCount + 1)
+                    idFilter = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('releaseIdFilter')
+                    if idFilter:
+                        releaseIds = [int(currId) for currId in idFilter[0].split(',') if currId.strip().isdigit() and (0 < int(currId) <= itemCount)]
+                    self.sendList([{'id': currId, 'name': itemType + '-' + str(currId), 'modifiedOn': self.server.releaseModifiedOn(currId)} for currId in releaseIds])
+                else:
+                    self.sendList([{'id': currId, 'name': itemType + '-' + str(currId)} for currId in range(1, itemCount + 1)])
+            elif itemType == 'definitions':
+                self.sendBody(200, self.server.definitionBody(int(itemId)))
+            else:
+                self.sendBody(200, self.server.releaseBody(int(itemId)))
+            return
+
+        # Organization apis
+        if re.match(r'^(?:/vsrm)?/[^/]+/_apis/projects$', requestPath):
+            self.sendList([{'id': 'project-' + str(projectIndex), 'name': 'Project' + str(projectIndex)} for projectIndex in range(releaseShape['projects'])])
+            return
+        projectMatch = re.match(r'^/[^/]+/_apis/projects/project-(\d+)$', requestPath)
+        if projectMatch and (int(projectMatch.group(1)) < releaseShape['projects']):
+            projectIndex = int(projectMatch.group(1))
+            processIndex = projectIndex % max(1, releaseShape['processes'])
+            self.sendJson(200, {'id': 'project-' + str(projectIndex),
+                                'name': 'Project' + str(projectIndex),
+                                'capabilities': {'processTemplate': {'templateName': 'Process ' + str(processIndex), 'templateTypeId': 'process-' + str(processIndex)}}})
+            return
+        if re.match(r'^/[^/]+/_apis/work/processes$', requestPath):
+            self.sendList(processList(releaseShape))
+            return
+        processMatch = re.match(r'^/[^/]+/_apis/work/processes/([^/]+)/(workitemtypes|behaviors)$', requestPath)
+        if processMatch:
+            processId, processSubName = processMatch.groups()
+            if processSubName == 'behaviors':
+                self.sendJson(200, {'count': 1, 'value': [{'referenceName': 'System.PortfolioBacklogBehavior', 'name': 'Portfolio'}]})
+            else:
+                self.sendList(witList(processId, releaseShape))
+            return
+        witMatch = re.match(r'^/[^/]+/_apis/work/processes/[^/]+/(?:workitemtypes|workitemtypesbehaviors)/([^/]+)/(fields|states|rules|layout|behaviors)$', requestPath)
+        if witMatch:
+            self.sendJson(200, witSubList(witMatch.group(1), witMatch.group(2), releaseShape))
+            return
+
+        self.sendJson(404, {'message': 'Not found: ' + requestPath})
+
+    def do_PUT(self):
+        requestBody = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.countRequest(self.command, self.path, 0, len(requestBody))
+        if self.injectFaults():
+            return
+        releaseMatch = re.match(r'^/vsrm/[^/]+/[^/]+/_apis/release/releases/(\d+)$', self.path.split('?')[0])
+        if not releaseMatch:
+            self.sendJson(404, {'message': 'Not found'})
+            return
+        try:
+            putRelease = json.loads(requestBody)
+        except ValueError:
+            self.sendJson(400, {'message': 'Invalid JSON'})
+            return
+        isUpdated, responseBody = self.server.updateRelease(int(releaseMatch.group(1)), putRelease)
+        if isUpdated:
+            self.sendBody(200, responseBody)
+        else:
+            self.sendJson(400, {'message': oldCopyOfReleaseMsg})
+
+
+#
+# Fake Azure DevOps server
+#
+# Runs in a background thread, counts the requests made and bytes transferred.
+#
+class FakeAdoServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, releaseShape=None, latencyMs=0, conflictPuts=0, throttleEvery=0, serverPort=0):
+        super().__init__(('127.0.0.1', serverPort), FakeAdoHandler)
+        self.releaseShape = dict(defaultShape, **(releaseShape or {}))
+        self.latencyMs = latencyMs
+        self.conflictPuts = conflictPuts
+        self.throttleEvery = throttleEvery
+        self.serverLock = threading.Lock()
+        self.releases = {}
+        self.definitionBodies = {}
+        self.serverThread = None
+        self.resetStats()
+
+    @property
+    def baseURL(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + '/'
+
+    def resetStats(self):
+        with self.serverLock:
+            self.requestCount = 0
+            self.stats = {'requests': 0, 'bytesSent': 0, 'bytesReceived': 0, 'byMethod': {}, 'conflicts': 0, 'throttled': 0}
+
+    def statsSnapshot(self):
+        with self.serverLock:
+            return json.loads(json.dumps(self.stats))
+
+    def countRequest(self, requestMethod, requestPath, bytesSent, bytesReceived):
+        with self.serverLock:
+            if bytesSent:
+                self.stats['requests'] += 1
+                self.stats['byMethod'][requestMethod] = self.stats['byMethod'].get(requestMethod, 0) + 1
+            self.stats['bytesSent'] += bytesSent
+            self.stats['bytesReceived'] += bytesReceived
+
+    def shouldThrottle(self):
+        with self.serverLock:
+            self.requestCount += 1
+            if self.throttleEvery and (self.requestCount % self.throttleEvery == 0):
+                self.stats['throttled'] += 1
+                return True
+        return False
+
+    def releaseModifiedOn(self, releaseId):
+        self.releaseBody(releaseId)
+        with self.serverLock:
+            return self.releases[releaseId][0]
+
+    #
+    # Releases are built on first use and kept, encoded, so PUTs change them
+    #
+    def releaseBody(self, releaseId):
+        with self.serverLock:
+            if releaseId not in self.releases:
+                currRelease = buildRelease(releaseId, self.releaseShape)
+                self.releases[releaseId] = (currRelease['modifiedOn'], json.dumps(currRelease).encode())
+            return self.releases[releaseId][1]
+
+    def definitionBody(self, definitionId):
+        with self.serverLock:
+            if definitionId not in self.definitionBodies:
+                self.definitionBodies[definitionId] = json.dumps(buildRelease(definitionId, self.releaseShape, isDefinition=True)).encode()
+            return self.definitionBodies[definitionId]
+
+    def updateRelease(self, releaseId, putRelease):
+        self.releaseBody(releaseId)
+        with self.serverLock:
+            currModifiedOn = self.releases[releaseId][0]
+            if (self.conflictPuts > 0) or (putRelease.get('modifiedOn') != currModifiedOn):
+                self.conflictPuts = max(0, self.conflictPuts - 1)
+                self.stats['conflicts'] += 1
+                # Someone else has changed the release
+                putRelease = json.loads(self.releases[releaseId][1])
+                putRelease['modifiedOn'] = datetime.now(timezone.utc).isoformat()
+                self.releases[releaseId] = (putRelease['modifiedOn'], json.dumps(putRelease).encode())
+                return False, None
+            putRelease['modifiedOn'] = datetime.now(timezone.utc).isoformat()
+            responseBody = json.dumps(putRelease).encode()
+            self.releases[releaseId] = (putRelease['modifiedOn'], responseBody)
+            return True, responseBody
+
+    def releaseVariables(self, releaseId):
+        with self.serverLock:
+            return json.loads(self.releases[releaseId][1])['variables']
+
+    def start(self):
+        self.serverThread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.serverThread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+#
+# Shape arguments, shared with the benchmark runner
+#
+def addShapeArguments(parser):
+    for shapeName, shapeDefault in defaultShape.items():
+        shapeHelp = shapeHelps.get(shapeName, 'Synthetic data: number of ' + shapeName)
+        parser.add_argument('-' + shapeName.lower(), dest=shapeName, type=int, default=shapeDefault, help=shapeHelp + ' (default ' + str(shapeDefault) + ')')
+    parser.add_argument('-latency', type=float, default=0, help='Milliseconds of latency added to each request')
+    parser.add_argument('-conflicts', type=int, default=0, help='Number of release PUTs to reject with \'old copy of release\'')
+    parser.add_argument('-throttleevery', type=int, default=0, help='Send a 429 for every n\'th request')
+
+
+def shapeFromArgs(args):
+    return {shapeName: getattr(args, shapeName) for shapeName in defaultShape}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-port', type=int, default=8080)
+    addShapeArguments(parser)
+    args = parser.parse_args()
+    fakeServer = FakeAdoServer(shapeFromArgs(args), args.latency, args.conflicts, args.throttleevery, args.port)
+    print('Fake Azure DevOps server on ' + fakeServer.baseURL)
+    print('  SYSTEM_TEAMFOUNDATIONSERVERURI = ' + fakeServer.baseURL + 'vsrm/zoyinc/')
+    print('  export_ado_process.py -orgurl    ' + fakeServer.baseURL + 'zoyinc/')
+    try:
+        fakeServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
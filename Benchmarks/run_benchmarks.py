@@ -0,0 +1,289 @@
+#
+# Benchmarks
+# ==========
+#
+# Runs healthCheck.py, processCodeDeployApproval.py and export_ado_process.py against
+# the fake Azure DevOps server, with synthetic releases of a given shape, and
+# reports for each:
+#
+#     Wall time, import time, request count, bytes transferred and peak RSS of the
+#     script
+#
+# Each script is run in its own process, the way a pipeline task runs it, so the
+# times include the Python start up. To catch performance regressions save a run
+# with '-json' and compare later runs to it with '-baseline', the run fails if a
+# scenario is slower, uses more memory, or makes more requests than the baseline
+# allows.
+#
+# Scripts are run with '-X importtime' and the import time is the total of the
+# modules the script imported, including those it imports later on, such as
+# requests when its first AdoClient is created. Where no .pyc files can be written
+# the import time includes compiling the modules.
+#
+# The fanout scenarios run '-fanout' copies of the script at the same time, as the
+# tasks of stages running in parallel on one agent do, sharing a release cache.
+#
+# Examples:
+#
+#     python run_benchmarks.py
+#     python run_benchmarks.py -stages 50 -deploysteps 40 -latency 20 -json baseline.json
+#     python run_benchmarks.py -stages 50 -deploysteps 40 -latency 20 -baseline baseline.json
+#
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_ado_server
+
+benchmarksDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchmarksDir)
+persistingDir = os.path.join(repoDir, 'Persisting Azure Pipeline Variables')
+processToolsDir = os.path.join(repoDir, 'ADO Process Tools')
+adoOrg = 'zoyinc'
+benchmarkToken = 'benchmark-token'
+
+allScenarios = ['healthcheck', 'healthcheck-scan', 'healthcheck-fanout', 'approval', 'approval-urllib', 'export']
+
+
+#
+# Command line and environment for a scenario
+#
+def scenarioCommand(scenarioName, fakeServer, args, workDir):
+    vsrmURL = fakeServer.baseURL + 'vsrm/' + adoOrg + '/'
+    lastStage = fake_ado_server.stageName(fakeServer.releaseShape['stages'] - 1)
+    scenarioEnv = dict(os.environ,
+                       RELEASE_RELEASEID='1',
+                       SYSTEM_TEAMPROJECT='Project0',
+                       SYSTEM_TEAMFOUNDATIONSERVERURI=vsrmURL,
+                       RELEASE_ENVIRONMENTNAME=lastStage,
+                       RELEASE_DEPLOYMENTID=str(fake_ado_server.deploymentIdOf(1, fakeServer.releaseShape['stages'] - 1, fakeServer.releaseShape['deploySteps'] - 1)))
+
+    if scenarioName == 'healthcheck':
+        scriptArgs = [os.path.join(persistingDir, 'healthCheck.py'), '-azuretoken', benchmarkToken]
+    elif scenarioName == 'healthcheck-scan':
+        scriptArgs = [os.path.join(persistingDir, 'healthCheck.py'), '-azuretoken', benchmarkToken, '-scan', 'releases', '-workers', str(args.workers)]
+    elif scenarioName == 'healthcheck-fanout':
+        scriptArgs = [os.path.join(persistingDir, 'healthCheck.py'), '-azuretoken', benchmarkToken, '-releasecachedir', os.path.join(workDir, 'releasecache')]
+    elif scenarioName == 'approval':
+        scriptArgs = [os.path.join(persistingDir, 'processCodeDeployApproval.py'), '-azuretoken', benchmarkToken, '-interventionName', fake_ado_server.interventionName]
+    elif scenarioName == 'approval-urllib':
+        scriptArgs = [os.path.join(persistingDir, 'processCodeDeployApproval.py'), '-azuretoken', benchmarkToken, '-interventionName', fake_ado_server.interventionName,
+                      '-transport', 'urllib']
+    else:
+        scriptArgs = [os.path.join(processToolsDir, 'export_ado_process.py'), '-azuretoken', benchmarkToken, '-deep',
+                      '-orgurl', fakeServer.baseURL + adoOrg + '/', '-proxy', 'none', '-logfile', os.path.join(workDir, 'export.log'),
+                      '-workers', str(args.workers)]
+    return [sys.executable, '-X', 'importtime'] + scriptArgs, scenarioEnv
+
+
+#
+# Split the script's stderr into the '-X importtime' lines and the rest, returns
+# (import seconds, other lines)
+#
+# Each line is 'import time: <self us> | <cumulative us> | <module>', with the module
+# indented by how deeply it was nested, so the total is the cumulative times of the
+# modules that are not indented. site is left out as it is imported by Python
+# before the script starts.
+#
+def splitImportTimes(stderrLines):
+    importMicroseconds = 0
+    otherLines = []
+    for currLine in stderrLines:
+        if not currLine.startswith('import time:'):
+            otherLines.append(currLine)
+            continue
+        timeFields = currLine.split('|')
+        if len(timeFields) != 3:
+            continue
+        moduleName = timeFields[2].rstrip('\n')
+        if moduleName.startswith('  ') or (moduleName.strip() == 'site'):
+            continue
+        try:
+            importMicroseconds += int(timeFields[1])
+        except ValueError:
+            # The heading line
+            pass
+    return importMicroseconds / 1000000.0, otherLines
+
+
+#
+# Worst of some exit codes, any failure is worse than success and a signal, which is
+# negative, counts by its number
+#
+def worstExitCode(exitCodes):
+    return max(exitCodes, key=abs)
+
+
+#
+# Run processCount copies of a script at the same time, as the tasks of stages that
+# run in parallel do, returns (exit code, wall seconds, import seconds, peak RSS in
+# MB)
+#
+# The exit code is the worst of them, the wall time until the last one finished,
+# and the import time and peak RSS the most of any one of them. Peak RSS comes from
+# wait4() so is only available where the OS has it.
+#
+def runScript(scriptCommand, scriptEnv, workDir, processCount=1):
+    with open(os.path.join(workDir, 'output.txt'), 'w') as outputFile:
+        scriptProcesses = []
+        startTime = time.perf_counter()
+        for processIndex in range(processCount):
+            stderrFile = open(os.path.join(workDir, 'stderr' + str(processIndex) + '.txt'), 'w+')
+            scriptProcesses.append((subprocess.Popen(scriptCommand, env=scriptEnv, cwd=workDir, stdout=outputFile, stderr=stderrFile), stderrFile))
+
+        exitCode = 0
+        importSeconds = 0.0
+        peakRSS = None
+        for scriptProcess, stderrFile in scriptProcesses:
+            if hasattr(os, 'wait4'):
+                waitPid, waitStatus, scriptUsage = os.wait4(scriptProcess.pid, 0)
+                scriptProcess.returncode = os.waitstatus_to_exitcode(waitStatus)
+                processRSS = scriptUsage.ru_maxrss / 1024.0
+                if sys.platform == 'darwin':
+                    processRSS = processRSS / 1024.0
+                peakRSS = max(peakRSS or 0.0, processRSS)
+            else:
+                scriptProcess.wait()
+            exitCode = worstExitCode([exitCode, scriptProcess.returncode])
+        wallTime = time.perf_counter() - startTime
+
+        # The rest of stderr goes after the output, as the times are not kept
+        for scriptProcess, stderrFile in scriptProcesses:
+            with stderrFile:
+                stderrFile.seek(0)
+                processImportSeconds, stderrLines = splitImportTimes(stderrFile.readlines())
+            importSeconds = max(importSeconds, processImportSeconds)
+            outputFile.writelines(stderrLines)
+    return exitCode, wallTime, importSeconds, peakRSS
+
+
+#
+# Run a scenario args.repeat times against a fresh server, keeping the worst exit
+# code, the median wall and import times and the largest peak RSS
+#
+def runScenario(scenarioName, args):
+    exitCodes = []
+    wallTimes = []
+    importTimes = []
+    peakRSSs = []
+    for repeatIndex in range(args.repeat):
+        fakeServer = fake_ado_server.FakeAdoServer(fake_ado_server.shapeFromArgs(args), args.latency, args.conflicts, args.throttleevery).start()
+        try:
+            with tempfile.TemporaryDirectory() as workDir:
+                scriptCommand, scriptEnv = scenarioCommand(scenarioName, fakeServer, args, workDir)
+                processCount = args.fanout if scenarioName.endswith('-fanout') else 1
+                exitCode, wallTime, importSeconds, peakRSS = runScript(scriptCommand, scriptEnv, workDir, processCount)
+                if args.verbose:
+                    with open(os.path.join(workDir, 'output.txt'), 'r') as outputFile:
+                        print(outputFile.read())
+            serverStats = fakeServer.statsSnapshot()
+        finally:
+            fakeServer.stop()
+        exitCodes.append(exitCode)
+        wallTimes.append(wallTime)
+        importTimes.append(importSeconds)
+        if peakRSS is not None:
+            peakRSSs.append(peakRSS)
+
+    return {'scenario': scenarioName,
+            'exitCode': worstExitCode(exitCodes),
+            'wallSeconds': statistics.median(wallTimes),
+            'importSeconds': statistics.median(importTimes),
+            'requests': serverStats['requests'],
+            'bytesSent': serverStats['bytesSent'],
+            'bytesReceived': serverStats['bytesReceived'],
+            'conflicts': serverStats['conflicts'],
+            'throttled': serverStats['throttled'],
+            'peakRSSMB': max(peakRSSs) if peakRSSs else None}
+
+
+#
+# Compare results to a baseline, returns a list of regressions
+#
+# A scenario that fails where the baseline did not is a regression, whatever its
+# times, as a script that stops early is quick and makes few requests.
+#
+def compareToBaseline(benchmarkResults, baselineResults, tolerance):
+    regressions = []
+    baselineByScenario = {currResult['scenario']: currResult for currResult in baselineResults['results']}
+    for currResult in benchmarkResults:
+        baselineResult = baselineByScenario.get(currResult['scenario'])
+        if baselineResult is None:
+            continue
+        if (currResult['exitCode'] != 0) and (baselineResult.get('exitCode', 0) == 0):
+            regressions.append(currResult['scenario'] + ': exit code ' + str(currResult['exitCode']) + ' vs baseline 0')
+        for metricName in ['wallSeconds', 'importSeconds', 'peakRSSMB', 'bytesSent']:
+            if (currResult.get(metricName) is not None) and baselineResult.get(metricName):
+                if currResult[metricName] > baselineResult[metricName] * (1 + tolerance):
+                    regressions.append(currResult['scenario'] + ': ' + metricName + ' ' + '%.2f' % currResult[metricName] + ' vs baseline ' + '%.2f' % baselineResult[metricName])
+        if currResult['requests'] > baselineResult['requests']:
+            regressions.append(currResult['scenario'] + ': requests ' + str(currResult['requests']) + ' vs baseline ' + str(baselineResult['requests']))
+    return regressions
+
+
+def formatMB(byteCount):
+    return '%.2f' % (byteCount / (1024.0 * 1024.0))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-scenarios', default=','.join(allScenarios), help='Comma separated scenarios to run, from: ' + ', '.join(allScenarios))
+    parser.add_argument('-workers', type=int, default=8, help='Workers for the scan and export scenarios')
+    parser.add_argument('-fanout', type=int, default=4, help='Number of copies of the script run at the same time for the fanout scenarios')
+    parser.add_argument('-repeat', type=int, default=1, help='Number of times to run each scenario, the median wall time is reported')
+    parser.add_argument('-json', help='Write the results to this json file')
+    parser.add_argument('-baseline', help='Fail if the results are worse than this earlier \'-json\' file')
+    parser.add_argument('-tolerance', type=float, default=0.25, help='How much worse than the baseline wall time, memory and bytes can be, 0.25 = 25%%')
+    parser.add_argument('-verbose', action='store_true', help='Show the output of the scripts')
+    fake_ado_server.addShapeArguments(parser)
+    args = parser.parse_args()
+
+    selectedScenarios = [currScenario.strip() for currScenario in args.scenarios.split(',') if currScenario.strip()]
+    for currScenario in selectedScenarios:
+        if currScenario not in allScenarios:
+            print('Unknown scenario \'' + currScenario + '\', choose from: ' + ', '.join(allScenarios))
+            sys.exit(1)
+
+    print('#')
+    print('# Benchmarks')
+    print('# ==========')
+    print('# Shape:     ' + ', '.join(shapeName + '=' + str(shapeValue) for shapeName, shapeValue in fake_ado_server.shapeFromArgs(args).items()))
+    print('# Faults:    latency=' + str(args.latency) + 'ms, conflicts=' + str(args.conflicts) + ', throttleevery=' + str(args.throttleevery))
+    print('#')
+    print()
+    print('Scenario            Exit   Wall (s)   Import (s)   Requests   Sent (MB)   Received (MB)   Peak RSS (MB)')
+    print('------------------  ----   --------   ----------   --------   ---------   -------------   -------------')
+
+    benchmarkResults = []
+    for currScenario in selectedScenarios:
+        currResult = runScenario(currScenario, args)
+        benchmarkResults.append(currResult)
+        peakRSSStr = '%.1f' % currResult['peakRSSMB'] if currResult['peakRSSMB'] is not None else 'n/a'
+        print(currScenario.ljust(18) + '  ' + str(currResult['exitCode']).rjust(4) + '   ' + ('%.3f' % currResult['wallSeconds']).rjust(8) + '   ' +
+              ('%.3f' % currResult['importSeconds']).rjust(10) + '   ' +
+              str(currResult['requests']).rjust(8) + '   ' + formatMB(currResult['bytesSent']).rjust(9) + '   ' +
+              formatMB(currResult['bytesReceived']).rjust(13) + '   ' + peakRSSStr.rjust(13))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as jsonFile:
+            json.dump({'shape': fake_ado_server.shapeFromArgs(args), 'results': benchmarkResults}, jsonFile, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baselineFile:
+            baselineResults = json.load(baselineFile)
+        regressions = compareToBaseline(benchmarkResults, baselineResults, args.tolerance)
+        print()
+        if regressions:
+            print('##[error] Performance regressions against ' + args.baseline)
+            for currRegression in regressions:
+                print('  ' + currRegression)
+            sys.exit(1)
+        print('No regressions against ' + args.baseline)
@@ -0,0 +1,156 @@
+#
+# Global variable index
+# =====================
+#
+# Builds, and answers questions from, a SQLite index of where the GLOBALVAR_
+# pipeline variables are used and the values they have across releases, see
+# zoyinc_release_tools.GlobalVarIndex.
+#
+# Index, or bring up to date, every release in the organization:
+#
+#     python globalVarIndex.py -db globalvars.db -ingest -azuretoken <token> -org zoyinc
+#
+# Then query it, with no calls to Azure DevOps:
+#
+#     python globalVarIndex.py -db globalvars.db -refs GLOBALVAR_PRD_MIMSG2
+#     python globalVarIndex.py -db globalvars.db -values DEPLOYAPPROVALOK -equals FALSE
+#     python globalVarIndex.py -db globalvars.db -problems -stage PRD
+#     python globalVarIndex.py -db globalvars.db -sql "SELECT variableRef, COUNT(*) FROM globalVarRefs GROUP BY variableRef"
+#
+# Variables can be given in full, 'GLOBALVAR_PRD_MIMSG2', or by name, 'MIMSG2', and
+# '%' can be used as a wildcard.
+#
+
+import sys
+import argparse
+import json
+import os
+import time
+
+#
+# The shared Azure DevOps tooling lives with the ADO Process Tools
+#
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ADO Process Tools'))
+import zoyinc_std_tools
+import zoyinc_release_tools
+
+notFoundStr = 'NOT_FOUND'
+
+
+#
+# Print query results as a table, or json lines
+#
+def printRows(columnNames, resultRows, jsonOutput):
+    if jsonOutput:
+        for currRow in resultRows:
+            print(json.dumps(dict(zip(columnNames, currRow))))
+        return
+    rowStrs = [['' if currValue is None else str(currValue) for currValue in currRow] for currRow in resultRows]
+    columnWidths = [max([len(columnName)] + [len(currRow[columnIndex]) for currRow in rowStrs]) for columnIndex, columnName in enumerate(columnNames)]
+    print('  '.join(columnName.ljust(columnWidth) for columnName, columnWidth in zip(columnNames, columnWidths)).rstrip())
+    print('  '.join('-' * columnWidth for columnWidth in columnWidths))
+    for currRow in rowStrs:
+        print('  '.join(currValue.ljust(columnWidth) for currValue, columnWidth in zip(currRow, columnWidths)).rstrip())
+
+
+#
+# Build or query the index and return the exit code
+#
+def main(argv=None, environ=None):
+
+    if environ is None:
+        environ = os.environ
+    teamFoundationServerURL = environ.get('SYSTEM_TEAMFOUNDATIONSERVERURI', notFoundStr)
+
+    #
+    # Import arguments
+    #
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('-db', required=True, help='SQLite index file, created if it does not exist')
+    parser.add_argument('-ingest', action='store_true', help='Add new and modified releases to the index')
+    parser.add_argument('-azuretoken', help='Azure personal access token PAL, needed for -ingest')
+    parser.add_argument('-org', help='Organization to index, defaults to the one in SYSTEM_TEAMFOUNDATIONSERVERURI')
+    parser.add_argument('-project', action='append', help='Project to index, can be given more than once, if not given all projects in the organization are indexed')
+    parser.add_argument('-workers', type=int, default=8, help='Number of releases to fetch at the same time when indexing')
+    parser.add_argument('-batchsize', type=int, default=200, help='Number of releases written to the index in each transaction')
+    parser.add_argument('-active', action='store_true', help='Only index the active releases')
+    parser.add_argument('-reindex', action='store_true', help='Fetch every release again, not just new and modified ones')
+    parser.add_argument('-cachedir', help='Directory to cache Azure DevOps responses in between runs')
+    parser.add_argument('-telemetrydir', help='Write request and phase timings, as json and a Prometheus textfile, to this directory')
+    parser.add_argument('-recordarchive', help='Record the Azure DevOps responses to this archive file, adding to it if it exists')
+    parser.add_argument('-replayarchive', help='Answer every Azure DevOps request from this archive file, recorded with -recordarchive, with no network')
+    parser.add_argument('-refs', metavar='VARIABLE', help='List the releases, stages, phases and fields that reference this variable')
+    parser.add_argument('-values', metavar='VARIABLE', help='List the values this variable had in each release')
+    parser.add_argument('-equals', metavar='VALUE', help='With -values, only where the variable had this value')
+    parser.add_argument('-problems', action='store_true', help='List the references with the wrong stage name, can be used with -refs')
+    parser.add_argument('-stage', help='With -refs or -problems, only references in this stage')
+    parser.add_argument('-sql', help='Run this SQL query against the index')
+    parser.add_argument('-json', action='store_true', help='Print the query results as json lines rather than a table')
+    zoyinc_std_tools.addProfileArguments(parser)
+    args = parser.parse_args(argv)
+
+    isQuery = args.refs or args.values or args.problems or args.sql
+    if not (args.ingest or isQuery):
+        print('##[error]')
+        print('##[error] Nothing to do, give -ingest and/or a query, -refs, -values, -problems or -sql')
+        print('##[error]')
+        return 1
+
+    globalVarIndex = zoyinc_release_tools.GlobalVarIndex(args.db)
+    try:
+        exitCode = 0
+
+        #
+        # Ingest
+        #
+        if args.ingest:
+            if args.org:
+                teamFoundationServerURL = 'https://vsrm.dev.azure.com/' + args.org + '/'
+            if (not args.azuretoken) or (teamFoundationServerURL == notFoundStr):
+                print('##[error]')
+                print('##[error] -ingest needs -azuretoken, and -org or SYSTEM_TEAMFOUNDATIONSERVERURI')
+                print('##[error]')
+                return 1
+            if args.telemetrydir:
+                zoyinc_std_tools.enableTelemetry('globalVarIndex', args.telemetrydir)
+            responseCache = None
+            if args.cachedir:
+                responseCache = zoyinc_std_tools.AdoResponseCache(args.cachedir)
+            ingestWorkers = max(1, args.workers)
+            responseArchive = zoyinc_std_tools.openResponseArchive(args.recordarchive, args.replayarchive)
+            adoClient = zoyinc_std_tools.AdoClient(args.azuretoken, poolMaxSize=max(10, ingestWorkers), responseCache=responseCache, responseArchive=responseArchive)
+            try:
+                exitCode = zoyinc_release_tools.ingestGlobalVarIndex(adoClient, teamFoundationServerURL, args.project, globalVarIndex, ingestWorkers,
+                                                                     args.active, args.reindex, max(1, args.batchsize))
+            finally:
+                adoClient.close()
+
+        #
+        # Queries
+        #
+        queryStart = time.perf_counter()
+        queryResults = []
+        if args.refs or args.problems:
+            queryResults.append(globalVarIndex.findReferences(args.refs, args.stage, 'error' if args.problems else None))
+        if args.values:
+            queryResults.append(globalVarIndex.findValues(args.values, args.equals))
+        if args.sql:
+            queryResults.append(globalVarIndex.query(args.sql))
+        querySeconds = time.perf_counter() - queryStart
+
+        for columnNames, resultRows in queryResults:
+            if not args.json:
+                print()
+            printRows(columnNames, resultRows, args.json)
+        if queryResults and not args.json:
+            print()
+            print('# ' + str(sum(len(resultRows) for columnNames, resultRows in queryResults)) + ' rows in %.1fms' % (querySeconds * 1000))
+    finally:
+        globalVarIndex.close()
+
+    sys.stdout.flush()
+    return exitCode
+
+
+if __name__ == '__main__':
+    sys.exit(zoyinc_std_tools.runScript('globalVarIndex', main))
@@ -4,220 +4,187 @@
 #
 #
 
-import requests
-import json
-import copy
-import re
 import sys
 import argparse
 import os
 from datetime import datetime
 
-notFoundStr = 'NOT_FOUND'
-currRelease = os.environ.get('RELEASE_RELEASEID', notFoundStr)
-teamProjectName = os.environ.get('SYSTEM_TEAMPROJECT', notFoundStr)
-teamFoundationServerURL = os.environ.get('SYSTEM_TEAMFOUNDATIONSERVERURI', notFoundStr)
-
 #
-# Import arguments and environment properties etc
+# The shared Azure DevOps tooling lives with the ADO Process Tools
 #
-parser = argparse.ArgumentParser()
-parser.add_argument("-azuretoken", required=True, help="Azure personal access token PAL")
-parser.add_argument('-t', action='store_true')
-args = parser.parse_args()
-azureToken = args.azuretoken
-testMode = False
-if args.t:
-    testMode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ADO Process Tools'))
+import zoyinc_std_tools
+import zoyinc_release_tools
 
-#
-# If running in test mode set test values
-#
-if testMode:
-    currRelease = '67'
-    currStage = 'PRD'
-    teamProjectName = 'Examples'
-    teamFoundationServerURL = 'https://vsrm.dev.azure.com/zoyinc/'
-
-if ((currRelease == notFoundStr) or (teamProjectName == notFoundStr) or (teamFoundationServerURL == notFoundStr)):
-    print('##[error]')
-    print('##[error] Something went wrong, could not determine some or all environment variables')
-    print('##[error]')
-    print('currRelease:              ' + currRelease)
-    print('teamProjectName:          ' + teamProjectName)
-    print('teamFoundationServerURL:  ' + teamFoundationServerURL)
-    quit(1)
-
-azureReleaseURL = teamFoundationServerURL + teamProjectName + '/_apis/release/releases/' + currRelease + '?api-version=5.0'
+notFoundStr = 'NOT_FOUND'
 
-#
-# Summary
-#
-print('#')
-print('# Running Global Pipeline Variables Healthcheck')
-print('# =============================================')
-print('# Current release:             ' + currRelease)
-print('# Team project name:           ' + teamProjectName)
-print('# Team foundation server URL:  ' + teamFoundationServerURL)
-print('# Date:                ' + datetime.now().strftime('%d/%m/%y %H:%M'))
-print('#')
-print('# Release URL:         ' + azureReleaseURL)
-print('#')
-
-
-
-
-##azureReleaseURL = 'https://vsrm.dev.azure.com/zoyinc/Examples/_apis/release/releases/' + currRelease + '?api-version=5.0'
-
-print('Azure URL: ' + azureReleaseURL)
-azureResponse = requests.get(azureReleaseURL, auth=('', azureToken))
-if azureResponse.status_code != 200:
-    print('##[error]')
-    print('##[error] Could not connect to Azure')
-    print('##[error]')
-    print('URL:            ' + azureReleaseURL)
-    print('Status code:    ' + str(azureResponse.status_code))
-    print('Error received: ' + azureResponse.reason)
-    quit(1)
-    
-releaseDetailOriginal = json.loads(azureResponse.text)
 
 #
-# Now need to go through all tasks and look for ones that include 'instructions'
-#
-# For the instructions field there is the concept of 'variable expand support' which is where
-# you can put environment variables in the instructions using the standard format '$(MY_VAR)'
-#
-# For us we are going to have gobal environment variables and the names will be consistent:
+# Run the health check and return the exit code
 #
-#     $(GLOBALVAR_WELLINGTON_MIMSG2)
+# argv and environ default to the command line and the environment. adoClientFor,
+# if given, is called with the token to get the client to use, the worker daemon
+# passes its own so connections and cached responses are kept between checks.
 #
-# GLOBALVAR_  = Standard prefixes for all our global variables (This is our convention no Azure)
-# WELLINGTON  = The environment name, must be equal to the 'name' of the 'Stage' in the pipeline
-# _           = There is always an underscore after the environment name
-# MIMSG2      = The name of the variable, in this case it stands for Manual Intervention MeSsaGe 2
-#
-# First iterate over all stages
-#
-globalVarPatternStr = r'\$\(GLOBALVAR_.*\)'
-globalVarPatternStrConditions = r'\'GLOBALVAR_.*?\''
-problemsReport = ''
-varIndentStr = '    '
-for stageIndex, itemValue in enumerate(releaseDetailOriginal['environments']):
-    
-    currStageName = releaseDetailOriginal['environments'][stageIndex]['name']
-    basicStageName = re.sub(r'( |_|\(|\)|-)','', currStageName).upper()
-    #
-    # Second iterate over all the phases in the current stage
-    #
-    for deployPhaseIndex, phaseValue in enumerate(releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot']):
-        
-        currPhaseName = releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot'][deployPhaseIndex]['name']
-        #
-        # Now check the conditions on the phase to see if they include any
-        # global variables
-        #
-        currPhaseCondition = releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot'][deployPhaseIndex]['deploymentInput']['condition']
-        if re.search(globalVarPatternStrConditions, currPhaseCondition, re.IGNORECASE):
-            print()
-            print('Found global variable/s in phase conditions')
-            print(' - Current phase:       ' + currPhaseName)
-            print(' - Current stage name:  ' + currStageName)
-            print('   - variable format:   ' + basicStageName)  
-            print('   - Phase condition:   ' + currPhaseCondition)                  
-            print(' Variables:')
-            
-            envVarIter = re.finditer(globalVarPatternStrConditions, currPhaseCondition, re.IGNORECASE)
-            for currEnvVarStr in envVarIter:         
-                
-                # Need to check it matches the stage name
-                foundStageNameMatch = re.search(r'_(.*)_', currEnvVarStr.group(), re.IGNORECASE)
-                
-                if foundStageNameMatch:
-                    foundStageName = foundStageNameMatch.group(0)[1:-1]
-                    if foundStageName == basicStageName:
-                        print(varIndentStr + currEnvVarStr.group() + ' - OK')
-                    else:
-                        errMsg1 = currEnvVarStr.group() + ' - ERROR  with global variable in phase condition. Stage = \'' + currStageName + '\', phase  = \'' + currPhaseName + '\', and condition \'' + currPhaseCondition + '\''
-                        indentBlanks = ' ' * len(currEnvVarStr.group())
-                        errMsg2 = indentBlanks + '   The stage name used for the variable is \'' + foundStageName + '\', which is different from the expected stage name \'' + basicStageName + '\'.'
-                        print( varIndentStr + errMsg1)
-                        print( varIndentStr + errMsg2)
-                        problemsReport = problemsReport + errMsg1 + '\n' + errMsg2 + '\n'
-                else:
-                    errMsg = currEnvVarStr.group() + ' - ERROR no stage name found in the variable name.'
-                    print( varIndentStr + errMsg)
-                    problemsReport = problemsReport + errMsg + '\n'
-
-            print()
-        
-        
-        #
-        # Third iterate over all the tasks in the current phase
-        #
-        for deployTaskIndex, taskValue in enumerate(releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot'][deployPhaseIndex]['workflowTasks']):
-            
-            currTaskName = releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot'][deployPhaseIndex]['workflowTasks'][deployTaskIndex]['name']
-            
-            # If the 'instructions' field exists then examine it
-            currTaskInstructions = ''
-            if 'instructions' in releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot'][deployPhaseIndex]['workflowTasks'][deployTaskIndex]['inputs']:
-                currTaskInstructions = str(releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot'][deployPhaseIndex]['workflowTasks'][deployTaskIndex]['inputs']['instructions'])
-                currTaskName = str(releaseDetailOriginal['environments'][stageIndex]['deployPhasesSnapshot'][deployPhaseIndex]['workflowTasks'][deployTaskIndex]['name'])
-                if re.search(globalVarPatternStr, currTaskInstructions, re.IGNORECASE):
-                    print()
-                    print('Found global variable/s in instructions')
-                    print(' - Current phase:       ' + currPhaseName)
-                    print(' - Current stage name:  ' + currStageName)
-                    print('   - variable format:   ' + basicStageName)                    
-                    print(' Variables:')
-                    
-                    envVarIter = re.finditer(globalVarPatternStr, currTaskInstructions, re.IGNORECASE)
-                    for currEnvVarStr in envVarIter:            
-                        # Need to check it matches the stage name
-                        foundStageNameMatch = re.search(r'_(.*)_', currEnvVarStr.group(), re.IGNORECASE)
-                        
-                        if foundStageNameMatch:
-                            foundStageName = foundStageNameMatch.group(0)[1:-1]
-                            if foundStageName == basicStageName:
-                                print(varIndentStr + currEnvVarStr.group() + ' - OK')
-                            else:
-                                errMsg1 = currEnvVarStr.group() + ' - ERROR  with global variable in stage, \'' + currStageName + '\', in phase \'' + currPhaseName + '\', and task \'' + currTaskName + '\'.'
-                                indentBlanks = ' ' * len(currEnvVarStr.group())
-                                errMsg2 = indentBlanks + '   The stage name used for the variable is \'' + foundStageName + '\', which is different from the expected stage name \'' + basicStageName + '\'.'
-                                print( varIndentStr + errMsg1)
-                                print( varIndentStr + errMsg2)
-                                problemsReport = problemsReport + errMsg1 + '\n' + errMsg2 + '\n'
-                        else:
-                            errMsg = currEnvVarStr.group() + ' - ERROR no stage name found in the variable name.'
-                            print( varIndentStr + errMsg)
-                            problemsReport = problemsReport + errMsg + '\n'
-
-                    print()
-
-#
-# If errors print them out
-#
-if problemsReport != '':
-    print('##[error]')
-    print('##[error] Errors with the use of global pipeline variables were found')
-    print('##[error]')
-    print(problemsReport)
-    sys.stdout.flush()
-    quit(1)
-    
+def main(argv=None, environ=None, adoClientFor=None):
 
+    if environ is None:
+        environ = os.environ
+    currRelease = environ.get('RELEASE_RELEASEID', notFoundStr)
+    teamProjectName = environ.get('SYSTEM_TEAMPROJECT', notFoundStr)
+    teamFoundationServerURL = environ.get('SYSTEM_TEAMFOUNDATIONSERVERURI', notFoundStr)
 
+    #
+    # Import arguments and environment properties etc
+    #
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument("-azuretoken", required=True, help="Azure personal access token PAL")
+    parser.add_argument('-t', action='store_true')
+    parser.add_argument('-scan', choices=['releases', 'definitions'], help='Check every active release, or every release definition, rather than just the current release')
+    parser.add_argument('-org', help='Organization to scan, defaults to the one in SYSTEM_TEAMFOUNDATIONSERVERURI')
+    parser.add_argument('-project', help='Project to scan, if not given all projects in the organization are scanned')
+    parser.add_argument('-workers', type=int, default=8, help='Number of releases to fetch and check at the same time when scanning')
+    parser.add_argument('-cachedir', help='Directory to cache Azure DevOps responses in between runs')
+    parser.add_argument('-telemetrydir', help='Write request and phase timings, as json and a Prometheus textfile, to this directory')
+    parser.add_argument('-findingsfile', help='Write each global variable use found to this file as it is found')
+    parser.add_argument('-findingsformat', choices=zoyinc_release_tools.findingsFormats, help='Format of the findings file, defaults to sarif for a .sarif file and jsonl otherwise')
+    parser.add_argument('-noconsolereport', action='store_true', help='Only print a summary, not the full report, use with -findingsfile')
+    parser.add_argument('-checkfields', choices=zoyinc_release_tools.checkFieldsChoices, default='phases', help='Check only the phases of each stage, the default, or every field of the release')
+    parser.add_argument('-extrarules', nargs='+', choices=zoyinc_release_tools.optionalRuleNames, default=[], help='Also look for global variables used in these ways, as well as $(...) macros and in conditions')
+    parser.add_argument('-recordarchive', help='Record the Azure DevOps responses to this archive file, adding to it if it exists')
+    parser.add_argument('-replayarchive', help='Answer every Azure DevOps request from this archive file, recorded with -recordarchive, with no network')
+    parser.add_argument('-transport', choices=zoyinc_std_tools.adoTransports, default=zoyinc_std_tools.defaultAdoTransport(environ), help='Send the requests with the requests library or the standard library urllib, urllib starts quicker but does not keep connections open so is slower for -scan')
+    parser.add_argument('-releasecachedir', default=environ.get(zoyinc_release_tools.sharedReleaseCacheEnv), help='Directory of the release cache shared by the tasks on this host, so a release is fetched once when stages run at the same time, defaults to ' + zoyinc_release_tools.sharedReleaseCacheEnv + ', not used with -scan')
+    zoyinc_std_tools.addProfileArguments(parser)
+    args = parser.parse_args(argv)
+    consoleReport = not args.noconsolereport
+    ruleEngine = zoyinc_release_tools.ruleEngineFor(args.extrarules)
+    azureToken = args.azuretoken
+    testMode = False
+    if args.t:
+        testMode = True
+    scanMode = args.scan
+    scanWorkers = max(1, args.workers)
+    if adoClientFor is None:
+        if args.telemetrydir:
+            zoyinc_std_tools.enableTelemetry('healthCheck', args.telemetrydir)
+        responseCache = None
+        if args.cachedir:
+            responseCache = zoyinc_std_tools.AdoResponseCache(args.cachedir)
+        responseArchive = zoyinc_std_tools.openResponseArchive(args.recordarchive, args.replayarchive)
+        adoClient = zoyinc_std_tools.AdoClient(azureToken, poolMaxSize=max(10, scanWorkers), responseCache=responseCache, responseArchive=responseArchive, transport=args.transport)
+    else:
+        adoClient = adoClientFor(azureToken)
 
+    #
+    # If running in test mode set test values
+    #
+    if testMode:
+        currRelease = '67'
+        currStage = 'PRD'
+        teamProjectName = 'Examples'
+        teamFoundationServerURL = 'https://vsrm.dev.azure.com/zoyinc/'
 
+    #
+    # Scanning is done separately, across all the releases or release definitions
+    #
+    if scanMode:
+        if args.org:
+            teamFoundationServerURL = 'https://vsrm.dev.azure.com/' + args.org + '/'
+        if teamFoundationServerURL == notFoundStr:
+            print('##[error]')
+            print('##[error] Could not determine the organization to scan, use \'-org\' or set SYSTEM_TEAMFOUNDATIONSERVERURI')
+            print('##[error]')
+            return 1
+        scanProjects = None
+        if args.project:
+            scanProjects = [args.project]
+        if args.findingsfile is None:
+            return zoyinc_release_tools.scanGlobalVars(adoClient, teamFoundationServerURL, scanProjects, scanMode, scanWorkers, consoleReport=consoleReport, checkFields=args.checkfields, ruleEngine=ruleEngine)
+        with zoyinc_release_tools.FindingsWriter(args.findingsfile, args.findingsformat) as findingsWriter:
+            return zoyinc_release_tools.scanGlobalVars(adoClient, teamFoundationServerURL, scanProjects, scanMode, scanWorkers, findingsWriter, consoleReport, args.checkfields, ruleEngine)
+
+    if ((currRelease == notFoundStr) or (teamProjectName == notFoundStr) or (teamFoundationServerURL == notFoundStr)):
+        print('##[error]')
+        print('##[error] Something went wrong, could not determine some or all environment variables')
+        print('##[error]')
+        print('currRelease:              ' + currRelease)
+        print('teamProjectName:          ' + teamProjectName)
+        print('teamFoundationServerURL:  ' + teamFoundationServerURL)
+        return 1
+
+    # The tasks of the deploy steps are not checked so are not fetched
+    azureReleaseURL = zoyinc_release_tools.releaseURLOf(teamFoundationServerURL, teamProjectName, currRelease, expand='none')
 
+    #
+    # Summary
+    #
+    print('#')
+    print('# Running Global Pipeline Variables Healthcheck')
+    print('# =============================================')
+    print('# Current release:             ' + currRelease)
+    print('# Team project name:           ' + teamProjectName)
+    print('# Team foundation server URL:  ' + teamFoundationServerURL)
+    print('# Date:                ' + datetime.now().strftime('%d/%m/%y %H:%M'))
+    print('#')
+    print('# Release URL:         ' + azureReleaseURL)
+    print('#')
 
 
 
 
+    ##azureReleaseURL = 'https://vsrm.dev.azure.com/zoyinc/Examples/_apis/release/releases/' + currRelease + '?api-version=5.0'
 
+    print('Azure URL: ' + azureReleaseURL)
 
+    #
+    # Now need to go through all the strings in the release, the task instructions
+    # and inputs, the phase conditions, variables and so on, and check the global
+    # variables used in them are for the stage they are in
+    #
+    # The release is checked as it streams in rather than being loaded in full, on
+    # releases with a long deploy history most of it is not needed.
+    #
+    releaseCache = None
+    if args.releasecachedir:
+        releaseCache = zoyinc_release_tools.SharedReleaseCache(args.releasecachedir)
+    try:
+        reportLines, problemLines, scanFindings = zoyinc_release_tools.fetchAndCheckGlobalVars(adoClient, azureReleaseURL, checkFields=args.checkfields, releaseCache=releaseCache, ruleEngine=ruleEngine)
+    except zoyinc_std_tools.AdoRequestError as e:
+        print('##[error]')
+        print('##[error] Could not connect to Azure')
+        print('##[error]')
+        print('URL:            ' + azureReleaseURL)
+        print('Status code:    ' + str(e.statusCode))
+        print('Error received: ' + e.reason)
+        return 1
+    if args.findingsfile:
+        with zoyinc_release_tools.FindingsWriter(args.findingsfile, args.findingsformat) as findingsWriter:
+            findingsWriter.writeFindings({'project': teamProjectName,
+                                          'itemType': 'release',
+                                          'itemId': currRelease,
+                                          'itemURL': azureReleaseURL}, scanFindings)
+    if consoleReport:
+        for currLine in reportLines:
+            print(currLine)
 
+    #
+    # If errors print them out
+    #
+    if problemLines:
+        print('##[error]')
+        print('##[error] Errors with the use of global pipeline variables were found')
+        print('##[error]')
+        if consoleReport:
+            print('\n'.join(problemLines))
+            print()
+        elif args.findingsfile:
+            print('See ' + args.findingsfile + ' for the problems found')
+        sys.stdout.flush()
+        return 1
 
+    return 0
 
 
+if __name__ == '__main__':
+    sys.exit(zoyinc_std_tools.runScript('healthCheck', main))
@@ -0,0 +1,129 @@
+#
+# Release tools client
+# ====================
+#
+# Runs healthCheck.py or processCodeDeployApproval.py through releaseToolsDaemon.py,
+# with the same arguments the script takes, for example:
+#
+#     python releaseToolsClient.py healthCheck -azuretoken $(System.AccessToken)
+#
+# The daemon is found from RELEASE_TOOLS_DAEMON, either 'unix:<socket path>' or
+# 'http://127.0.0.1:<port>', and for http the key is read from the file in
+# RELEASE_TOOLS_DAEMON_KEYFILE. If RELEASE_TOOLS_DAEMON is not set, or the daemon is
+# not running, the script is run here instead as it would be without the daemon.
+#
+# 'releaseToolsClient.py flush' has the daemon write any release variables it is
+# holding straight away.
+#
+# With '-profile' the script is always run here, so the profile is of this run and
+# not of the daemon.
+#
+# Only the standard library is imported, so this starts quickly.
+#
+
+import http.client
+import json
+import os
+import runpy
+import socket
+import sys
+import urllib.parse
+
+daemonKeyHeader = 'X-Release-Tools-Key'
+daemonScripts = ['healthCheck', 'processCodeDeployApproval']
+
+#
+# Environment variables the scripts read
+#
+forwardedEnvPrefixes = ('RELEASE_', 'SYSTEM_', 'GLOBALVAR_')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socketPath, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+
+#
+# POST a request to the daemon, returns the json reply or None if the daemon could
+# not be reached
+#
+def daemonRequest(daemonAddress, requestPath, requestValue):
+    requestHeaders = {'Content-Type': 'application/json'}
+    if daemonAddress.startswith('unix:'):
+        daemonConnection = UnixHTTPConnection(daemonAddress[len('unix:'):], timeout=3600)
+    else:
+        splitAddress = urllib.parse.urlsplit(daemonAddress)
+        daemonConnection = http.client.HTTPConnection(splitAddress.hostname, splitAddress.port, timeout=3600)
+        keyFilename = os.environ.get('RELEASE_TOOLS_DAEMON_KEYFILE')
+        if keyFilename:
+            with open(keyFilename, 'r') as keyFile:
+                requestHeaders[daemonKeyHeader] = keyFile.read().strip()
+
+    try:
+        daemonConnection.request('POST', requestPath, body=json.dumps(requestValue), headers=requestHeaders)
+        daemonResponse = daemonConnection.getresponse()
+        replyValue = json.loads(daemonResponse.read())
+    except (OSError, ValueError):
+        return None
+    finally:
+        daemonConnection.close()
+
+    if daemonResponse.status != 200:
+        print('##[warning] Release tools daemon at ' + daemonAddress + ' returned ' + str(daemonResponse.status) + ': ' + str(replyValue.get('error')))
+        return None
+    return replyValue
+
+
+#
+# Ask the daemon to run the script, returns (exit code, output) or None if the
+# daemon could not be reached
+#
+def runThroughDaemon(daemonAddress, scriptName, scriptArgv):
+    runRequest = {'script': scriptName,
+                  'argv': scriptArgv,
+                  'environ': {envName: envValue for envName, envValue in os.environ.items() if envName.startswith(forwardedEnvPrefixes)}}
+    replyValue = daemonRequest(daemonAddress, '/run', runRequest)
+    if replyValue is None:
+        return None
+    return replyValue['exitCode'], replyValue['output']
+
+
+if __name__ == '__main__':
+
+    if (len(sys.argv) < 2) or (sys.argv[1] not in daemonScripts + ['flush']):
+        print('Usage: releaseToolsClient.py {' + ','.join(daemonScripts + ['flush']) + '} [script arguments]')
+        sys.exit(2)
+    scriptName = sys.argv[1]
+    scriptArgv = sys.argv[2:]
+
+    daemonAddress = os.environ.get('RELEASE_TOOLS_DAEMON')
+    if scriptName == 'flush':
+        flushReply = None
+        if daemonAddress:
+            flushReply = daemonRequest(daemonAddress, '/flush', {})
+        if flushReply is None:
+            print('##[error]')
+            print('##[error] Could not reach the release tools daemon, RELEASE_TOOLS_DAEMON=' + str(daemonAddress))
+            print('##[error]')
+            sys.exit(1)
+        print('# Release variables written for ' + str(flushReply['releasesWritten']) + ' releases')
+        sys.exit(0)
+    profileRun = any(currArg.partition('=')[0] == '-profile' for currArg in scriptArgv)
+    if daemonAddress and not profileRun:
+        daemonReply = runThroughDaemon(daemonAddress, scriptName, scriptArgv)
+        if daemonReply is not None:
+            exitCode, scriptOutput = daemonReply
+            sys.stdout.write(scriptOutput)
+            sys.stdout.flush()
+            sys.exit(exitCode)
+        print('# Release tools daemon at ' + daemonAddress + ' is not available, running ' + scriptName + ' here.', flush=True)
+
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), scriptName + '.py')] + scriptArgv
+    runpy.run_path(sys.argv[0], run_name='__main__')
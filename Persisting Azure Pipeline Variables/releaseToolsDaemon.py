@@ -0,0 +1,386 @@
+#
+# Release tools daemon
+# ====================
+#
+# Each pipeline task normally starts a new Python, imports requests, and opens new
+# connections to Azure DevOps, just to run healthCheck.py or
+# processCodeDeployApproval.py once. On a self-hosted agent this daemon can be left
+# running and the tasks run releaseToolsClient.py instead, which hands the command
+# line and environment to the daemon and prints what comes back.
+#
+# The daemon keeps one client per token, so connections to Azure DevOps stay open,
+# and a response cache shared by all checks, so a release fetched by one task is
+# only revalidated by the next. Cached responses are keyed by the token, and
+# System.AccessToken is issued for each job, so both are only reused by the tasks
+# of one job. At most -maxclients clients are kept, the least recently used is
+# closed to make room, and a client not used for -clientidletimeout seconds is
+# closed when the next check starts.
+#
+# It listens on either a Unix socket, which only the agent user can open, or on
+# loopback HTTP. Over HTTP every request must send the key the daemon writes to
+# -keyfile, so other users on the machine cannot run checks with it.
+#
+# Examples:
+#
+#     python releaseToolsDaemon.py -socket /home/agent/releaseTools.sock
+#     python releaseToolsDaemon.py -port 8790 -keyfile /home/agent/releaseTools.key
+#
+# When run through the daemon -cachedir and -telemetrydir given to a check are not
+# used, the daemon's own -cachedir and -telemetrydir are used instead.
+# A -findingsfile is written by the daemon, from its own working directory, so give
+# it as an absolute path.
+#
+# Requests are json POSTed to /run:
+#
+#     {"script": "healthCheck", "argv": ["-azuretoken", "..."], "environ": {...}}
+#
+# and the reply is:
+#
+#     {"exitCode": 0, "output": "..."}
+#
+# By default each processCodeDeployApproval.py writes its release variables as soon
+# as it has them. With -writewindow they go through a write-behind queue instead,
+# the variables set on a release within -writewindow seconds of each other, by any
+# of the tasks, are written with one update. This holds up every approval by up to
+# the window, so only use it where many tasks approve the same release at once.
+# POST /flush writes everything queued straight away.
+#
+
+import argparse
+import collections
+import http.server
+import json
+import os
+import secrets
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+#
+# The shared Azure DevOps tooling lives with the ADO Process Tools
+#
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ADO Process Tools'))
+import zoyinc_std_tools
+import zoyinc_release_tools
+import healthCheck
+import processCodeDeployApproval
+
+daemonScripts = {'healthCheck': healthCheck.main,
+                 'processCodeDeployApproval': processCodeDeployApproval.main}
+daemonKeyHeader = 'X-Release-Tools-Key'
+
+
+#
+# stdout/stderr that each thread can point somewhere else
+#
+# The checks print their output, while a check is running in a request thread its
+# output goes to that request's buffer, everything else goes to the real stream.
+#
+class ThreadLocalOutput:
+
+    def __init__(self, realStream):
+        self.realStream = realStream
+        self.threadState = threading.local()
+
+    def redirect(self, outputBuffer):
+        self.threadState.outputBuffer = outputBuffer
+
+    def stream(self):
+        outputBuffer = getattr(self.threadState, 'outputBuffer', None)
+        if outputBuffer is None:
+            return self.realStream
+        return outputBuffer
+
+    def write(self, outputText):
+        return self.stream().write(outputText)
+
+    def flush(self):
+        self.stream().flush()
+
+    def __getattr__(self, attrName):
+        return getattr(self.realStream, attrName)
+
+
+#
+# Output of one check
+#
+class ThreadBuffer:
+
+    def __init__(self):
+        self.outputParts = []
+
+    def write(self, outputText):
+        self.outputParts.append(outputText)
+        return len(outputText)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.outputParts)
+
+
+#
+# Clients and cache shared by all the checks
+#
+class DaemonState:
+
+    def __init__(self, cacheDir, poolMaxSize, writeWindow, maxClients=8, clientIdleSeconds=600):
+        self.responseCache = zoyinc_std_tools.AdoResponseCache(cacheDir)
+        self.releaseWriteQueue = None
+        self.scriptOptions = {}
+        if writeWindow > 0:
+            self.releaseWriteQueue = zoyinc_release_tools.ReleaseWriteQueue(writeWindow)
+            self.scriptOptions['processCodeDeployApproval'] = {'releaseWriteQueue': self.releaseWriteQueue}
+        self.poolMaxSize = poolMaxSize
+        self.maxClients = maxClients
+        self.clientIdleSeconds = clientIdleSeconds
+
+        # token: (client, last used), in least to most recently used order
+        self.adoClients = collections.OrderedDict()
+        self.clientsClosed = 0
+        self.stateLock = threading.Lock()
+        self.startTime = time.time()
+        self.lastRequestTime = time.monotonic()
+        self.runCount = 0
+
+    #
+    # Client for a token, closing the clients that are idle or over -maxclients
+    #
+    # A closed client can still be used by a check that already has it, its session
+    # opens new connections as they are needed.
+    #
+    def adoClientFor(self, azureToken):
+        closeClients = []
+        with self.stateLock:
+            timeNow = time.monotonic()
+            if azureToken in self.adoClients:
+                adoClient = self.adoClients.pop(azureToken)[0]
+            else:
+                adoClient = zoyinc_std_tools.AdoClient(azureToken, poolMaxSize=self.poolMaxSize, responseCache=self.responseCache)
+            while self.adoClients and ((len(self.adoClients) >= self.maxClients) or (timeNow - next(iter(self.adoClients.values()))[1] >= self.clientIdleSeconds)):
+                closeClients.append(self.adoClients.popitem(last=False)[1][0])
+            self.adoClients[azureToken] = (adoClient, timeNow)
+            self.clientsClosed += len(closeClients)
+        for oldClient in closeClients:
+            oldClient.close()
+        return adoClient
+
+    #
+    # Run a check with its output captured, returns (exit code, output)
+    #
+    def runScript(self, scriptName, scriptArgv, scriptEnviron):
+        with self.stateLock:
+            self.runCount += 1
+            self.lastRequestTime = time.monotonic()
+        scriptOutput = ThreadBuffer()
+        sys.stdout.redirect(scriptOutput)
+        sys.stderr.redirect(scriptOutput)
+        try:
+            # Profiling patches threads process wide, so is not done for one run of many
+            profileDir, topCount, scriptArgv = zoyinc_std_tools.splitProfileArgs(scriptArgv)
+            if profileDir:
+                scriptOutput.write('##[warning] -profile is ignored by the release tools daemon, run ' + scriptName + '.py directly to profile it\n')
+            exitCode = daemonScripts[scriptName](scriptArgv, scriptEnviron, self.adoClientFor, **self.scriptOptions.get(scriptName, {}))
+        except SystemExit as e:
+            # argparse exits on bad arguments, after printing the usage
+            exitCode = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            scriptOutput.write('##[error]\n')
+            scriptOutput.write('##[error] ' + scriptName + ' failed in the release tools daemon\n')
+            scriptOutput.write('##[error]\n')
+            scriptOutput.write(traceback.format_exc())
+            exitCode = 1
+        finally:
+            sys.stdout.redirect(None)
+            sys.stderr.redirect(None)
+        with self.stateLock:
+            self.lastRequestTime = time.monotonic()
+        return exitCode, scriptOutput.getvalue()
+
+    #
+    # Write the queued release variables now, returns the number of releases written
+    #
+    def flushWrites(self):
+        if self.releaseWriteQueue is None:
+            return 0
+        batchesBefore = self.releaseWriteQueue.stats['batches']
+        self.releaseWriteQueue.flush()
+        return self.releaseWriteQueue.stats['batches'] - batchesBefore
+
+    def status(self):
+        daemonStatus = {'pid': os.getpid(),
+                        'uptimeSeconds': time.time() - self.startTime,
+                        'runs': self.runCount,
+                        'clients': len(self.adoClients),
+                        'clientsClosed': self.clientsClosed,
+                        'cache': dict(self.responseCache.stats)}
+        if self.releaseWriteQueue is not None:
+            daemonStatus['releaseWrites'] = dict(self.releaseWriteQueue.stats)
+        return daemonStatus
+
+
+#
+# Handles /run, /flush and /status
+#
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # TCP_NODELAY can only be set on TCP sockets
+    def setup(self):
+        self.disable_nagle_algorithm = isinstance(self.server, DaemonTCPServer)
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendJson(self, statusCode, replyValue):
+        replyBytes = json.dumps(replyValue).encode()
+        self.send_response(statusCode)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(replyBytes)))
+        self.end_headers()
+        self.wfile.write(replyBytes)
+
+    def keyIsValid(self):
+        if self.server.daemonKey is None:
+            return True
+        return secrets.compare_digest(self.headers.get(daemonKeyHeader, ''), self.server.daemonKey)
+
+    def do_GET(self):
+        if not self.keyIsValid():
+            self.sendJson(403, {'error': 'Missing or wrong ' + daemonKeyHeader})
+        elif self.path == '/status':
+            self.sendJson(200, self.server.daemonState.status())
+        else:
+            self.sendJson(404, {'error': 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        if not self.keyIsValid():
+            self.sendJson(403, {'error': 'Missing or wrong ' + daemonKeyHeader})
+            return
+        if self.path == '/flush':
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.sendJson(200, {'releasesWritten': self.server.daemonState.flushWrites()})
+            return
+        if self.path != '/run':
+            self.sendJson(404, {'error': 'Unknown path ' + self.path})
+            return
+        try:
+            runRequest = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            scriptName = runRequest['script']
+            scriptArgv = [str(currArg) for currArg in runRequest.get('argv', [])]
+            scriptEnviron = {str(envName): str(envValue) for envName, envValue in runRequest.get('environ', {}).items()}
+        except (ValueError, KeyError, AttributeError, TypeError) as e:
+            self.sendJson(400, {'error': 'Bad run request: ' + str(e)})
+            return
+        if scriptName not in daemonScripts:
+            self.sendJson(400, {'error': 'Unknown script \'' + scriptName + '\', choose from: ' + ', '.join(sorted(daemonScripts))})
+            return
+        exitCode, scriptOutput = self.server.daemonState.runScript(scriptName, scriptArgv, scriptEnviron)
+        self.sendJson(200, {'exitCode': exitCode, 'output': scriptOutput})
+
+
+class DaemonTCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class DaemonUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # BaseHTTPRequestHandler expects a (host, port) client address
+    def get_request(self):
+        clientSocket, clientAddress = super().get_request()
+        return clientSocket, ('unix', 0)
+
+
+#
+# Stop the server once nothing has been asked of it for idleSeconds
+#
+def stopWhenIdle(daemonServer, daemonState, idleSeconds):
+    while True:
+        time.sleep(min(idleSeconds, 5))
+        with daemonState.stateLock:
+            idleFor = time.monotonic() - daemonState.lastRequestTime
+        if idleFor >= idleSeconds:
+            daemonServer.shutdown()
+            return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-socket', help='Listen on this Unix socket')
+    parser.add_argument('-port', type=int, help='Listen on this loopback port')
+    parser.add_argument('-keyfile', help='File to write the key HTTP clients must send, required with -port')
+    parser.add_argument('-cachedir', help='Directory to also keep cached Azure DevOps responses in, by default they are only kept in memory')
+    parser.add_argument('-poolsize', type=int, default=10, help='Max connections kept open to each host per token')
+    parser.add_argument('-maxclients', type=int, default=8, help='Max number of tokens to keep a client and its connections open for, the least recently used is closed first')
+    parser.add_argument('-clientidletimeout', type=float, default=600, help='Close the client of a token not used for this many seconds')
+    parser.add_argument('-idletimeout', type=float, default=0, help='Exit after this many seconds without a request, 0 to never exit')
+    parser.add_argument('-telemetrydir', help='Write request and phase timings, as json and a Prometheus textfile, to this directory when the daemon exits')
+    parser.add_argument('-writewindow', type=float, default=0, help='Seconds to hold release variable writes so writes to the same release can be combined, by default each is written straight away')
+    args = parser.parse_args()
+
+    if (args.socket is None) == (args.port is None):
+        print('##[error]')
+        print('##[error] Give one of \'-socket\' or \'-port\'')
+        print('##[error]')
+        sys.exit(1)
+    if (args.port is not None) and (args.keyfile is None):
+        print('##[error]')
+        print('##[error] \'-keyfile\' is required with \'-port\'')
+        print('##[error]')
+        sys.exit(1)
+
+    if args.telemetrydir:
+        zoyinc_std_tools.enableTelemetry('releaseToolsDaemon', args.telemetrydir)
+    daemonState = DaemonState(args.cachedir, args.poolsize, args.writewindow, max(1, args.maxclients), args.clientidletimeout)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        previousUmask = os.umask(0o177)
+        try:
+            daemonServer = DaemonUnixServer(args.socket, DaemonRequestHandler)
+        finally:
+            os.umask(previousUmask)
+        daemonServer.daemonKey = None
+        listenAddress = 'unix:' + args.socket
+    else:
+        daemonServer = DaemonTCPServer(('127.0.0.1', args.port), DaemonRequestHandler)
+        daemonServer.daemonKey = secrets.token_hex(32)
+        keyFileDescriptor = os.open(args.keyfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(keyFileDescriptor, 'w') as keyFile:
+            keyFile.write(daemonServer.daemonKey)
+        listenAddress = 'http://127.0.0.1:' + str(daemonServer.server_address[1])
+    daemonServer.daemonState = daemonState
+
+    sys.stdout = ThreadLocalOutput(sys.stdout)
+    sys.stderr = ThreadLocalOutput(sys.stderr)
+
+    print('#')
+    print('# Release tools daemon')
+    print('# ====================')
+    print('# Listening on:   ' + listenAddress)
+    print('# Scripts:        ' + ', '.join(sorted(daemonScripts)))
+    print('# Pid:            ' + str(os.getpid()))
+    print('# Write window:   ' + (str(args.writewindow) + 's' if args.writewindow > 0 else 'off'))
+    print('#')
+    print('# Set RELEASE_TOOLS_DAEMON=' + listenAddress + ' for releaseToolsClient.py')
+    print('#', flush=True)
+
+    if args.idletimeout:
+        threading.Thread(target=stopWhenIdle, args=(daemonServer, daemonState, args.idletimeout), daemon=True).start()
+    try:
+        daemonServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemonServer.server_close()
+        daemonState.flushWrites()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,1667 @@
+#
+# Release tools
+# =============
+#
+# Shared code for the scripts that work with Azure DevOps releases and the
+# GLOBALVAR_ pipeline variables.
+#
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+import zoyinc_std_tools
+
+#
+# Global variable names
+#
+# For the instructions field there is the concept of 'variable expand support' which is where
+# you can put environment variables in the instructions using the standard format '$(MY_VAR)'
+#
+# For us we are going to have gobal environment variables and the names will be consistent:
+#
+#     $(GLOBALVAR_WELLINGTON_MIMSG2)
+#
+# GLOBALVAR_  = Standard prefixes for all our global variables (This is our convention no Azure)
+# WELLINGTON  = The environment name, must be equal to the 'name' of the 'Stage' in the pipeline
+# _           = There is always an underscore after the environment name
+# MIMSG2      = The name of the variable, in this case it stands for Manual Intervention MeSsaGe 2
+#
+
+
+#
+# Stage name as used in global variable names
+#
+# 'Test Env (2)' goes to 'TESTENV2'
+#
+def basicStageNameOf(stageName):
+    return re.sub(r'( |_|\(|\)|-)','', stageName).upper()
+
+
+#
+# Release index
+#
+# Built with a single pass over a release, or release definition, so the stages,
+# deployments, phases and manual interventions can be looked up directly rather
+# than looping through the release each time.
+#
+#     stagesByName        = Stage name in upper case: stage
+#     deploymentsById     = Deployment id: (stage, deploy step)
+#     deployPhasesById    = Phase id: (stage, deploy step, release deploy phase)
+#     interventionsByKey  = (stage name in upper case, deployment id, intervention name in
+#                           upper case): (release deploy phase, manual intervention)
+#
+# Ids are held as strings, where the same name is used more than once the first one
+# in the release is kept, as the loops through the release this replaced stopped at
+# the first match.
+#
+# healthCheck.py checks the release as it streams in, so never has the whole release
+# to index.
+#
+class ReleaseIndex:
+
+    def __init__(self, releaseDetail):
+        self.stagesByName = {}
+        self.deploymentsById = {}
+        self.deployPhasesById = {}
+        self.interventionsByKey = {}
+
+        for currStage in releaseDetail.get('environments') or []:
+            currStageUpper = currStage['name'].upper()
+            self.stagesByName.setdefault(currStageUpper, currStage)
+
+            for currDeployStep in currStage.get('deploySteps') or []:
+                currDeploymentId = str(currDeployStep.get('deploymentId'))
+                self.deploymentsById.setdefault(currDeploymentId, (currStage, currDeployStep))
+
+                for currDeployPhase in currDeployStep.get('releaseDeployPhases') or []:
+                    self.deployPhasesById.setdefault(str(currDeployPhase.get('phaseId')), (currStage, currDeployStep, currDeployPhase))
+
+                    for currIntervention in currDeployPhase.get('manualInterventions') or []:
+                        interventionKey = (currStageUpper, currDeploymentId, currIntervention['name'].upper())
+                        self.interventionsByKey.setdefault(interventionKey, (currDeployPhase, currIntervention))
+
+    def stage(self, stageName):
+        return self.stagesByName.get(stageName.upper())
+
+    def deployment(self, deploymentId):
+        return self.deploymentsById.get(str(deploymentId))
+
+    def deployPhase(self, phaseId):
+        return self.deployPhasesById.get(str(phaseId))
+
+    #
+    # Returns (release deploy phase, manual intervention) or None if not found
+    #
+    def intervention(self, stageName, deploymentId, interventionName):
+        return self.interventionsByKey.get((stageName.upper(), str(deploymentId), interventionName.upper()))
+
+
+#
+# Global variable rules
+# ---------------------
+#
+# Each rule is a way a global variable can be referenced in a release. The rule's
+# pattern uses '{ref}' for the variable name itself:
+#
+#     macro       $(GLOBALVAR_PRD_MIMSG2)                   In any field
+#     condition   'GLOBALVAR_PRD_DEPLOYAPPROVALOK'          In phase, and other, conditions
+#     expression  variables.GLOBALVAR_PRD_DEPLOYAPPROVALOK  Runtime expressions and conditions
+#     envvar      $GLOBALVAR_PRD_X, ${GLOBALVAR_PRD_X},     Scripts reading the variable from
+#                 $env:GLOBALVAR_PRD_X, %GLOBALVAR_PRD_X%   the environment
+#
+# fieldPattern, if given, limits the rule to the fields whose path matches it.
+#
+# Only macro and condition, the references the health check has always looked for,
+# are checked by default. expression and envvar are turned on with ruleEngineFor(),
+# healthCheck.py's '-extrarules'.
+#
+# All the rules are compiled into one pattern, so each string in a release is
+# searched once whatever the number of rules. Strings that do not contain the
+# global variable prefix at all are skipped without being searched.
+#
+globalVarPrefix = 'GLOBALVAR_'
+globalVarRefPatternStr = r'GLOBALVAR_(?:[^_\s()\[\]{}\'"%$,]+_)?[A-Za-z0-9_.]*'
+globalVarPartsPattern = re.compile(r'GLOBALVAR_(?:(?P<stage>[^_\s()\[\]{}\'"%$,]+)_)?(?P<name>[A-Za-z0-9_.]*)', re.IGNORECASE)
+varIndentStr = '    '
+
+#
+# Parts of a release that are not checked
+#
+#     deploySteps = The deployment history of each stage, what was run rather than
+#                   what is configured
+#
+skippedFieldKeys = ('deploySteps',)
+
+#
+# What is checked in a release
+#
+#     phases = Only the phases of each stage, the stage's phasesKey, the default
+#     all    = Every field of the release
+#
+checkFieldsChoices = ['all', 'phases']
+
+
+class GlobalVarRule:
+
+    def __init__(self, ruleName, patternStr, fieldPattern=None, ruleDescription=''):
+        self.ruleName = ruleName
+        self.patternStr = patternStr
+        self.ruleDescription = ruleDescription
+        self.fieldPattern = None
+        if fieldPattern is not None:
+            self.fieldPattern = re.compile(fieldPattern)
+
+    def appliesTo(self, fieldPathStr):
+        return (self.fieldPattern is None) or (self.fieldPattern.search(fieldPathStr) is not None)
+
+
+defaultGlobalVarRules = [
+    GlobalVarRule('macro', r'\$\({ref}\)',
+                  ruleDescription='Global variable used as a $(...) macro'),
+    GlobalVarRule('condition', r'\'{ref}\'', fieldPattern=r'(^|\.)condition$',
+                  ruleDescription='Global variable quoted in a condition'),
+]
+
+optionalGlobalVarRules = [
+    GlobalVarRule('expression', r'(?<![\w\'])variables\.{ref}',
+                  ruleDescription='Global variable used as variables.<name> in an expression'),
+    GlobalVarRule('envvar', r'\$env:{ref}|\$\{{ref}\}|\${ref}|%{ref}%',
+                  ruleDescription='Global variable read from the environment by a script'),
+]
+
+
+#
+# A global variable reference found in a release
+#
+#     status  = 'ok', 'error', or 'unchecked' when it is outside of any stage so
+#               there is no stage name to check it against
+#     offset  = Where the reference starts in the field
+#
+class GlobalVarFinding:
+
+    def __init__(self, ruleName, status, message, matchText, offset, foundStageName, variableName, fieldPath, stageName, basicStageName, phaseName, taskName):
+        self.ruleName = ruleName
+        self.status = status
+        self.message = message
+        self.matchText = matchText
+        self.offset = offset
+        self.foundStageName = foundStageName
+        self.variableName = variableName
+        self.fieldPath = fieldPath
+        self.stageName = stageName
+        self.basicStageName = basicStageName
+        self.phaseName = phaseName
+        self.taskName = taskName
+
+    def asDict(self):
+        return dict(vars(self))
+
+
+#
+# Rule engine, all the rules compiled into one pattern
+#
+class GlobalVarRuleEngine:
+
+    def __init__(self, globalVarRules=None):
+        if globalVarRules is None:
+            globalVarRules = defaultGlobalVarRules
+        self.globalVarRules = list(globalVarRules)
+        self.combinedPattern = re.compile('|'.join('(?P<rule' + str(ruleIndex) + '>' + currRule.patternStr.replace('{ref}', '(?:' + globalVarRefPatternStr + ')') + ')'
+                                                   for ruleIndex, currRule in enumerate(self.globalVarRules)), re.IGNORECASE)
+        self.prefixPattern = re.compile(re.escape(globalVarPrefix), re.IGNORECASE)
+
+    #
+    # False if the field can not have any references in it
+    #
+    def mayReference(self, fieldValue):
+        return self.prefixPattern.search(fieldValue) is not None
+
+    #
+    # Returns a list of (rule, match) for the references in a field, in the order
+    # they are in the field
+    #
+    def findReferences(self, fieldPathStr, fieldValue):
+        foundReferences = []
+        for currMatch in self.combinedPattern.finditer(fieldValue):
+            currRule = self.globalVarRules[int(currMatch.lastgroup[len('rule'):])]
+            if currRule.appliesTo(fieldPathStr):
+                foundReferences.append((currRule, currMatch))
+        return foundReferences
+
+
+defaultRuleEngine = GlobalVarRuleEngine()
+optionalRuleNames = [currRule.ruleName for currRule in optionalGlobalVarRules]
+
+#
+# Rule engine with the default rules and the optional rules named in extraRuleNames
+#
+def ruleEngineFor(extraRuleNames=None):
+    if not extraRuleNames:
+        return defaultRuleEngine
+    return GlobalVarRuleEngine(defaultGlobalVarRules + [currRule for currRule in optionalGlobalVarRules if currRule.ruleName in extraRuleNames])
+
+
+#
+# Field path as a string, 'environments[0].deployPhasesSnapshot[1].name'
+#
+def fieldPathStrOf(fieldPath):
+    pathStr = ''
+    for currPart in fieldPath:
+        if isinstance(currPart, int):
+            pathStr += '[' + str(currPart) + ']'
+        elif pathStr:
+            pathStr += '.' + currPart
+        else:
+            pathStr = currPart
+    return pathStr
+
+
+#
+# Every string in a json value, as (path, string), the path being a tuple of keys
+# and list indexes
+#
+def iterStringFields(jsonValue):
+    pendingValues = [((), jsonValue)]
+    while pendingValues:
+        currPath, currValue = pendingValues.pop()
+        if isinstance(currValue, str):
+            yield currPath, currValue
+        elif isinstance(currValue, dict):
+            pendingValues.extend((currPath + (currKey,), currItem) for currKey, currItem in reversed(list(currValue.items())))
+        elif isinstance(currValue, list):
+            pendingValues.extend((currPath + (currIndex,), currItem) for currIndex, currItem in reversed(list(enumerate(currValue))))
+
+
+#
+# Global variable scan of a release, or release definition
+#
+# Strings are added, in any order, with addString() as the release is walked or
+# streamed. Only the strings with references, and the stage, phase and task names,
+# are kept. finish() then checks each reference against the name of the stage it
+# is in and builds the report.
+#
+# Where a field is in the release:
+#
+#     ('environments', stage index, ...)                                    In a stage
+#     ('environments', stage index, phasesKey, phase index, ...)            In a phase
+#     (... phasesKey, phase index, 'workflowTasks', task index, ...)        In a task
+#
+# With checkFields 'phases' strings outside of the phases are dropped as they are
+# added, so only the phases are checked.
+#
+class GlobalVarScan:
+
+    def __init__(self, phasesKey='deployPhasesSnapshot', ruleEngine=None, checkFields='phases'):
+        if ruleEngine is None:
+            ruleEngine = defaultRuleEngine
+        self.phasesKey = phasesKey
+        self.ruleEngine = ruleEngine
+        self.phasesOnly = (checkFields == 'phases')
+        self.namesByPath = {}
+        self.fieldHits = []
+
+    def stagePathOf(self, fieldPath):
+        if (len(fieldPath) > 2) and (fieldPath[0] == 'environments') and isinstance(fieldPath[1], int):
+            return fieldPath[:2]
+        return None
+
+    def phasePathOf(self, fieldPath):
+        if (len(fieldPath) > 4) and (self.stagePathOf(fieldPath) is not None) and (fieldPath[2] == self.phasesKey) and isinstance(fieldPath[3], int):
+            return fieldPath[:4]
+        return None
+
+    def taskPathOf(self, fieldPath):
+        if (len(fieldPath) > 6) and (self.phasePathOf(fieldPath) is not None) and (fieldPath[4] == 'workflowTasks') and isinstance(fieldPath[5], int):
+            return fieldPath[:6]
+        return None
+
+    def addString(self, fieldPath, fieldValue):
+        if fieldPath and (fieldPath[-1] == 'name') and (len(fieldPath) in (3, 5, 7)):
+            ownerPath = fieldPath[:-1]
+            if ownerPath in (self.stagePathOf(fieldPath), self.phasePathOf(fieldPath), self.taskPathOf(fieldPath)):
+                self.namesByPath[ownerPath] = fieldValue
+        if not self.ruleEngine.mayReference(fieldValue):
+            return
+        if (len(fieldPath) > 2) and (fieldPath[2] in skippedFieldKeys) and (self.stagePathOf(fieldPath) is not None):
+            return
+        if self.phasesOnly and (self.phasePathOf(fieldPath) is None):
+            return
+        fieldPathStr = fieldPathStrOf(fieldPath)
+        foundReferences = self.ruleEngine.findReferences(fieldPathStr, fieldValue)
+        if foundReferences:
+            self.fieldHits.append((fieldPath, fieldPathStr, fieldValue, foundReferences))
+
+    #
+    # Report order, stage by stage and within a stage phase by phase, the phase
+    # condition first then the tasks. Fields outside of the phases come after the
+    # phases and fields outside of the stages come last.
+    #
+    def reportOrderOf(self, fieldHit):
+        fieldPath = fieldHit[0]
+        stagePath = self.stagePathOf(fieldPath)
+        phasePath = self.phasePathOf(fieldPath)
+        taskPath = self.taskPathOf(fieldPath)
+        return (stagePath[1] if stagePath else float('inf'),
+                phasePath[3] if phasePath else float('inf'),
+                0 if fieldPath[4:] == ('deploymentInput', 'condition') else 1,
+                taskPath[5] if taskPath else -1)
+
+    #
+    # Check each reference uses the stage name it is in
+    #
+    def checkReferences(self, foundReferences, fieldPathStr, stageName, basicStageName, phaseName, taskName, errMsgContext, reportLines, problemLines):
+        scanFindings = []
+        for currRule, currMatch in foundReferences:
+            matchText = currMatch.group()
+            varParts = globalVarPartsPattern.search(matchText)
+            foundStageName = varParts.group('stage')
+            if basicStageName is None:
+                findingStatus = 'unchecked'
+                findingMsg = 'not used in a stage so the stage name can not be checked'
+                reportLines.append(varIndentStr + matchText + ' - NOT CHECKED, ' + findingMsg)
+            elif foundStageName is None:
+                findingStatus = 'error'
+                findingMsg = 'no stage name found in the variable name'
+                errMsg = matchText + ' - ERROR no stage name found in the variable name.'
+                reportLines.append(varIndentStr + errMsg)
+                problemLines.append(errMsg)
+            elif foundStageName == basicStageName:
+                findingStatus = 'ok'
+                findingMsg = 'stage name matches'
+                reportLines.append(varIndentStr + matchText + ' - OK')
+            else:
+                findingStatus = 'error'
+                findingMsg = 'The stage name used for the variable is \'' + foundStageName + '\', which is different from the expected stage name \'' + basicStageName + '\'.'
+                errMsg1 = matchText + ' - ERROR  with global variable in ' + errMsgContext
+                errMsg2 = ' ' * len(matchText) + '   ' + findingMsg
+                reportLines.append(varIndentStr + errMsg1)
+                reportLines.append(varIndentStr + errMsg2)
+                problemLines.append(errMsg1)
+                problemLines.append(errMsg2)
+            scanFindings.append(GlobalVarFinding(currRule.ruleName, findingStatus, findingMsg, matchText, currMatch.start(), foundStageName, varParts.group('name'),
+                                                 fieldPathStr, stageName, basicStageName, phaseName, taskName))
+        return scanFindings
+
+    #
+    # Returns the console report lines, the problem lines and the findings, no
+    # problems means the release is OK
+    #
+    def finish(self):
+        reportLines = []
+        problemLines = []
+        scanFindings = []
+
+        for fieldPath, fieldPathStr, fieldValue, foundReferences in sorted(self.fieldHits, key=self.reportOrderOf):
+            stagePath = self.stagePathOf(fieldPath)
+            phasePath = self.phasePathOf(fieldPath)
+            taskPath = self.taskPathOf(fieldPath)
+            stageName = basicStageName = phaseName = taskName = None
+            if stagePath is not None:
+                stageName = self.namesByPath.get(stagePath, '')
+                basicStageName = basicStageNameOf(stageName)
+            if phasePath is not None:
+                phaseName = self.namesByPath.get(phasePath, '')
+            if taskPath is not None:
+                taskName = self.namesByPath.get(taskPath, '')
+
+            reportLines.append('')
+            if (phasePath is not None) and (fieldPath[4:] == ('deploymentInput', 'condition')):
+                reportLines.append('Found global variable/s in phase conditions')
+                reportLines.append(' - Current phase:       ' + phaseName)
+                reportLines.append(' - Current stage name:  ' + stageName)
+                reportLines.append('   - variable format:   ' + basicStageName)
+                reportLines.append('   - Phase condition:   ' + fieldValue)
+                errMsgContext = 'phase condition. Stage = \'' + stageName + '\', phase  = \'' + phaseName + '\', and condition \'' + fieldValue + '\''
+            elif (taskPath is not None) and (fieldPath[6:] == ('inputs', 'instructions')):
+                reportLines.append('Found global variable/s in instructions')
+                reportLines.append(' - Current phase:       ' + phaseName)
+                reportLines.append(' - Current stage name:  ' + stageName)
+                reportLines.append('   - variable format:   ' + basicStageName)
+                errMsgContext = 'stage, \'' + stageName + '\', in phase \'' + phaseName + '\', and task \'' + taskName + '\'.'
+            elif stagePath is not None:
+                reportLines.append('Found global variable/s in ' + fieldPathStr)
+                if phaseName is not None:
+                    reportLines.append(' - Current phase:       ' + phaseName)
+                if taskName is not None:
+                    reportLines.append(' - Current task:        ' + taskName)
+                reportLines.append(' - Current stage name:  ' + stageName)
+                reportLines.append('   - variable format:   ' + basicStageName)
+                errMsgContext = 'stage, \'' + stageName + '\', field \'' + fieldPathStr + '\'.'
+            else:
+                reportLines.append('Found global variable/s outside of any stage in ' + fieldPathStr)
+                errMsgContext = None
+            reportLines.append(' Variables:')
+            scanFindings.extend(self.checkReferences(foundReferences, fieldPathStr, stageName, basicStageName, phaseName, taskName, errMsgContext, reportLines, problemLines))
+            reportLines.append('')
+
+        return reportLines, problemLines, scanFindings
+
+
+#
+# Check the global variables used in a release, or release definition
+#
+# Checks every string in the release, the phase conditions, task instructions and
+# inputs, variables and so on, and checks the global variables used include the
+# name of the stage they are in.
+#
+# phasesKey is 'deployPhasesSnapshot' for a release and 'deployPhases' for a
+# release definition.
+#
+# Returns the console report lines, the problem lines and the list of
+# GlobalVarFinding, no problems means the release is OK.
+#
+def checkReleaseGlobalVars(releaseDetail, phasesKey='deployPhasesSnapshot', ruleEngine=None, checkFields='phases'):
+    if checkFields == 'phases':
+        releaseDetail = zoyinc_std_tools.projectJson(releaseDetail, ['environments.name', 'environments.' + phasesKey])
+    globalVarScan = GlobalVarScan(phasesKey, ruleEngine, checkFields)
+    for fieldPath, fieldValue in iterStringFields(releaseDetail):
+        globalVarScan.addString(fieldPath, fieldValue)
+    return globalVarScan.finish()
+
+
+#
+# Findings file
+# -------------
+#
+# Findings are written out as each release is checked rather than being kept until
+# the end, as either:
+#
+#     jsonl = One json object per line, the finding and the release it is in
+#     sarif = A SARIF 2.1.0 log, for tools that read static analysis results
+#
+# Only bufferSize findings are held in memory before being written, so a scan of a
+# large organization does not grow with the number of findings. Every finding is
+# written, including the 'ok' ones, in SARIF these are results of kind 'pass'.
+#
+# A SARIF log is only complete json once the writer has been closed.
+#
+findingsFormats = ['jsonl', 'sarif']
+sarifSchemaURL = 'https://json.schemastore.org/sarif-2.1.0.json'
+sarifLevels = {'ok': 'none', 'error': 'error', 'unchecked': 'warning'}
+
+
+class FindingsWriter:
+
+    def __init__(self, outputFilename, outputFormat=None, bufferSize=100, ruleEngine=None):
+        if outputFormat is None:
+            outputFormat = 'sarif' if outputFilename.lower().endswith('.sarif') else 'jsonl'
+        if ruleEngine is None:
+            ruleEngine = defaultRuleEngine
+        self.outputFilename = outputFilename
+        self.outputFormat = outputFormat
+        self.bufferSize = max(1, bufferSize)
+        self.pendingRecords = []
+        self.findingCount = 0
+        self.problemCount = 0
+        self.wroteResult = False
+        self.outputFile = open(outputFilename, 'w', encoding='utf-8', newline='\n')
+        if outputFormat == 'sarif':
+            sarifTool = {'driver': {'name': 'healthCheck',
+                                    'rules': [{'id': currRule.ruleName, 'shortDescription': {'text': currRule.ruleDescription or currRule.ruleName}}
+                                              for currRule in ruleEngine.globalVarRules]}}
+            self.outputFile.write('{"$schema": ' + json.dumps(sarifSchemaURL) + ', "version": "2.1.0", "runs": [{"tool": ' + json.dumps(sarifTool) + ', "results": [\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        self.close()
+
+    #
+    # itemInfo is a dict describing the release, or release definition, the findings
+    # are in, it must include 'itemURL'
+    #
+    def writeFindings(self, itemInfo, scanFindings):
+        for currFinding in scanFindings:
+            if self.outputFormat == 'sarif':
+                self.pendingRecords.append(self.sarifResultOf(itemInfo, currFinding))
+            else:
+                findingRecord = dict(itemInfo)
+                findingRecord.update(currFinding.asDict())
+                self.pendingRecords.append(findingRecord)
+            self.findingCount += 1
+            if currFinding.status != 'ok':
+                self.problemCount += 1
+            if len(self.pendingRecords) >= self.bufferSize:
+                self.flush()
+
+    def sarifResultOf(self, itemInfo, currFinding):
+        sarifResult = {'ruleId': currFinding.ruleName,
+                       'level': sarifLevels[currFinding.status],
+                       'message': {'text': currFinding.matchText + ': ' + currFinding.message},
+                       'locations': [{'physicalLocation': {'artifactLocation': {'uri': itemInfo['itemURL']}},
+                                      'logicalLocations': [{'fullyQualifiedName': currFinding.fieldPath, 'kind': 'member'}]}],
+                       'properties': dict(itemInfo, **{propertyName: propertyValue for propertyName, propertyValue in currFinding.asDict().items()
+                                                       if propertyName not in ('ruleName', 'message', 'fieldPath')})}
+        if currFinding.status == 'ok':
+            sarifResult['kind'] = 'pass'
+        return sarifResult
+
+    def flush(self):
+        if self.outputFormat == 'sarif':
+            for currRecord in self.pendingRecords:
+                if self.wroteResult:
+                    self.outputFile.write(',\n')
+                self.outputFile.write(json.dumps(currRecord))
+                self.wroteResult = True
+        else:
+            for currRecord in self.pendingRecords:
+                self.outputFile.write(json.dumps(currRecord) + '\n')
+        self.pendingRecords = []
+        self.outputFile.flush()
+
+    def close(self):
+        if self.outputFile.closed:
+            return
+        self.flush()
+        if self.outputFormat == 'sarif':
+            self.outputFile.write('\n]}]}\n')
+        self.outputFile.close()
+
+
+#
+# List the projects in an organization
+#
+# serverURL is the release management url, 'https://vsrm.dev.azure.com/<org>/', the
+# projects api is on the main 'https://dev.azure.com/<org>/' url.
+#
+# Lists are followed page by page, so organizations and projects with more than
+# $top items are listed in full.
+#
+def listProjects(adoClient, serverURL):
+    collectionURL = serverURL.replace('://vsrm.', '://')
+    return [currProject['name'] for currProject in zoyinc_std_tools.iterAdoItems(adoClient, collectionURL + '_apis/projects?$top=1000&api-version=5.0', prefetch=True)]
+
+
+#
+# List the active releases, or the release definitions, in a project
+#
+# Returns a list of (project name, id, name)
+#
+def listScanItems(adoClient, serverURL, projectName, scanMode):
+    if scanMode == 'definitions':
+        listURL = serverURL + projectName + '/_apis/release/definitions?$top=1000&api-version=5.0'
+    else:
+        listURL = serverURL + projectName + '/_apis/release/releases?statusFilter=active&$top=1000&api-version=5.0'
+    return [(projectName, currItem['id'], currItem['name']) for currItem in zoyinc_std_tools.iterAdoItems(adoClient, listURL, prefetch=True)]
+
+
+#
+# Url of a release
+#
+# Azure DevOps can leave parts of the release out of the response:
+#
+#     expand          = 'none' leaves out the tasks of each deploy step, 'tasks'
+#                       includes them
+#     propertyFilters = Names of the entries in the release's 'properties' to
+#                       include
+#
+# A release that is going to be PUT back must be fetched in full, the PUT replaces
+# the whole release.
+#
+def releaseURLOf(serverURL, projectName, releaseId, expand=None, propertyFilters=None):
+    queryParams = []
+    if expand is not None:
+        queryParams.append('$expand=' + expand)
+    if propertyFilters:
+        queryParams.append('propertyFilters=' + ','.join(propertyFilters))
+    queryParams.append('api-version=5.0')
+    return serverURL + projectName + '/_apis/release/releases/' + str(releaseId) + '?' + '&'.join(queryParams)
+
+
+#
+# Url and phases key of a release, or release definition, for the scan
+#
+# The tasks of the deploy steps are never checked so releases are fetched without
+# them.
+#
+def scanItemURL(serverURL, scanItemDetails, scanMode):
+    projectName, itemId, itemName = scanItemDetails
+    if scanMode == 'definitions':
+        return serverURL + projectName + '/_apis/release/definitions/' + str(itemId) + '?api-version=5.0', 'deployPhases'
+    return releaseURLOf(serverURL, projectName, itemId, expand='none'), 'deployPhasesSnapshot'
+
+
+#
+# Fetch and check a single release, or release definition, for the scan
+#
+def scanItem(adoClient, serverURL, scanItemDetails, scanMode, checkFields='phases', ruleEngine=None):
+    itemURL, phasesKey = scanItemURL(serverURL, scanItemDetails, scanMode)
+    return fetchAndCheckGlobalVars(adoClient, itemURL, phasesKey, checkFields, ruleEngine=ruleEngine)
+
+
+#
+# Check the global variables across all the releases, or release definitions, in
+# one or more projects
+#
+# The listing and checking is done in a pool of scanWorkers threads. If projectNames
+# is None all projects in the organization are scanned.
+#
+# Each item is dealt with as soon as it has been checked, its findings go to
+# findingsWriter, if given, and its report is printed in project and id order as
+# soon as the items before it are done. Only the items that finish ahead of an
+# earlier one are held. With consoleReport False only the summary is printed.
+#
+# Returns the exit code, 1 if any problems were found.
+#
+def scanGlobalVars(adoClient, serverURL, projectNames, scanMode, scanWorkers, findingsWriter=None, consoleReport=True, checkFields='phases', ruleEngine=None):
+
+    scanStart = time.time()
+    if scanMode == 'definitions':
+        itemTypeStr = 'release definition'
+    else:
+        itemTypeStr = 'release'
+
+    print('#')
+    print('# Running Global Pipeline Variables Healthcheck scan')
+    print('# ==================================================')
+    print('# Scanning:                    ' + itemTypeStr + 's')
+    print('# Team foundation server URL:  ' + serverURL)
+    print('# Workers:                     ' + str(scanWorkers))
+    print('# Fields checked:              ' + checkFields)
+    print('# Rules:                       ' + ', '.join(currRule.ruleName for currRule in (ruleEngine or defaultRuleEngine).globalVarRules))
+    if findingsWriter is not None:
+        print('# Findings file:               ' + findingsWriter.outputFilename + ' (' + findingsWriter.outputFormat + ')')
+    print('# Date:                        ' + datetime.now().strftime('%d/%m/%y %H:%M'))
+    print('#')
+
+    scanErrors = []
+    itemsChecked = 0
+    itemsWithProblems = 0
+    problemsByIndex = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=scanWorkers) as scanPool:
+
+        if projectNames is None:
+            projectNames = listProjects(adoClient, serverURL)
+        print('Projects: ' + ', '.join(projectNames))
+
+        #
+        # List what needs to be checked in each project
+        #
+        scanItems = []
+        listFutures = {scanPool.submit(listScanItems, adoClient, serverURL, currProject, scanMode): currProject for currProject in projectNames}
+        for currFuture in concurrent.futures.as_completed(listFutures):
+            try:
+                scanItems.extend(currFuture.result())
+            except zoyinc_std_tools.AdoRequestError as e:
+                scanErrors.append('Could not list the ' + itemTypeStr + 's in project \'' + listFutures[currFuture] + '\': ' + str(e))
+        scanItems.sort()
+        print('Found ' + str(len(scanItems)) + ' ' + itemTypeStr + 's to check')
+        sys.stdout.flush()
+
+        #
+        # Fetch and check them
+        #
+        # finishedReports holds, by position in scanItems, the reports of items that
+        # finished before an earlier item, None for an item that could not be checked.
+        #
+        finishedReports = {}
+        nextReportIndex = 0
+        checkFutures = {scanPool.submit(scanItem, adoClient, serverURL, currItem, scanMode, checkFields, ruleEngine): itemIndex for itemIndex, currItem in enumerate(scanItems)}
+        for currFuture in concurrent.futures.as_completed(checkFutures):
+            itemIndex = checkFutures[currFuture]
+            projectName, itemId, itemName = scanItems[itemIndex]
+            try:
+                reportLines, itemProblemLines, scanFindings = currFuture.result()
+            except zoyinc_std_tools.AdoRequestError as e:
+                scanErrors.append('Could not get ' + itemTypeStr + ' ' + str(itemId) + ' in project \'' + projectName + '\': ' + str(e))
+                finishedReports[itemIndex] = None
+            else:
+                itemsChecked += 1
+                itemHeader = projectName + ' / ' + itemTypeStr + ' ' + str(itemId) + ' (' + itemName + ')'
+                if itemProblemLines:
+                    itemsWithProblems += 1
+                    if consoleReport:
+                        problemsByIndex[itemIndex] = [''] + [itemHeader] + itemProblemLines
+                if findingsWriter is not None:
+                    findingsWriter.writeFindings({'project': projectName,
+                                                  'itemType': itemTypeStr,
+                                                  'itemId': itemId,
+                                                  'itemName': itemName,
+                                                  'itemURL': scanItemURL(serverURL, scanItems[itemIndex], scanMode)[0]}, scanFindings)
+                finishedReports[itemIndex] = (itemHeader, reportLines) if consoleReport else None
+
+            while nextReportIndex in finishedReports:
+                finishedReport = finishedReports.pop(nextReportIndex)
+                nextReportIndex += 1
+                if finishedReport is not None:
+                    print()
+                    print('#')
+                    print('# ' + finishedReport[0])
+                    print('#')
+                    for currLine in finishedReport[1]:
+                        print(currLine)
+            sys.stdout.flush()
+
+    print()
+    print('#')
+    print('# Scan summary')
+    print('# ============')
+    print('# ' + (itemTypeStr.capitalize() + 's checked:').ljust(36) + str(itemsChecked))
+    print('# ' + (itemTypeStr.capitalize() + 's with problems:').ljust(36) + str(itemsWithProblems))
+    print('# ' + 'Fetch errors:'.ljust(36) + str(len(scanErrors)))
+    if findingsWriter is not None:
+        print('# ' + 'Findings written:'.ljust(36) + str(findingsWriter.findingCount))
+    print('# ' + 'Time taken:'.ljust(36) + '%.1f' % (time.time() - scanStart) + 's')
+    print('#')
+
+    if scanErrors:
+        print('##[error]')
+        print('##[error] Some ' + itemTypeStr + 's could not be checked')
+        print('##[error]')
+        for currError in scanErrors:
+            print(currError)
+    if itemsWithProblems:
+        print('##[error]')
+        print('##[error] Errors with the use of global pipeline variables were found')
+        print('##[error]')
+        if consoleReport:
+            print('\n'.join(currLine for itemIndex in sorted(problemsByIndex) for currLine in problemsByIndex[itemIndex]))
+            print()
+        elif findingsWriter is not None:
+            print('See ' + findingsWriter.outputFilename + ' for the ' + str(findingsWriter.problemCount) + ' problems found')
+    sys.stdout.flush()
+
+    if scanErrors or itemsWithProblems:
+        return 1
+    return 0
+
+
+#
+# Check the global variables in a release as it is streamed in
+#
+# Does the same checks as checkReleaseGlobalVars() but works from the events of
+# zoyinc_std_tools.iterJsonEvents(..., indexedPaths=True) so the release is never
+# loaded in full. Only the
+# stage, phase and task names, and the strings that contain global variables, are
+# kept.
+#
+def streamReleaseGlobalVars(jsonEvents, phasesKey='deployPhasesSnapshot', ruleEngine=None, checkFields='phases'):
+    globalVarScan = GlobalVarScan(phasesKey, ruleEngine, checkFields)
+    for fieldPath, currEvent, fieldValue in jsonEvents:
+        if currEvent == 'string':
+            globalVarScan.addString(fieldPath, fieldValue)
+    with zoyinc_std_tools.phaseTimer('validate'):
+        return globalVarScan.finish()
+
+
+#
+# Stream a release, or release definition, from Azure DevOps and check its global
+# variables
+#
+# A release is got through releaseCache, a SharedReleaseCache, if one is given.
+#
+# Raises zoyinc_std_tools.AdoRequestError if the request fails.
+#
+def fetchAndCheckGlobalVars(adoClient, requestURL, phasesKey='deployPhasesSnapshot', checkFields='phases', releaseCache=None, ruleEngine=None):
+    with zoyinc_std_tools.phaseTimer('fetch'):
+        if releaseCache is None:
+            adoResponse = adoClient.get(requestURL, stream=True)
+        else:
+            adoResponse = releaseCache.get(adoClient, requestURL, stream=True)
+    with adoResponse:
+        if adoResponse.status_code != 200:
+            raise zoyinc_std_tools.AdoRequestError(requestURL, adoResponse.status_code, adoResponse.reason)
+        # Reading the body is fetch time, the rest is parse and validate time
+        textChunks = zoyinc_std_tools.timedPhaseIterator(zoyinc_std_tools.iterResponseText(adoResponse), 'fetch')
+        with zoyinc_std_tools.phaseTimer('parse'):
+            return streamReleaseGlobalVars(zoyinc_std_tools.iterJsonEvents(textChunks, indexedPaths=True), phasesKey, ruleEngine, checkFields)
+
+
+#
+# Shared release cache
+# --------------------
+#
+# When the stages of a release run at the same time on one agent host each task
+# would GET the same, often multi-MB, release. SharedReleaseCache keeps the
+# releases in cacheDir, shared by every process on the host, so it is only fetched
+# once:
+#
+#     - A release is only fetched by one process at a time, it holds the release's
+#       lock file while it does so. Processes wanting the same release wait for the
+#       lock and then read what was fetched, rather than fetching it again
+#     - The revision of a cached release is its top level modifiedOn. Before a
+#       cached release is used the current modifiedOn is got from the release list
+#       with releaseIdFilter, a small request, and if the release has changed
+#       since it was cached it is fetched again. With checkRevision=False this is
+#       not done and a cached release is used until it is maxAgeSeconds old
+#     - Releases are dropped once they are maxAgeSeconds old, and the oldest are
+#       dropped when the cache is over maxBytes
+#
+# When nothing is cached for a release it is fetched without the revision request,
+# so a single task makes the one request it always did.
+#
+# Not every change to a release is known to change its modifiedOn, such as a
+# manual intervention being resumed, so the cache is only for reads that can
+# tolerate that, like the health check. processCodeDeployApproval.py, which reads
+# the intervention comment just entered, always fetches the release itself.
+#
+# Only 200 responses are cached. Releases are keyed by the token and url, as in
+# zoyinc_std_tools.AdoResponseCache. Urls that are not of a single release, and
+# releases whose revision can not be got, are fetched as usual.
+#
+# The directory can be given with the ZOYINC_RELEASE_CACHE_DIR environment
+# variable, set once for all the pipelines on an agent.
+#
+sharedReleaseCacheEnv = 'ZOYINC_RELEASE_CACHE_DIR'
+releaseURLPattern = re.compile(r'^(?P<listURL>.*/_apis/release/releases)/(?P<releaseId>\d+)(?:\?|$)')
+
+class SharedReleaseCache:
+
+    def __init__(self, cacheDir, maxAgeSeconds=600, maxBytes=1024 * 1024 * 1024, lockTimeout=300, checkRevision=True):
+        self.cacheDir = cacheDir
+        self.maxAgeSeconds = maxAgeSeconds
+        self.maxBytes = maxBytes
+        self.lockTimeout = lockTimeout
+        self.checkRevision = checkRevision
+        os.makedirs(cacheDir, exist_ok=True)
+        self.statsLock = threading.Lock()
+        self.stats = {'hit': 0, 'waited': 0, 'miss': 0, 'bypassed': 0, 'evicted': 0}
+
+    def countStatus(self, statName, statCount=1):
+        with self.statsLock:
+            self.stats[statName] += statCount
+
+    def entryKey(self, azureToken, releaseURL):
+        keySource = json.dumps([hashlib.sha256(azureToken.encode()).hexdigest(), releaseURL])
+        return hashlib.sha256(keySource.encode()).hexdigest()
+
+    def entryPath(self, entryKey, fileExt):
+        return os.path.join(self.cacheDir, entryKey + fileExt)
+
+    #
+    # modifiedOn of the release, or None if it can not be got
+    #
+    def releaseRevision(self, adoClient, releaseURL):
+        urlMatch = releaseURLPattern.match(releaseURL)
+        if urlMatch is None:
+            return None
+        revisionURL = urlMatch.group('listURL') + '?releaseIdFilter=' + urlMatch.group('releaseId') + '&api-version=5.0'
+        try:
+            listJson = adoClient.getJson(revisionURL)
+        except zoyinc_std_tools.AdoRequestError:
+            return None
+        for currRelease in listJson.get('value', []):
+            if str(currRelease.get('id')) == urlMatch.group('releaseId'):
+                return currRelease.get('modifiedOn')
+        return None
+
+    #
+    # Top level modifiedOn of a release body, or None if it has none
+    #
+    def bodyRevision(self, bodyFilename):
+        try:
+            with open(bodyFilename, 'r', encoding='utf-8', errors='replace') as bodyFile:
+                textChunks = iter(lambda: bodyFile.read(65536), '')
+                for fieldPath, currEvent, fieldValue in zoyinc_std_tools.iterJsonEvents(textChunks, indexedPaths=True):
+                    if (fieldPath == ('modifiedOn',)) and (currEvent == 'string'):
+                        return fieldValue
+        except ValueError:
+            pass
+        return None
+
+    #
+    # Meta of the cached release if it is not too old, or None
+    #
+    def entryMeta(self, entryKey):
+        try:
+            with open(self.entryPath(entryKey, '.json'), 'r') as metaFile:
+                entryMeta = json.load(metaFile)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entryMeta['storedAt'] >= self.maxAgeSeconds:
+            return None
+        return entryMeta
+
+    #
+    # Response from the cached release, or None if it has been evicted
+    #
+    def cachedResponse(self, entryMeta, cacheStatus):
+        try:
+            bodyFile = open(os.path.join(self.cacheDir, entryMeta['bodyFile']), 'rb')
+        except OSError:
+            return None
+        adoResponse = zoyinc_std_tools.AdoResponse(200, 'OK', entryMeta['url'], entryMeta['headers'], bodyFile)
+        adoResponse.cacheStatus = cacheStatus
+        self.countStatus(cacheStatus)
+        return adoResponse
+
+    #
+    # GET a release through the cache
+    #
+    # The response's cacheStatus is 'hit' if it was cached, 'waited' if another
+    # process fetched it while we waited, or 'miss' if we fetched it.
+    #
+    def get(self, adoClient, releaseURL, stream=False):
+        if releaseURLPattern.match(releaseURL) is None:
+            self.countStatus('bypassed')
+            return adoClient.get(releaseURL, stream=stream)
+        getStart = time.time()
+        entryKey = self.entryKey(adoClient.azureToken, releaseURL)
+
+        entryMeta = self.entryMeta(entryKey)
+        if entryMeta is not None:
+            isCurrent = True
+            if self.checkRevision:
+                releaseRevision = self.releaseRevision(adoClient, releaseURL)
+                if releaseRevision is None:
+                    self.countStatus('bypassed')
+                    return adoClient.get(releaseURL, stream=stream)
+                isCurrent = (releaseRevision == entryMeta['revision'])
+            if isCurrent:
+                adoResponse = self.cachedResponse(entryMeta, 'hit')
+                if adoResponse is not None:
+                    return adoResponse
+
+        lockFilename = self.entryPath(entryKey, '.lock')
+        try:
+            with zoyinc_std_tools.FileLock(lockFilename, self.lockTimeout):
+                # Used to tell the lock files still in use from old ones
+                os.utime(lockFilename)
+
+                # Only what another process fetched after we asked is new enough
+                entryMeta = self.entryMeta(entryKey)
+                if (entryMeta is not None) and (entryMeta['storedAt'] >= getStart):
+                    adoResponse = self.cachedResponse(entryMeta, 'waited')
+                    if adoResponse is not None:
+                        return adoResponse
+                return self.fetchRelease(adoClient, releaseURL, entryKey, stream)
+        except TimeoutError:
+            # Whoever has the lock is taking too long, fetch it ourselves
+            self.countStatus('bypassed')
+            return adoClient.get(releaseURL, stream=stream)
+
+    #
+    # Fetch a release into the cache, must be called with the release's lock held
+    #
+    def fetchRelease(self, adoClient, releaseURL, entryKey, stream):
+        adoResponse = adoClient.get(releaseURL, stream=True)
+        if adoResponse.status_code != 200:
+            if not stream:
+                adoResponse.content
+            return adoResponse
+
+        # Each fetch has its own body file so one being read is never replaced
+        bodyName = entryKey + '.' + str(time.time_ns()) + '.body'
+        tempFilename = os.path.join(self.cacheDir, bodyName + '.tmp')
+        bodyBytes = 0
+        with adoResponse, open(tempFilename, 'wb') as bodyFile:
+            for currChunk in adoResponse.iter_content(chunk_size=65536):
+                bodyFile.write(currChunk)
+                bodyBytes += len(currChunk)
+        os.replace(tempFilename, os.path.join(self.cacheDir, bodyName))
+
+        entryMeta = {'url': releaseURL,
+                     'revision': self.bodyRevision(os.path.join(self.cacheDir, bodyName)),
+                     'storedAt': time.time(),
+                     'bodyFile': bodyName,
+                     'bodyBytes': bodyBytes,
+                     'headers': zoyinc_std_tools.cachedHeadersOf(adoResponse)}
+        metaFilename = self.entryPath(entryKey, '.json')
+        try:
+            with open(metaFilename, 'r') as metaFile:
+                oldBodyName = json.load(metaFile)['bodyFile']
+        except (OSError, ValueError, KeyError):
+            oldBodyName = None
+        with open(metaFilename + '.tmp', 'w') as metaFile:
+            json.dump(entryMeta, metaFile)
+        os.replace(metaFilename + '.tmp', metaFilename)
+        if oldBodyName is not None:
+            self.removeFile(os.path.join(self.cacheDir, oldBodyName), True)
+        self.countStatus('miss')
+
+        self.evict(bodyName)
+        cachedResponse = zoyinc_std_tools.AdoResponse(200, 'OK', releaseURL, entryMeta['headers'], open(os.path.join(self.cacheDir, bodyName), 'rb'))
+        cachedResponse.cacheStatus = 'miss'
+        return cachedResponse
+
+    #
+    # Drop the releases that are too old, then the oldest until the cache is under
+    # maxBytes, and the files of releases that are not used any more
+    #
+    # Files other processes have open can not be removed on Windows, they are left
+    # for the next time.
+    #
+    def evict(self, keepBodyName=None):
+        timeNow = time.time()
+        keptBodies = []
+        keptBytes = 0
+        for currEntry in os.scandir(self.cacheDir):
+            try:
+                currStat = currEntry.stat()
+            except OSError:
+                continue
+            fileAge = timeNow - currStat.st_mtime
+            if currEntry.name.endswith('.body'):
+                if (fileAge < self.maxAgeSeconds) or (currEntry.name == keepBodyName):
+                    keptBodies.append((currStat.st_mtime, currEntry.name, currStat.st_size))
+                    keptBytes += currStat.st_size
+                    continue
+            elif currEntry.name.endswith('.json'):
+                if fileAge < self.maxAgeSeconds:
+                    continue
+            elif currEntry.name.endswith(('.lock', '.tmp')):
+                # Lock files, and the temp files of fetches that may still be going
+                if fileAge < self.maxAgeSeconds + self.lockTimeout:
+                    continue
+            else:
+                continue
+            self.removeFile(currEntry.path, currEntry.name.endswith('.body'))
+
+        for currMtime, bodyName, bodySize in sorted(keptBodies):
+            if keptBytes <= self.maxBytes:
+                break
+            if bodyName != keepBodyName:
+                if self.removeFile(os.path.join(self.cacheDir, bodyName), True):
+                    keptBytes -= bodySize
+
+    def removeFile(self, cacheFilename, isBody):
+        try:
+            os.remove(cacheFilename)
+        except OSError:
+            return False
+        if isBody:
+            self.countStatus('evicted')
+        return True
+
+
+#
+# Global variable index
+# ---------------------
+#
+# A SQLite database of where the global variables are used, and the values they
+# have, across every release, so questions like which releases use
+# GLOBALVAR_PRD_MIMSG2, or where DEPLOYAPPROVALOK was FALSE, are answered from the
+# database rather than by fetching every release again.
+#
+#     releases         = One row per release indexed, with its modifiedOn
+#     stages           = The stages of each release
+#     phaseConditions  = The condition of each phase that has one
+#     globalVarRefs    = Each global variable reference found, as in the findings
+#                        of checkReleaseGlobalVars()
+#     globalVarValues  = The value of each GLOBALVAR_ variable, release scoped or
+#                        stage scoped, secrets are indexed without their value
+#
+# Variable names are held in upper case, variableRef is the full name,
+# 'GLOBALVAR_PRD_MIMSG2', variableStage and variableName its parts, 'PRD' and
+# 'MIMSG2'.
+#
+# Ingesting is incremental, a release already in the index is only fetched again
+# if its modifiedOn has changed. The rows are written batchSize releases at a time,
+# each batch in one transaction.
+#
+globalVarIndexSchema = '''
+CREATE TABLE IF NOT EXISTS releases (
+    releaseKey      INTEGER PRIMARY KEY,
+    serverURL       TEXT NOT NULL,
+    project         TEXT NOT NULL,
+    releaseId       INTEGER NOT NULL,
+    releaseName     TEXT,
+    definitionName  TEXT,
+    status          TEXT,
+    createdOn       TEXT,
+    modifiedOn      TEXT,
+    indexedOn       TEXT,
+    UNIQUE (serverURL, project, releaseId)
+);
+CREATE TABLE IF NOT EXISTS stages (
+    releaseKey      INTEGER NOT NULL,
+    stageIndex      INTEGER,
+    stageName       TEXT,
+    basicStageName  TEXT,
+    status          TEXT
+);
+CREATE TABLE IF NOT EXISTS phaseConditions (
+    releaseKey      INTEGER NOT NULL,
+    stageName       TEXT,
+    phaseName       TEXT,
+    phaseCondition  TEXT
+);
+CREATE TABLE IF NOT EXISTS globalVarRefs (
+    releaseKey      INTEGER NOT NULL,
+    variableRef     TEXT,
+    variableStage   TEXT,
+    variableName    TEXT,
+    ruleName        TEXT,
+    status          TEXT,
+    fieldPath       TEXT,
+    stageName       TEXT,
+    phaseName       TEXT,
+    taskName        TEXT
+);
+CREATE TABLE IF NOT EXISTS globalVarValues (
+    releaseKey      INTEGER NOT NULL,
+    scope           TEXT,
+    variableRef     TEXT,
+    variableStage   TEXT,
+    variableName    TEXT,
+    value           TEXT,
+    isSecret        INTEGER
+);
+CREATE INDEX IF NOT EXISTS stagesByRelease ON stages (releaseKey);
+CREATE INDEX IF NOT EXISTS stagesByName ON stages (basicStageName);
+CREATE INDEX IF NOT EXISTS phaseConditionsByRelease ON phaseConditions (releaseKey);
+CREATE INDEX IF NOT EXISTS globalVarRefsByRelease ON globalVarRefs (releaseKey);
+CREATE INDEX IF NOT EXISTS globalVarRefsByRef ON globalVarRefs (variableRef);
+CREATE INDEX IF NOT EXISTS globalVarRefsByName ON globalVarRefs (variableName);
+CREATE INDEX IF NOT EXISTS globalVarValuesByRelease ON globalVarValues (releaseKey);
+CREATE INDEX IF NOT EXISTS globalVarValuesByRef ON globalVarValues (variableRef, value);
+CREATE INDEX IF NOT EXISTS globalVarValuesByName ON globalVarValues (variableName, value);
+'''
+
+globalVarIndexChildTables = ['stages', 'phaseConditions', 'globalVarRefs', 'globalVarValues']
+
+
+#
+# Full name of a global variable, and its stage and name parts, in upper case
+#
+def globalVarNameParts(variableStr):
+    varParts = globalVarPartsPattern.search(variableStr)
+    variableRef = varParts.group(0).upper()
+    variableStage = (varParts.group('stage') or '').upper() or None
+    return variableRef, variableStage, varParts.group('name').upper()
+
+
+#
+# The index rows of a release, by table, without the releaseKey
+#
+def globalVarIndexRowsOf(releaseDetail):
+    indexRows = {currTable: [] for currTable in globalVarIndexChildTables}
+
+    reportLines, problemLines, scanFindings = checkReleaseGlobalVars(releaseDetail)
+    for currFinding in scanFindings:
+        variableRef, variableStage, variableName = globalVarNameParts(currFinding.matchText)
+        indexRows['globalVarRefs'].append((variableRef, variableStage, variableName, currFinding.ruleName, currFinding.status,
+                                           currFinding.fieldPath, currFinding.stageName, currFinding.phaseName, currFinding.taskName))
+
+    variableScopes = [('release', releaseDetail.get('variables') or {})]
+    for stageIndex, currStage in enumerate(releaseDetail.get('environments') or []):
+        indexRows['stages'].append((stageIndex, currStage.get('name'), basicStageNameOf(currStage.get('name') or ''), currStage.get('status')))
+        for currPhase in currStage.get('deployPhasesSnapshot') or []:
+            phaseCondition = (currPhase.get('deploymentInput') or {}).get('condition')
+            if phaseCondition:
+                indexRows['phaseConditions'].append((currStage.get('name'), currPhase.get('name'), phaseCondition))
+        variableScopes.append((currStage.get('name'), currStage.get('variables') or {}))
+
+    for variableScope, scopeVariables in variableScopes:
+        for currVarName, currVariable in scopeVariables.items():
+            if not currVarName.upper().startswith(globalVarPrefix):
+                continue
+            variableRef, variableStage, variableName = globalVarNameParts(currVarName)
+            isSecret = bool((currVariable or {}).get('isSecret'))
+            variableValue = None if isSecret else (currVariable or {}).get('value')
+            indexRows['globalVarValues'].append((variableScope, variableRef, variableStage, variableName, variableValue, int(isSecret)))
+
+    return indexRows
+
+
+class GlobalVarIndex:
+
+    def __init__(self, databaseFilename):
+        # Only the scripts that use the index load sqlite3
+        import sqlite3
+        self.databaseFilename = databaseFilename
+        self.indexDb = sqlite3.connect(databaseFilename)
+        self.indexDb.execute('PRAGMA journal_mode=WAL')
+        self.indexDb.execute('PRAGMA synchronous=NORMAL')
+        self.indexDb.executescript(globalVarIndexSchema)
+
+    #
+    # releaseId: (releaseKey, modifiedOn) of the releases of a project in the index
+    #
+    def indexedReleases(self, serverURL, projectName):
+        indexedRows = self.indexDb.execute('SELECT releaseId, releaseKey, modifiedOn FROM releases WHERE serverURL = ? AND project = ?', (serverURL, projectName))
+        return {releaseId: (releaseKey, modifiedOn) for releaseId, releaseKey, modifiedOn in indexedRows}
+
+    #
+    # Write a batch of releases, a list of (serverURL, project, releaseDetail,
+    # indexRows), in one transaction. Releases already in the index are replaced.
+    #
+    def writeBatch(self, releaseBatch):
+        indexedOn = datetime.now().isoformat(timespec='seconds')
+        with self.indexDb:
+            childRows = {currTable: [] for currTable in globalVarIndexChildTables}
+            for serverURL, projectName, releaseDetail, indexRows in releaseBatch:
+                releaseKeyRow = self.indexDb.execute('SELECT releaseKey FROM releases WHERE serverURL = ? AND project = ? AND releaseId = ?',
+                                                     (serverURL, projectName, releaseDetail['id'])).fetchone()
+                releaseValues = (releaseDetail.get('name'), (releaseDetail.get('releaseDefinition') or {}).get('name'), releaseDetail.get('status'),
+                                 releaseDetail.get('createdOn'), releaseDetail.get('modifiedOn'), indexedOn)
+                if releaseKeyRow is None:
+                    releaseKey = self.indexDb.execute('INSERT INTO releases (serverURL, project, releaseId, releaseName, definitionName, status, createdOn, modifiedOn, indexedOn) '
+                                                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (serverURL, projectName, releaseDetail['id']) + releaseValues).lastrowid
+                else:
+                    releaseKey = releaseKeyRow[0]
+                    self.indexDb.execute('UPDATE releases SET releaseName = ?, definitionName = ?, status = ?, createdOn = ?, modifiedOn = ?, indexedOn = ? '
+                                         'WHERE releaseKey = ?', releaseValues + (releaseKey,))
+                for currTable in globalVarIndexChildTables:
+                    self.indexDb.execute('DELETE FROM ' + currTable + ' WHERE releaseKey = ?', (releaseKey,))
+                    childRows[currTable].extend((releaseKey,) + currRow for currRow in indexRows[currTable])
+            for currTable in globalVarIndexChildTables:
+                if childRows[currTable]:
+                    columnCount = len(childRows[currTable][0])
+                    self.indexDb.executemany('INSERT INTO ' + currTable + ' VALUES (' + ', '.join(['?'] * columnCount) + ')', childRows[currTable])
+
+    #
+    # Run a query, returns (column names, rows)
+    #
+    def query(self, querySql, queryParams=()):
+        queryCursor = self.indexDb.execute(querySql, queryParams)
+        return [currColumn[0] for currColumn in queryCursor.description or []], queryCursor.fetchall()
+
+    #
+    # Where clause for a variable, the full 'GLOBALVAR_PRD_MIMSG2' or just the name
+    # 'MIMSG2', '%' can be used as a wildcard
+    #
+    def variableWhere(self, variableStr):
+        variableStr = variableStr.upper()
+        columnName = 'variableRef' if variableStr.startswith(globalVarPrefix) else 'variableName'
+        if '%' in variableStr:
+            return columnName + ' LIKE ?', variableStr
+        return columnName + ' = ?', variableStr
+
+    #
+    # Releases and stages that reference a variable
+    #
+    def findReferences(self, variableStr=None, stageName=None, status=None):
+        whereParts = []
+        queryParams = []
+        if variableStr:
+            whereStr, whereParam = self.variableWhere(variableStr)
+            whereParts.append('g.' + whereStr)
+            queryParams.append(whereParam)
+        if stageName:
+            whereParts.append('g.stageName = ? COLLATE NOCASE')
+            queryParams.append(stageName)
+        if status:
+            whereParts.append('g.status = ?')
+            queryParams.append(status)
+        return self.query('SELECT r.project, r.releaseId, r.releaseName, g.stageName, g.phaseName, g.taskName, g.fieldPath, g.variableRef, g.ruleName, g.status '
+                          'FROM globalVarRefs g JOIN releases r ON r.releaseKey = g.releaseKey' +
+                          (' WHERE ' + ' AND '.join(whereParts) if whereParts else '') +
+                          ' ORDER BY r.project, r.releaseId, g.stageName, g.phaseName, g.fieldPath', queryParams)
+
+    #
+    # Values a variable had, or only where it had variableValue
+    #
+    def findValues(self, variableStr, variableValue=None):
+        whereStr, whereParam = self.variableWhere(variableStr)
+        queryParams = [whereParam]
+        valueWhere = ''
+        if variableValue is not None:
+            valueWhere = ' AND v.value = ? COLLATE NOCASE'
+            queryParams.append(variableValue)
+        return self.query('SELECT r.project, r.releaseId, r.releaseName, v.scope, v.variableRef, v.value, r.modifiedOn '
+                          'FROM globalVarValues v JOIN releases r ON r.releaseKey = v.releaseKey '
+                          'WHERE v.' + whereStr + valueWhere + ' ORDER BY r.project, r.releaseId, v.scope', queryParams)
+
+    def close(self):
+        self.indexDb.close()
+
+
+#
+# List the releases of a project for the index, returns a list of (project name,
+# id, name, modifiedOn)
+#
+def listIndexReleases(adoClient, serverURL, projectName, activeOnly=False):
+    listURL = serverURL + projectName + '/_apis/release/releases?' + ('statusFilter=active&' if activeOnly else '') + '$top=1000&api-version=5.0'
+    return [(projectName, currItem['id'], currItem['name'], currItem.get('modifiedOn'))
+            for currItem in zoyinc_std_tools.iterAdoItems(adoClient, listURL, prefetch=True)]
+
+
+#
+# Fetch a release and build its index rows, run in the ingest pool
+#
+def fetchIndexRows(adoClient, serverURL, projectName, releaseId):
+    releaseDetail = adoClient.getJson(releaseURLOf(serverURL, projectName, releaseId, expand='none'))
+    return releaseDetail, globalVarIndexRowsOf(releaseDetail)
+
+
+#
+# Add the releases of one or more projects to the index
+#
+# Releases are listed, and those that are new or have been modified since they were
+# indexed are fetched in a pool of ingestWorkers threads. The rows are written here,
+# batchSize releases to a transaction. Where the release list has no modifiedOn only
+# the releases not in the index are fetched. With reindex every release is fetched.
+#
+# Returns the exit code, 1 if any releases could not be indexed.
+#
+def ingestGlobalVarIndex(adoClient, serverURL, projectNames, globalVarIndex, ingestWorkers, activeOnly=False, reindex=False, batchSize=200):
+
+    ingestStart = time.time()
+    print('#')
+    print('# Indexing global pipeline variables')
+    print('# ==================================')
+    print('# Index:                       ' + globalVarIndex.databaseFilename)
+    print('# Team foundation server URL:  ' + serverURL)
+    print('# Workers:                     ' + str(ingestWorkers))
+    print('# Releases:                    ' + ('active' if activeOnly else 'all'))
+    print('# Date:                        ' + datetime.now().strftime('%d/%m/%y %H:%M'))
+    print('#')
+
+    ingestErrors = []
+    releasesIndexed = 0
+    releasesUnchanged = 0
+    releaseBatch = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ingestWorkers) as ingestPool:
+
+        if projectNames is None:
+            projectNames = listProjects(adoClient, serverURL)
+        print('Projects: ' + ', '.join(projectNames))
+
+        #
+        # List the releases and work out which need fetching
+        #
+        fetchItems = []
+        listFutures = {ingestPool.submit(listIndexReleases, adoClient, serverURL, currProject, activeOnly): currProject for currProject in projectNames}
+        for currFuture in concurrent.futures.as_completed(listFutures):
+            projectName = listFutures[currFuture]
+            try:
+                projectReleases = currFuture.result()
+            except zoyinc_std_tools.AdoRequestError as e:
+                ingestErrors.append('Could not list the releases in project \'' + projectName + '\': ' + str(e))
+                continue
+            indexedReleases = globalVarIndex.indexedReleases(serverURL, projectName)
+            for currProject, releaseId, releaseName, modifiedOn in projectReleases:
+                if (not reindex) and (releaseId in indexedReleases) and ((modifiedOn is None) or (modifiedOn == indexedReleases[releaseId][1])):
+                    releasesUnchanged += 1
+                else:
+                    fetchItems.append((currProject, releaseId))
+        fetchItems.sort()
+        print('Found ' + str(len(fetchItems)) + ' new or modified releases to index, ' + str(releasesUnchanged) + ' unchanged')
+        sys.stdout.flush()
+
+        #
+        # Fetch them and write the rows in batches
+        #
+        fetchFutures = {ingestPool.submit(fetchIndexRows, adoClient, serverURL, projectName, releaseId): (projectName, releaseId) for projectName, releaseId in fetchItems}
+        for currFuture in concurrent.futures.as_completed(fetchFutures):
+            projectName, releaseId = fetchFutures[currFuture]
+            try:
+                releaseDetail, indexRows = currFuture.result()
+            except zoyinc_std_tools.AdoRequestError as e:
+                ingestErrors.append('Could not get release ' + str(releaseId) + ' in project \'' + projectName + '\': ' + str(e))
+                continue
+            releaseBatch.append((serverURL, projectName, releaseDetail, indexRows))
+            if len(releaseBatch) >= batchSize:
+                globalVarIndex.writeBatch(releaseBatch)
+                releasesIndexed += len(releaseBatch)
+                releaseBatch = []
+                print('Indexed ' + str(releasesIndexed) + ' of ' + str(len(fetchItems)) + ' releases')
+                sys.stdout.flush()
+
+    if releaseBatch:
+        globalVarIndex.writeBatch(releaseBatch)
+        releasesIndexed += len(releaseBatch)
+
+    print()
+    print('#')
+    print('# Index summary')
+    print('# =============')
+    print('# ' + 'Releases indexed:'.ljust(36) + str(releasesIndexed))
+    print('# ' + 'Releases unchanged:'.ljust(36) + str(releasesUnchanged))
+    print('# ' + 'Fetch errors:'.ljust(36) + str(len(ingestErrors)))
+    print('# ' + 'Time taken:'.ljust(36) + '%.1f' % (time.time() - ingestStart) + 's')
+    print('#')
+
+    if ingestErrors:
+        print('##[error]')
+        print('##[error] Some releases could not be indexed')
+        print('##[error]')
+        for currError in ingestErrors:
+            print(currError)
+        sys.stdout.flush()
+        return 1
+    sys.stdout.flush()
+    return 0
+
+
+#
+# Release variable updates
+# ------------------------
+#
+# Release scoped variables can only be changed with the "Releases - Update Release"
+# api, which is a complete replace of the release. If another process has updated the
+# release since we got our copy Azure rejects the PUT with:
+#
+#    You are using an old copy of release. Refresh your copy and try again.
+#
+# updateReleaseVariables() uses the release the caller already has for the first
+# PUT. Only if there is a conflict does it get the release again, after an
+# exponential backoff with jitter, and apply our variables to the new copy.
+#
+oldCopyOfReleaseStr = 'USING AN OLD COPY OF RELEASE'
+jsonRequestHeaders = {"Content-Type" : "application/json"}
+
+#
+# Raised when the release variables could not be updated
+#
+class ReleaseUpdateError(Exception):
+
+    def __init__(self, errorMsg, requestURL, statusCode=None, reason=None, responseMsg=None, content=None):
+        self.requestURL = requestURL
+        self.statusCode = statusCode
+        self.reason = reason
+        self.responseMsg = responseMsg
+        self.content = content
+        self.updateMessages = []
+        super().__init__(errorMsg)
+
+
+#
+# Copy of a release with the variables changed
+#
+# Only the top level of the release and the 'variables' are copied, everything else
+# is shared with the original, which is not changed. Existing variables keep their
+# other settings, such as 'isSecret', just the value is changed.
+#
+def withReleaseVariables(releaseDetail, newVariables):
+    putReleaseDetail = dict(releaseDetail)
+    putVariables = dict(releaseDetail.get('variables') or {})
+    for envVarItem, envVarVal in newVariables.items():
+        putVariables[envVarItem] = dict(putVariables.get(envVarItem) or {}, value=envVarVal)
+    putReleaseDetail['variables'] = putVariables
+    return putReleaseDetail
+
+
+#
+# Seconds to wait before the next attempt, doubles each attempt up to maxDelay
+# with half of it random so competing processes do not retry in step
+#
+def backoffDelay(attemptNumber, baseDelay, maxDelay):
+    expDelay = min(maxDelay, baseDelay * (2 ** (attemptNumber - 1)))
+    return (expDelay / 2) + random.uniform(0, expDelay / 2)
+
+
+#
+# Update release variables
+#
+# releaseDetail is the release as already fetched, newVariables is a dict of
+# variable name: value.
+#
+# Returns the updated release as returned by Azure. Only a conflict with another
+# update of the release is retried. Raises ReleaseUpdateError for any other error,
+# or if there is still a conflict after maxAttempts.
+#
+# The retries are printed as they happen, or if updateMessages is a list they are
+# added to it instead, for callers whose output is not this thread's stdout.
+#
+def updateReleaseVariables(adoClient, releaseURL, releaseDetail, newVariables, maxAttempts=5, baseDelay=1.0, maxDelay=30.0, updateMessages=None):
+
+    for attemptNumber in range(1, maxAttempts + 1):
+
+        putReleaseDetail = withReleaseVariables(releaseDetail, newVariables)
+        adoResponse = adoClient.put(releaseURL, requestData=json.dumps(putReleaseDetail), requestHeaders=jsonRequestHeaders)
+        if adoResponse.status_code == 200:
+            return json.loads(adoResponse.content)
+
+        #
+        # Get "message" from Azure
+        #
+        # This is different from the HTTP error. The Azure "message" is a dictionary
+        # item in the JSON response. A conflict is a HTTP 400 error with a JSON
+        # response whose message says we are using an old copy of the release, or a
+        # HTTP 409. Only a conflict is worth retrying, anything else is raised straight
+        # away.
+        #
+        responseMsg = None
+        try:
+            responseMsg = json.loads(adoResponse.content)['message']
+        except ValueError:
+            if adoResponse.status_code != 409:
+                raise ReleaseUpdateError('No JSON response received - some other error type.', releaseURL, adoResponse.status_code, adoResponse.reason, None, adoResponse.content)
+        except (KeyError, TypeError):
+            if adoResponse.status_code != 409:
+                raise ReleaseUpdateError('JSON response received but no dictionary \'message\' item was found.', releaseURL, adoResponse.status_code, adoResponse.reason, None, adoResponse.content)
+
+        isConflict = (adoResponse.status_code == 409) or (str(responseMsg).upper().find(oldCopyOfReleaseStr) != -1)
+        if not isConflict:
+            raise ReleaseUpdateError('Update of the release variables failed with an unexpected error.', releaseURL, adoResponse.status_code, adoResponse.reason, responseMsg, adoResponse.content)
+
+        if attemptNumber == maxAttempts:
+            raise ReleaseUpdateError('Could not update the release variables after ' + str(maxAttempts) + ' attempts.', releaseURL, adoResponse.status_code, adoResponse.reason, responseMsg, adoResponse.content)
+
+        retryMessage = '# update of global property failed because of another process is also updating the release definition. We will try again.'
+        if updateMessages is None:
+            print(retryMessage)
+            sys.stdout.flush()
+        else:
+            updateMessages.append(retryMessage)
+        time.sleep(backoffDelay(attemptNumber, baseDelay, maxDelay))
+
+        #
+        # Our copy is out of date so get the release again, our variables are
+        # applied to it at the top of the loop
+        #
+        try:
+            releaseDetail = adoClient.getJson(releaseURL)
+        except zoyinc_std_tools.AdoRequestError as e:
+            raise ReleaseUpdateError('Could not get the latest copy of the release.', releaseURL, e.statusCode, e.reason, None, e.content)
+
+
+#
+# Write-behind queue for release variable updates
+# -----------------------------------------------
+#
+# When several tasks set variables on the same release at about the same time each
+# doing its own GET and PUT means more PUTs, and more "old copy of release"
+# conflicts for them to retry. ReleaseWriteQueue holds the variables written to each
+# release for up to windowSeconds, later writes of a variable replacing earlier
+# ones, then does one updateReleaseVariables() for all of them.
+#
+# submit() returns a concurrent.futures.Future for the write, its result is
+# (updated release, update messages) or the ReleaseUpdateError once the batch it is
+# in has been written. Batches are written on a timer thread so nothing is printed,
+# the messages, such as retries, are given to each write to print in its own
+# output. flush() writes a release, or all releases, without waiting for the
+# window.
+#
+# Writes to the same release are done one batch at a time, so a later batch can not
+# be overwritten by an earlier one that had to retry. A release's lock is only kept
+# while it has a batch being written or waiting to be.
+#
+class PendingReleaseWrite:
+
+    def __init__(self, adoClient, releaseURL, releaseDetail):
+        self.adoClient = adoClient
+        self.releaseURL = releaseURL
+        self.releaseDetail = releaseDetail
+        self.newVariables = {}
+        self.writeFutures = []
+        self.flushTimer = None
+
+
+class ReleaseWriteQueue:
+
+    def __init__(self, windowSeconds=0.5, maxAttempts=5):
+        self.windowSeconds = windowSeconds
+        self.maxAttempts = maxAttempts
+        self.pendingWrites = {}
+        self.releaseLocks = {}
+        self.queueLock = threading.Lock()
+        self.stats = {'writes': 0, 'batches': 0, 'failedBatches': 0}
+
+    #
+    # Queue variables to be written to a release
+    #
+    # releaseDetail is the copy of the release the caller already has, if any, the
+    # newest copy given for the batch is used for its first PUT.
+    #
+    def submit(self, adoClient, releaseURL, newVariables, releaseDetail=None):
+        writeKey = (adoClient, releaseURL)
+        writeFuture = concurrent.futures.Future()
+        with self.queueLock:
+            pendingWrite = self.pendingWrites.get(writeKey)
+            if pendingWrite is None:
+                pendingWrite = PendingReleaseWrite(adoClient, releaseURL, releaseDetail)
+                self.pendingWrites[writeKey] = pendingWrite
+                pendingWrite.flushTimer = threading.Timer(self.windowSeconds, self.flushPending, args=(pendingWrite,))
+                pendingWrite.flushTimer.daemon = True
+                pendingWrite.flushTimer.start()
+            elif releaseDetail is not None:
+                pendingWrite.releaseDetail = releaseDetail
+            pendingWrite.newVariables.update(newVariables)
+            pendingWrite.writeFutures.append(writeFuture)
+            self.stats['writes'] += 1
+        return writeFuture
+
+    #
+    # Write the pending variables of one release, or of all releases if releaseURL
+    # is None, adoClient None matches any client
+    #
+    def flush(self, adoClient=None, releaseURL=None):
+        with self.queueLock:
+            flushWrites = [currWrite for currWrite in self.pendingWrites.values()
+                           if (releaseURL is None) or ((currWrite.releaseURL == releaseURL) and (adoClient in (None, currWrite.adoClient)))]
+        for pendingWrite in flushWrites:
+            self.flushPending(pendingWrite)
+
+    def flushPending(self, pendingWrite):
+        writeKey = (pendingWrite.adoClient, pendingWrite.releaseURL)
+        with self.queueLock:
+            # Already written by an earlier flush
+            if self.pendingWrites.get(writeKey) is not pendingWrite:
+                return
+            del self.pendingWrites[writeKey]
+            # [lock, number of batches using it]
+            releaseLock = self.releaseLocks.setdefault(writeKey, [threading.Lock(), 0])
+            releaseLock[1] += 1
+        pendingWrite.flushTimer.cancel()
+
+        updateMessages = []
+        try:
+            with releaseLock[0]:
+                releaseDetail = pendingWrite.releaseDetail
+                if releaseDetail is None:
+                    try:
+                        releaseDetail = pendingWrite.adoClient.getJson(pendingWrite.releaseURL)
+                    except zoyinc_std_tools.AdoRequestError as e:
+                        raise ReleaseUpdateError('Could not get the release.', pendingWrite.releaseURL, e.statusCode, e.reason, None, e.content)
+                updatedRelease = updateReleaseVariables(pendingWrite.adoClient, pendingWrite.releaseURL, releaseDetail, pendingWrite.newVariables,
+                                                        maxAttempts=self.maxAttempts, updateMessages=updateMessages)
+        except Exception as e:
+            if isinstance(e, ReleaseUpdateError):
+                e.updateMessages = updateMessages
+            with self.queueLock:
+                self.stats['batches'] += 1
+                self.stats['failedBatches'] += 1
+            for writeFuture in pendingWrite.writeFutures:
+                writeFuture.set_exception(e)
+            return
+        finally:
+            with self.queueLock:
+                releaseLock[1] -= 1
+                if releaseLock[1] == 0:
+                    del self.releaseLocks[writeKey]
+        with self.queueLock:
+            self.stats['batches'] += 1
+        for writeFuture in pendingWrite.writeFutures:
+            writeFuture.set_result((updatedRelease, updateMessages))
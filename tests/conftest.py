@@ -0,0 +1,31 @@
+#
+# Test set up
+# ===========
+#
+# The scripts are not a package, each directory is put on the path the same way the
+# scripts themselves find zoyinc_std_tools.
+#
+
+import os
+import sys
+
+import pytest
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for scriptDir in ['ADO Process Tools', 'Persisting Azure Pipeline Variables', 'Benchmarks']:
+    sys.path.insert(0, os.path.join(repoDir, scriptDir))
+
+import fake_ado_server
+
+
+#
+# Fake Azure DevOps server, see Benchmarks/fake_ado_server.py, started for each test
+#
+# Faults are injected by setting them on the server, such as conflictPuts, and the
+# synthetic data changed through its releaseShape.
+#
+@pytest.fixture
+def fakeAdoServer():
+    adoServer = fake_ado_server.FakeAdoServer().start()
+    yield adoServer
+    adoServer.stop()
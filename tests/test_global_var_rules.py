@@ -0,0 +1,103 @@
+#
+# GlobalVarRuleEngine and the global variable checks of a release
+#
+
+import json
+
+import zoyinc_std_tools
+import zoyinc_release_tools
+
+#
+# A release with one stage, 'Prod (East)', whose global variables should have the
+# stage name 'PRODEAST'
+#
+sampleRelease = {
+    'name': 'Release-7',
+    'description': 'Uses $(GLOBALVAR_PRODEAST_OUTSIDE)',
+    'environments': [{
+        'name': 'Prod (East)',
+        'variables': {'NOTE': {'value': '$(GLOBALVAR_DEV_STAGEVAR)'}},
+        'deploySteps': [{'comment': '$(GLOBALVAR_DEV_HISTORY)'}],
+        'deployPhasesSnapshot': [{
+            'name': 'Agent job',
+            'deploymentInput': {'condition': "and(succeeded(), eq(variables['GLOBALVAR_PRODEAST_DEPLOYAPPROVALOK'], 'TRUE'))"},
+            'workflowTasks': [{
+                'name': 'Run script',
+                'inputs': {'script': 'echo $(GLOBALVAR_PRODEAST_A) $(GLOBALVAR_DEV_B) $(GLOBALVAR_NOSTAGE)\n'
+                                     'echo $GLOBALVAR_DEV_ENV ${GLOBALVAR_PRODEAST_ENV2} %GLOBALVAR_PRODEAST_ENV3%\n'
+                                     'if variables.GLOBALVAR_DEV_EXPR'},
+            }, {
+                'name': 'Approval',
+                'inputs': {'instructions': 'Approve with $(GLOBALVAR_PRODEAST_MIMSG2)'},
+            }],
+        }],
+    }],
+}
+
+
+def findingsOf(releaseDetail, **checkArgs):
+    reportLines, problemLines, scanFindings = zoyinc_release_tools.checkReleaseGlobalVars(releaseDetail, **checkArgs)
+    return [(currFinding.ruleName, currFinding.status, currFinding.foundStageName, currFinding.variableName) for currFinding in scanFindings]
+
+
+def testDefaultRulesInThePhases():
+    assert findingsOf(sampleRelease) == [('condition', 'ok', 'PRODEAST', 'DEPLOYAPPROVALOK'),
+                                         ('macro', 'ok', 'PRODEAST', 'A'),
+                                         ('macro', 'error', 'DEV', 'B'),
+                                         ('macro', 'error', None, 'NOSTAGE'),
+                                         ('macro', 'ok', 'PRODEAST', 'MIMSG2')]
+
+
+def testExtraRules():
+    ruleEngine = zoyinc_release_tools.ruleEngineFor(['envvar', 'expression'])
+    scriptFindings = [currFinding for currFinding in findingsOf(sampleRelease, ruleEngine=ruleEngine) if currFinding[0] in zoyinc_release_tools.optionalRuleNames]
+    assert scriptFindings == [('envvar', 'error', 'DEV', 'ENV'),
+                              ('envvar', 'ok', 'PRODEAST', 'ENV2'),
+                              ('envvar', 'ok', 'PRODEAST', 'ENV3'),
+                              ('expression', 'error', 'DEV', 'EXPR')]
+    # Only the rules asked for
+    envRuleEngine = zoyinc_release_tools.ruleEngineFor(['envvar'])
+    assert 'expression' not in [currFinding[0] for currFinding in findingsOf(sampleRelease, ruleEngine=envRuleEngine)]
+    assert zoyinc_release_tools.ruleEngineFor([]) is zoyinc_release_tools.defaultRuleEngine
+
+
+def testAllFields():
+    allFindings = findingsOf(sampleRelease, checkFields='all')
+    # The stage variable is checked against its stage, the deploy history is skipped,
+    # and the description is outside of any stage
+    assert ('macro', 'error', 'DEV', 'STAGEVAR') in allFindings
+    assert 'HISTORY' not in [currFinding[3] for currFinding in allFindings]
+    assert allFindings[-1] == ('macro', 'unchecked', 'PRODEAST', 'OUTSIDE')
+    assert len(allFindings) == len(findingsOf(sampleRelease)) + 2
+
+
+def testConditionRuleOnlyInConditions():
+    ruleEngine = zoyinc_release_tools.GlobalVarRuleEngine()
+    quotedText = "eq(variables['GLOBALVAR_PRD_X'], 'TRUE')"
+    assert [currRule.ruleName for currRule, currMatch in ruleEngine.findReferences('environments[0].deployPhasesSnapshot[0].deploymentInput.condition', quotedText)] == ['condition']
+    assert ruleEngine.findReferences('environments[0].deployPhasesSnapshot[0].workflowTasks[0].inputs.script', quotedText) == []
+
+
+def testReferencesFoundInOrder():
+    ruleEngine = zoyinc_release_tools.GlobalVarRuleEngine()
+    fieldValue = '$(GLOBALVAR_PRD_FIRST_NAME)x$(GLOBALVAR_PRD_SECOND) $(globalvar_prd_third)'
+    foundMatches = [currMatch.group() for currRule, currMatch in ruleEngine.findReferences('field', fieldValue)]
+    assert foundMatches == ['$(GLOBALVAR_PRD_FIRST_NAME)', '$(GLOBALVAR_PRD_SECOND)', '$(globalvar_prd_third)']
+    assert not ruleEngine.mayReference('$(SOMETHING_ELSE)')
+
+
+def testProblemLines():
+    reportLines, problemLines, scanFindings = zoyinc_release_tools.checkReleaseGlobalVars(sampleRelease)
+    assert problemLines[0].startswith('$(GLOBALVAR_DEV_B) - ERROR')
+    assert 'different from the expected stage name \'PRODEAST\'' in problemLines[1]
+    assert 'Found global variable/s in phase conditions' in reportLines
+
+
+def testStreamedCheckMatches():
+    releaseText = json.dumps(sampleRelease)
+    for checkFields in zoyinc_release_tools.checkFieldsChoices:
+        textChunks = [releaseText[chunkStart:chunkStart + 10] for chunkStart in range(0, len(releaseText), 10)]
+        streamedResult = zoyinc_release_tools.streamReleaseGlobalVars(zoyinc_std_tools.iterJsonEvents(textChunks, indexedPaths=True), checkFields=checkFields)
+        loadedResult = zoyinc_release_tools.checkReleaseGlobalVars(sampleRelease, checkFields=checkFields)
+        assert streamedResult[:2] == loadedResult[:2]
+        assert [currFinding.asDict() for currFinding in streamedResult[2]] == [currFinding.asDict() for currFinding in loadedResult[2]]
@@ -0,0 +1,90 @@
+#
+# iterJsonEvents(), the incremental JSON parser
+#
+
+import json
+
+import pytest
+
+import zoyinc_std_tools
+
+sampleDocument = {'name': 'Release-1',
+                  'environments': [{'name': 'PRD', 'rank': 1, 'conditions': []},
+                                   {'name': 'STG', 'rank': -2.5e3, 'ok': True, 'owner': None}],
+                  'quoted': 'say "hi"\\ \n\t/ café \U0001f600',
+                  'empty': {}}
+
+
+#
+# Build the value back up from the events, with indexedPaths
+#
+def valueOfEvents(jsonEvents):
+    valueStack = []
+    keyStack = []
+    rootValue = None
+    for eventPath, currEvent, eventValue in jsonEvents:
+        if currEvent == 'map_key':
+            keyStack[-1] = eventValue
+            continue
+        if currEvent in ['end_map', 'end_array']:
+            valueStack.pop()
+            keyStack.pop()
+            continue
+        if currEvent == 'start_map':
+            newValue = {}
+        elif currEvent == 'start_array':
+            newValue = []
+        else:
+            newValue = eventValue
+        if not valueStack:
+            rootValue = newValue
+        elif isinstance(valueStack[-1], list):
+            assert eventPath[-1] == len(valueStack[-1])
+            valueStack[-1].append(newValue)
+        else:
+            assert eventPath[-1] == keyStack[-1]
+            valueStack[-1][keyStack[-1]] = newValue
+        if currEvent in ['start_map', 'start_array']:
+            valueStack.append(newValue)
+            keyStack.append(None)
+    return rootValue
+
+
+def chunksOf(documentText, chunkSize):
+    return [documentText[chunkStart:chunkStart + chunkSize] for chunkStart in range(0, len(documentText), chunkSize)]
+
+
+@pytest.mark.parametrize('chunkSize', [1, 2, 3, 7, 64, 100000])
+def testSplitChunksGiveTheSameEvents(chunkSize):
+    documentText = json.dumps(sampleDocument, indent=1)
+    wholeEvents = list(zoyinc_std_tools.iterJsonEvents([documentText], indexedPaths=True))
+    splitEvents = list(zoyinc_std_tools.iterJsonEvents(chunksOf(documentText, chunkSize), indexedPaths=True))
+    assert splitEvents == wholeEvents
+    assert valueOfEvents(splitEvents) == sampleDocument
+
+
+@pytest.mark.parametrize('chunkSize', [1, 2, 5])
+def testEscapesSplitAcrossChunks(chunkSize):
+    # ensure_ascii gives \uXXXX escapes, and a surrogate pair for the emoji
+    documentText = json.dumps({'quoted': sampleDocument['quoted']}, ensure_ascii=True)
+    assert '\\ud83d\\ude00' in documentText
+    jsonEvents = list(zoyinc_std_tools.iterJsonEvents(chunksOf(documentText, chunkSize)))
+    assert ('quoted', 'string', sampleDocument['quoted']) in jsonEvents
+
+
+def testNumbersSplitAcrossChunks():
+    jsonEvents = list(zoyinc_std_tools.iterJsonEvents(['[12', '34, -0.', '5e', '1, 7]']))
+    assert [eventValue for eventPath, currEvent, eventValue in jsonEvents if currEvent == 'number'] == [1234, -5.0, 7]
+
+
+def testPrefixes():
+    documentText = json.dumps({'environments': [{'name': 'PRD'}, {'name': 'STG'}]})
+    namedEvents = [jsonEvent for jsonEvent in zoyinc_std_tools.iterJsonEvents([documentText]) if jsonEvent[1] == 'string']
+    assert namedEvents == [('environments.item.name', 'string', 'PRD'), ('environments.item.name', 'string', 'STG')]
+    indexedEvents = [jsonEvent for jsonEvent in zoyinc_std_tools.iterJsonEvents([documentText], indexedPaths=True) if jsonEvent[1] == 'string']
+    assert indexedEvents == [(('environments', 0, 'name'), 'string', 'PRD'), (('environments', 1, 'name'), 'string', 'STG')]
+
+
+def testTruncatedDocument():
+    with pytest.raises(ValueError):
+        list(zoyinc_std_tools.iterJsonEvents(['{"environments": [{"name": "PR']))
@@ -0,0 +1,47 @@
+#
+# enableLogging() and LogPayload, payloads written up to each handler's limit
+#
+
+import io
+import logging
+import os
+import subprocess
+import sys
+
+import zoyinc_std_tools
+
+
+def testPayloadsAreTruncatedInBytes():
+    assert str(zoyinc_std_tools.LogPayload('x' * 10)) == 'x' * 10
+    assert zoyinc_std_tools.LogPayload('x' * 10).truncated(4) == 'xxxx... (6 more bytes not logged)'
+    assert zoyinc_std_tools.LogPayload(b'abcdef').truncated(2) == "b'ab'... (4 more bytes not logged)"
+    # Each e acute is two utf-8 bytes, a character is not split
+    assert zoyinc_std_tools.LogPayload('é' * 4).truncated(5) == 'éé... (3 more bytes not logged)'
+    assert zoyinc_std_tools.LogPayload('abc').truncated(None) == 'abc'
+
+
+def testEachHandlerHasItsOwnLimit():
+    testLogger = logging.getLogger('test_logging.handlers')
+    testLogger.setLevel(logging.DEBUG)
+    shortOutput = io.StringIO()
+    longOutput = io.StringIO()
+    for logOutput, maxPayloadBytes in [(shortOutput, 3), (longOutput, None)]:
+        logHandler = logging.StreamHandler(logOutput)
+        logHandler.setFormatter(zoyinc_std_tools.PayloadFormatter('%(message)s', maxPayloadBytes=maxPayloadBytes))
+        testLogger.addHandler(logHandler)
+    try:
+        testLogger.debug('Payload %s of %d', zoyinc_std_tools.LogPayload('abcdef'), 1)
+    finally:
+        testLogger.handlers = []
+    assert shortOutput.getvalue() == 'Payload abc... (3 more bytes not logged) of 1\n'
+    assert longOutput.getvalue() == 'Payload abcdef of 1\n'
+
+
+def testHandlersOnlyImportedWhenNeeded(tmp_path):
+    stdToolsDir = os.path.dirname(zoyinc_std_tools.__file__)
+    checkScript = ('import sys, zoyinc_std_tools\n'
+                   'zoyinc_std_tools.enableLogging("ERROR", "ERROR", sys.argv[1], queueLogging=sys.argv[2] == "queue")\n'
+                   'print("logging.handlers" in sys.modules)\n')
+    for queueArg, handlersImported in [('plain', 'False'), ('queue', 'True')]:
+        checkRun = subprocess.run([sys.executable, '-c', checkScript, str(tmp_path / 'test.log'), queueArg], cwd=stdToolsDir, capture_output=True, text=True)
+        assert checkRun.stdout.strip() == handlersImported, checkRun.stderr
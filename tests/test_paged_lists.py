@@ -0,0 +1,72 @@
+#
+# iterAdoPages() and iterAdoItems(), paged lists with and without the response cache
+#
+
+import io
+
+import zoyinc_std_tools
+
+
+def processListURL(fakeAdoServer):
+    return fakeAdoServer.baseURL + 'zoyinc/_apis/work/processes?api-version=6.0'
+
+
+def processCount(fakeAdoServer):
+    return fakeAdoServer.releaseShape['processes']
+
+
+def testAllPagesAreFollowed(fakeAdoServer):
+    fakeAdoServer.releaseShape['pageSize'] = 1
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    for prefetch in [False, True]:
+        fakeAdoServer.resetStats()
+        listItems = list(zoyinc_std_tools.iterAdoItems(adoClient, processListURL(fakeAdoServer), prefetch=prefetch))
+        assert [currItem['typeId'] for currItem in listItems] == ['process-' + str(processIndex) for processIndex in range(processCount(fakeAdoServer))]
+        assert fakeAdoServer.statsSnapshot()['requests'] == processCount(fakeAdoServer)
+
+
+def testCachedPagesKeepTheirContinuationToken(fakeAdoServer, tmp_path):
+    fakeAdoServer.releaseShape['pageSize'] = 1
+    plainItems = list(zoyinc_std_tools.iterAdoItems(zoyinc_std_tools.AdoClient('token'), processListURL(fakeAdoServer)))
+
+    # Memory only, on disk, and on disk from another run
+    for cacheDir in [None, str(tmp_path), str(tmp_path)]:
+        adoClient = zoyinc_std_tools.AdoClient('token', responseCache=zoyinc_std_tools.AdoResponseCache(cacheDir))
+        fakeAdoServer.resetStats()
+        for getIndex in range(2):
+            assert list(zoyinc_std_tools.iterAdoItems(adoClient, processListURL(fakeAdoServer))) == plainItems
+        # The processes list is cached for an hour, every page is a hit the second time
+        assert adoClient.responseCache.stats['hit'] + adoClient.responseCache.stats['miss'] == 2 * processCount(fakeAdoServer)
+        assert fakeAdoServer.statsSnapshot()['requests'] == adoClient.responseCache.stats['miss']
+
+
+def testUncachedHeaders(fakeAdoServer):
+    fakeAdoServer.releaseShape['pageSize'] = 1
+    adoClient = zoyinc_std_tools.AdoClient('token', responseCache=zoyinc_std_tools.AdoResponseCache())
+    for getIndex in range(2):
+        adoResponse = adoClient.get(processListURL(fakeAdoServer))
+        adoResponse.content
+    assert adoResponse.cacheStatus == 'hit'
+    assert adoResponse.headers[zoyinc_std_tools.continuationTokenHeader] == '1'
+    assert 'Date' not in adoResponse.headers
+    assert 'Content-Length' not in adoResponse.headers
+
+
+#
+# Client that answers with a 304 once the first response is cached, the fake server
+# does not send ETags
+#
+class RevalidatingClient(zoyinc_std_tools.AdoClient):
+
+    def sendRequest(self, requestType, requestURL, requestParams=None, requestData=None, requestHeaders=None, stream=False):
+        if 'If-None-Match' in (requestHeaders or {}):
+            return zoyinc_std_tools.AdoResponse(304, 'Not Modified', requestURL, {'ETag': '"1"'}, io.BytesIO(b''))
+        return zoyinc_std_tools.AdoResponse(200, 'OK', requestURL, {'ETag': '"1"', 'Content-Type': 'application/json', 'x-ms-continuationtoken': 'page2'}, io.BytesIO(b'{"count": 0, "value": []}'))
+
+
+def testRevalidatedPageKeepsItsContinuationToken():
+    adoClient = RevalidatingClient('token', responseCache=zoyinc_std_tools.AdoResponseCache(endpointTTLs=[], defaultTTL=0))
+    for getIndex in range(2):
+        pageJson, continuationToken = zoyinc_std_tools.fetchAdoPage(adoClient, 'https://ado/zoyinc/_apis/release/releases', None, None)
+        assert continuationToken == 'page2'
+    assert adoClient.responseCache.stats == {'hit': 0, 'revalidated': 1, 'miss': 1}
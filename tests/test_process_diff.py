@@ -0,0 +1,79 @@
+#
+# diffProcessExports(), the structural diff of two process exports
+#
+
+import copy
+
+import zoyinc_process_tools
+
+sampleExport = {'process': {
+    'agile': {'name': 'Agile', 'typeId': 'process-0',
+              'behaviors': {'system.portfoliobacklogbehavior': {'name': 'Portfolio'}},
+              'workItemTypes': {
+                  'agile.bug': {'name': 'Bug', 'referenceName': 'Agile.Bug',
+                                'fields': {'system.title': {'referenceName': 'System.Title', 'required': True},
+                                           'custom.severity': {'referenceName': 'Custom.Severity', 'required': False}},
+                                'states': {'active': {'name': 'Active', 'color': '007acc'}},
+                                'rules': {},
+                                'layout': {'pages': [{'id': 'page-1'}]},
+                                'behaviors': {}}}},
+    'scrum': {'name': 'Scrum', 'typeId': 'process-1'}}}
+
+
+def diffLinesOf(oldExport, newExport):
+    return [zoyinc_process_tools.diffLineOf(diffItem) for diffItem in zoyinc_process_tools.diffProcessExports(oldExport, newExport)]
+
+
+def testSameExports():
+    assert zoyinc_process_tools.diffProcessExports(sampleExport, copy.deepcopy(sampleExport)) == []
+
+
+def testChanges():
+    newExport = copy.deepcopy(sampleExport)
+    bugWit = newExport['process']['agile']['workItemTypes']['agile.bug']
+    bugWit['fields']['custom.severity']['required'] = True
+    bugWit['fields']['custom.priority'] = {'referenceName': 'Custom.Priority'}
+    del bugWit['states']['active']
+    bugWit['layout'] = {'pages': [{'id': 'page-2'}]}
+    del newExport['process']['agile']['behaviors']['system.portfoliobacklogbehavior']
+    newExport['process']['basic'] = {'name': 'Basic', 'typeId': 'process-2'}
+
+    # Depth first, in key order
+    assert diffLinesOf(sampleExport, newExport) == [
+        "- process 'agile' / behavior 'system.portfoliobacklogbehavior'",
+        "~ process 'agile' / workItemType 'agile.bug'  (layout)",
+        "+ process 'agile' / workItemType 'agile.bug' / field 'custom.priority'",
+        "~ process 'agile' / workItemType 'agile.bug' / field 'custom.severity'  (required)",
+        "- process 'agile' / workItemType 'agile.bug' / state 'active'",
+        "+ process 'basic'"]
+    # And back again
+    assert diffLinesOf(newExport, sampleExport)[-1] == "- process 'basic'"
+
+
+def testDiffItems():
+    newExport = copy.deepcopy(sampleExport)
+    newExport['process']['scrum']['name'] = 'Scrum 2'
+    assert zoyinc_process_tools.diffProcessExports(sampleExport, newExport) == [{'change': 'changed', 'path': [['process', 'scrum']], 'properties': ['name']}]
+
+
+def testNodeHashes():
+    oldNode = zoyinc_process_tools.ProcessHashNode(sampleExport['process']['agile'], zoyinc_process_tools.processDiffLevels)
+
+    # The order of the keys does not change the hash
+    reorderedProcess = dict(reversed(list(copy.deepcopy(sampleExport['process']['agile']).items())))
+    reorderedProcess['workItemTypes']['agile.bug']['fields'] = dict(reversed(list(reorderedProcess['workItemTypes']['agile.bug']['fields'].items())))
+    assert zoyinc_process_tools.ProcessHashNode(reorderedProcess, zoyinc_process_tools.processDiffLevels).nodeHash() == oldNode.nodeHash()
+
+    # A change deep down changes the hash of every node above it, but not the others
+    changedProcess = copy.deepcopy(sampleExport['process']['agile'])
+    changedProcess['workItemTypes']['agile.bug']['fields']['system.title']['required'] = False
+    newNode = zoyinc_process_tools.ProcessHashNode(changedProcess, zoyinc_process_tools.processDiffLevels)
+    assert newNode.nodeHash() != oldNode.nodeHash()
+    oldWit = oldNode.groups()['workItemTypes']['agile.bug']
+    newWit = newNode.groups()['workItemTypes']['agile.bug']
+    assert newWit.nodeHash() != oldWit.nodeHash()
+    assert newWit.groups()['fields']['custom.severity'].nodeHash() == oldWit.groups()['fields']['custom.severity'].nodeHash()
+    assert newWit.groups()['states']['active'].nodeHash() == oldWit.groups()['states']['active'].nodeHash()
+
+    # A group is not the same as a property holding the same dict
+    assert zoyinc_process_tools.ProcessHashNode({'fields': {}}, {'fields': None}).nodeHash() != zoyinc_process_tools.ProcessHashNode({'fields': {}}, None).nodeHash()
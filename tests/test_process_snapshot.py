@@ -0,0 +1,109 @@
+#
+# ProcessSnapshotStore, reusing the layout and behaviors of unchanged work item types
+#
+
+import json
+import logging
+import os
+
+import zoyinc_std_tools
+import zoyinc_process_tools
+
+testLogger = logging.getLogger('test_process_snapshot')
+
+
+def exportWith(fakeAdoServer, snapshotStore=None):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    exportContext = zoyinc_process_tools.ProcessExportContext(testLogger, adoClient, fakeAdoServer.baseURL + 'zoyinc/', None, 'token')
+    fakeAdoServer.resetStats()
+    processDict = zoyinc_process_tools.exportProcesses(exportContext, deepExport=True, exportWorkers=4, snapshotStore=snapshotStore)
+    return processDict, fakeAdoServer.statsSnapshot()['requests']
+
+
+def witCountOf(fakeAdoServer):
+    return fakeAdoServer.releaseShape['processes'] * fakeAdoServer.releaseShape['wits']
+
+
+def testUnchangedWitsAreReused(fakeAdoServer, tmp_path):
+    plainExport, plainRequests = exportWith(fakeAdoServer)
+
+    firstExport, firstRequests = exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+    assert firstExport == plainExport
+    assert firstRequests == plainRequests
+    assert os.path.exists(os.path.join(str(tmp_path), 'manifest.json'))
+
+    # Only the layout and behaviors of each work item type are not fetched again
+    secondExport, secondRequests = exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+    assert secondExport == plainExport
+    assert secondRequests == plainRequests - len(zoyinc_process_tools.witDetailSubs) * witCountOf(fakeAdoServer)
+
+
+def testChangedWitsAreFetched(fakeAdoServer, tmp_path):
+    exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+
+    # Every work item type gets another field, state and rule
+    fakeAdoServer.releaseShape['witItems'] += 1
+    plainExport, plainRequests = exportWith(fakeAdoServer)
+    changedExport, changedRequests = exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+    assert changedExport == plainExport
+    assert changedRequests == plainRequests
+    for curProcess in changedExport['process'].values():
+        for curWit in curProcess['workItemTypes'].values():
+            assert len(curWit['rules']) == fakeAdoServer.releaseShape['witItems']
+
+
+def testOldAndFullRefresh(fakeAdoServer, tmp_path):
+    plainExport, plainRequests = exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+
+    fullExport, fullRequests = exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path), fullRefresh=True))
+    assert (fullExport, fullRequests) == (plainExport, plainRequests)
+
+    staleExport, staleRequests = exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path), refreshAfterSeconds=0))
+    assert (staleExport, staleRequests) == (plainExport, plainRequests)
+
+
+def testObjectsAreStoredOnce(fakeAdoServer, tmp_path):
+    exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+    objectsDir = os.path.join(str(tmp_path), 'objects')
+    objectFiles = sorted(os.path.join(dirPath, fileName) for dirPath, dirNames, fileNames in os.walk(objectsDir) for fileName in fileNames)
+    for objectFilename in objectFiles:
+        with open(objectFilename, 'r') as objectFile:
+            assert zoyinc_std_tools.contentHash(json.load(objectFile)) + '.json' == os.path.basename(objectFilename)
+
+    # Every work item type has the same layout, it is stored once
+    with open(os.path.join(str(tmp_path), 'manifest.json'), 'r') as manifestFile:
+        snapshotManifest = json.load(manifestFile)
+    layoutHashes = {witEntry['layout'] for processEntry in snapshotManifest['processes'].values() for witEntry in processEntry['workItemTypes'].values()}
+    assert len(layoutHashes) == 1
+
+    exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+    assert sorted(os.path.join(dirPath, fileName) for dirPath, dirNames, fileNames in os.walk(objectsDir) for fileName in fileNames) == objectFiles
+
+
+def objectHashesIn(snapshotDir):
+    return {fileName[:-5] for dirPath, dirNames, fileNames in os.walk(os.path.join(snapshotDir, 'objects')) for fileName in fileNames}
+
+
+def testUnreferencedObjectsAreRemoved(fakeAdoServer, tmp_path):
+    snapshotStore = zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path))
+    exportWith(fakeAdoServer, snapshotStore)
+    firstHashes = objectHashesIn(str(tmp_path))
+    assert firstHashes == snapshotStore.manifestHashes(snapshotStore.manifest)
+
+    # The rules of the old export are no longer referred to
+    fakeAdoServer.releaseShape['witItems'] -= 1
+    exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+    secondStore = zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path))
+    assert objectHashesIn(str(tmp_path)) == secondStore.manifestHashes(secondStore.manifest)
+    assert not firstHashes <= objectHashesIn(str(tmp_path))
+
+
+def testMissingObjectsAreFetched(fakeAdoServer, tmp_path):
+    plainExport, plainRequests = exportWith(fakeAdoServer, zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path)))
+    snapshotStore = zoyinc_process_tools.ProcessSnapshotStore(str(tmp_path))
+    layoutHash = next(iter(next(iter(snapshotStore.manifest['processes'].values()))['workItemTypes'].values()))['layout']
+    os.remove(snapshotStore.blobFilename(layoutHash))
+
+    # Every work item type has the same layout, so all of their details are fetched
+    missingExport, missingRequests = exportWith(fakeAdoServer, snapshotStore)
+    assert (missingExport, missingRequests) == (plainExport, plainRequests)
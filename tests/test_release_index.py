@@ -0,0 +1,31 @@
+#
+# ReleaseIndex, direct lookup of the parts of a release
+#
+
+import fake_ado_server
+import zoyinc_release_tools
+
+sampleRelease = fake_ado_server.buildRelease(1, fake_ado_server.defaultShape)
+
+
+def testLookups():
+    releaseIndex = zoyinc_release_tools.ReleaseIndex(sampleRelease)
+    assert releaseIndex.stage('stage02') is sampleRelease['environments'][1]
+    assert releaseIndex.stage('STAGE99') is None
+
+    deploymentId = fake_ado_server.deploymentIdOf(1, 1, 2)
+    foundStage, foundDeployStep = releaseIndex.deployment(deploymentId)
+    assert (foundStage['name'], foundDeployStep) == ('STAGE02', sampleRelease['environments'][1]['deploySteps'][2])
+    assert releaseIndex.deployment(str(deploymentId)) == (foundStage, foundDeployStep)
+    assert releaseIndex.deployPhase(str(deploymentId) + '-2')[2]['name'] == 'Phase 2'
+
+
+def testFirstInterventionIsKept():
+    deploymentId = fake_ado_server.deploymentIdOf(1, 4, 0)
+    releaseIndex = zoyinc_release_tools.ReleaseIndex(sampleRelease)
+
+    # Every phase of the deployment has the intervention, the first phase's is found
+    foundDeployPhase, foundIntervention = releaseIndex.intervention('Stage05', deploymentId, fake_ado_server.interventionName.lower())
+    assert foundDeployPhase is sampleRelease['environments'][4]['deploySteps'][0]['releaseDeployPhases'][0]
+    assert foundIntervention['comments'] == 'Approved for S-T-A-G-E-0-5'
+    assert releaseIndex.intervention('STAGE04', deploymentId, fake_ado_server.interventionName) is None
@@ -0,0 +1,100 @@
+#
+# updateReleaseVariables(), the optimistic update of release variables
+#
+
+import json
+
+import pytest
+
+import zoyinc_std_tools
+import zoyinc_release_tools
+
+
+def releaseURLFor(fakeAdoServer, releaseId=2):
+    return zoyinc_release_tools.releaseURLOf(fakeAdoServer.baseURL + 'vsrm/zoyinc/', 'Project0', releaseId)
+
+
+#
+# Another task's update, made between our GET and our PUT
+#
+def otherTaskUpdate(adoClient, releaseURL, newVariables):
+    releaseDetail = adoClient.getJson(releaseURL)
+    return zoyinc_release_tools.updateReleaseVariables(adoClient, releaseURL, releaseDetail, newVariables)
+
+
+def testUpdateWithoutConflict(fakeAdoServer):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseDetail = adoClient.getJson(releaseURL)
+
+    fakeAdoServer.resetStats()
+    updatedRelease = zoyinc_release_tools.updateReleaseVariables(adoClient, releaseURL, releaseDetail, {'GLOBALVAR_PRD_DEPLOYAPPROVALOK': 'TRUE'})
+    assert updatedRelease['variables']['GLOBALVAR_PRD_DEPLOYAPPROVALOK']['value'] == 'TRUE'
+    assert fakeAdoServer.statsSnapshot()['byMethod'] == {'PUT': 1}
+    # The copy the caller has is not changed
+    assert 'GLOBALVAR_PRD_DEPLOYAPPROVALOK' not in releaseDetail['variables']
+
+
+def testConflictMergesWithTheOtherUpdate(fakeAdoServer, capsys):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    staleRelease = adoClient.getJson(releaseURL)
+    otherTaskUpdate(adoClient, releaseURL, {'GLOBALVAR_STG_OTHER': 'theirs', 'SHARED': 'theirs'})
+
+    fakeAdoServer.resetStats()
+    updatedRelease = zoyinc_release_tools.updateReleaseVariables(adoClient, releaseURL, staleRelease, {'GLOBALVAR_PRD_MINE': 'mine', 'SHARED': 'mine'}, baseDelay=0.001)
+
+    # Our variables are applied to their copy, so neither update is lost
+    releaseVariables = fakeAdoServer.releaseVariables(2)
+    assert releaseVariables['GLOBALVAR_STG_OTHER']['value'] == 'theirs'
+    assert releaseVariables['GLOBALVAR_PRD_MINE']['value'] == 'mine'
+    assert releaseVariables['SHARED']['value'] == 'mine'
+    assert updatedRelease['variables'] == releaseVariables
+    assert fakeAdoServer.statsSnapshot()['byMethod'] == {'PUT': 2, 'GET': 1}
+    assert 'another process is also updating' in capsys.readouterr().out
+
+
+def testRepeatedConflictsAreRetried(fakeAdoServer):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseDetail = adoClient.getJson(releaseURL)
+    fakeAdoServer.conflictPuts = 3
+
+    updateMessages = []
+    zoyinc_release_tools.updateReleaseVariables(adoClient, releaseURL, releaseDetail, {'A': '1'}, baseDelay=0.001, updateMessages=updateMessages)
+    assert fakeAdoServer.releaseVariables(2)['A']['value'] == '1'
+    assert fakeAdoServer.statsSnapshot()['conflicts'] == 3
+    assert len(updateMessages) == 3
+
+
+def testGivesUpAfterMaxAttempts(fakeAdoServer):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseDetail = adoClient.getJson(releaseURL)
+    fakeAdoServer.conflictPuts = 10
+
+    with pytest.raises(zoyinc_release_tools.ReleaseUpdateError) as raisedError:
+        zoyinc_release_tools.updateReleaseVariables(adoClient, releaseURL, releaseDetail, {'A': '1'}, maxAttempts=3, baseDelay=0.001, updateMessages=[])
+    assert raisedError.value.statusCode == 400
+    assert zoyinc_release_tools.oldCopyOfReleaseStr in raisedError.value.responseMsg.upper()
+    assert fakeAdoServer.statsSnapshot()['conflicts'] == 3
+
+
+def testOtherErrorsAreNotRetried(fakeAdoServer):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseDetail = adoClient.getJson(releaseURLFor(fakeAdoServer))
+    notReleaseURL = fakeAdoServer.baseURL + 'vsrm/zoyinc/Project0/_apis/release/definitions/2?api-version=5.0'
+
+    fakeAdoServer.resetStats()
+    with pytest.raises(zoyinc_release_tools.ReleaseUpdateError) as raisedError:
+        zoyinc_release_tools.updateReleaseVariables(adoClient, notReleaseURL, releaseDetail, {'A': '1'}, baseDelay=0.001)
+    assert raisedError.value.statusCode == 404
+    assert raisedError.value.responseMsg == 'Not found'
+    assert fakeAdoServer.statsSnapshot()['byMethod'] == {'PUT': 1}
+
+
+def testWithReleaseVariablesKeepsOtherSettings():
+    releaseDetail = {'id': 2, 'variables': {'SECRET': {'value': 'old', 'isSecret': True}}}
+    putRelease = zoyinc_release_tools.withReleaseVariables(releaseDetail, {'SECRET': 'new', 'NEW': 'x'})
+    assert putRelease['variables'] == {'SECRET': {'value': 'new', 'isSecret': True}, 'NEW': {'value': 'x'}}
+    assert json.dumps(releaseDetail) == json.dumps({'id': 2, 'variables': {'SECRET': {'value': 'old', 'isSecret': True}}})
@@ -0,0 +1,127 @@
+#
+# SharedReleaseCache, releases shared by the processes on a host
+#
+
+import json
+import threading
+import time
+
+import zoyinc_std_tools
+import zoyinc_release_tools
+
+
+def releaseURLFor(fakeAdoServer, releaseId=3):
+    return zoyinc_release_tools.releaseURLOf(fakeAdoServer.baseURL + 'vsrm/zoyinc/', 'Project0', releaseId, expand='none')
+
+
+#
+# Get through the cache, returns (cache status, release, requests made)
+#
+def cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer):
+    fakeAdoServer.resetStats()
+    adoResponse = releaseCache.get(adoClient, releaseURL)
+    return adoResponse.cacheStatus, json.loads(adoResponse.content), fakeAdoServer.statsSnapshot()['requests']
+
+
+def testMissThenHit(fakeAdoServer, tmp_path):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseCache = zoyinc_release_tools.SharedReleaseCache(str(tmp_path))
+
+    # A miss is the one request it would have been without the cache
+    cacheStatus, missRelease, missRequests = cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)
+    assert (cacheStatus, missRequests) == ('miss', 1)
+    assert missRelease == adoClient.getJson(releaseURL)
+
+    # A hit only asks for the revision, and another process shares it
+    otherCache = zoyinc_release_tools.SharedReleaseCache(str(tmp_path))
+    cacheStatus, hitRelease, hitRequests = cachedGet(otherCache, adoClient, releaseURL, fakeAdoServer)
+    assert (cacheStatus, hitRequests) == ('hit', 1)
+    assert hitRelease == missRelease
+    assert (releaseCache.stats['miss'], otherCache.stats['hit']) == (1, 1)
+
+
+def testChangedReleaseIsFetchedAgain(fakeAdoServer, tmp_path):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseCache = zoyinc_release_tools.SharedReleaseCache(str(tmp_path))
+    cacheStatus, cachedRelease, getRequests = cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)
+
+    # Updating the release changes its modifiedOn
+    zoyinc_release_tools.updateReleaseVariables(adoClient, releaseURL, cachedRelease, {'GLOBALVAR_PRD_DEPLOYAPPROVALOK': 'TRUE'})
+    cacheStatus, changedRelease, getRequests = cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)
+    assert (cacheStatus, getRequests) == ('miss', 2)
+    assert changedRelease['variables']['GLOBALVAR_PRD_DEPLOYAPPROVALOK']['value'] == 'TRUE'
+    assert changedRelease['modifiedOn'] != cachedRelease['modifiedOn']
+
+    assert cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)[0] == 'hit'
+
+
+def testWithoutRevisionCheck(fakeAdoServer, tmp_path):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseCache = zoyinc_release_tools.SharedReleaseCache(str(tmp_path), checkRevision=False)
+    cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)
+    cacheStatus, hitRelease, hitRequests = cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)
+    assert (cacheStatus, hitRequests) == ('hit', 0)
+
+
+def testOldEntriesAreFetchedAgain(fakeAdoServer, tmp_path):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseCache = zoyinc_release_tools.SharedReleaseCache(str(tmp_path), maxAgeSeconds=0.2)
+    cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)
+    time.sleep(0.3)
+    cacheStatus, missRelease, missRequests = cachedGet(releaseCache, adoClient, releaseURL, fakeAdoServer)
+    assert (cacheStatus, missRequests) == ('miss', 1)
+
+
+def testOtherUrlsAreNotCached(fakeAdoServer, tmp_path):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseCache = zoyinc_release_tools.SharedReleaseCache(str(tmp_path))
+    definitionURL = fakeAdoServer.baseURL + 'vsrm/zoyinc/Project0/_apis/release/definitions/1?api-version=5.0'
+    for getIndex in range(2):
+        adoResponse = releaseCache.get(adoClient, definitionURL)
+        assert (adoResponse.status_code, adoResponse.cacheStatus) == (200, None)
+    assert releaseCache.stats['bypassed'] == 2
+
+    # Nor are errors, the fake server only has releases under vsrm
+    missingURL = zoyinc_release_tools.releaseURLOf(fakeAdoServer.baseURL + 'zoyinc/', 'Project0', 3)
+    for getIndex in range(2):
+        missingResponse = releaseCache.get(adoClient, missingURL)
+        assert (missingResponse.status_code, missingResponse.cacheStatus) == (404, None)
+    assert releaseCache.stats['miss'] == 0
+
+
+def testStreamedHit(fakeAdoServer, tmp_path):
+    adoClient = zoyinc_std_tools.AdoClient('token')
+    releaseURL = releaseURLFor(fakeAdoServer)
+    releaseCache = zoyinc_release_tools.SharedReleaseCache(str(tmp_path))
+    releaseBody = releaseCache.get(adoClient, releaseURL).content
+    with releaseCache.get(adoClient, releaseURL, stream=True) as adoResponse:
+        assert adoResponse.cacheStatus == 'hit'
+        assert b''.join(adoResponse.iter_content(chunk_size=1000)) == releaseBody
+
+
+def testConcurrentGetsFetchOnce(fakeAdoServer, tmp_path):
+    adoClient = zoyinc_std_tools.AdoClient('token', poolMaxSize=8)
+    releaseURL = releaseURLFor(fakeAdoServer)
+    fakeAdoServer.latencyMs = 50
+    fakeAdoServer.resetStats()
+
+    # Each thread has its own cache, as each process on the host would
+    cacheStatuses = []
+    def getRelease():
+        adoResponse = zoyinc_release_tools.SharedReleaseCache(str(tmp_path)).get(adoClient, releaseURL)
+        cacheStatuses.append((adoResponse.cacheStatus, len(adoResponse.content)))
+    getThreads = [threading.Thread(target=getRelease) for threadIndex in range(8)]
+    for getThread in getThreads:
+        getThread.start()
+    for getThread in getThreads:
+        getThread.join()
+
+    assert [cacheStatus for cacheStatus, bodyBytes in cacheStatuses].count('miss') == 1
+    assert len(set(bodyBytes for cacheStatus, bodyBytes in cacheStatuses)) == 1
+    # The release is fetched once, a hit also asks for the revision
+    hitCount = [cacheStatus for cacheStatus, bodyBytes in cacheStatuses].count('hit')
+    assert fakeAdoServer.statsSnapshot()['requests'] == 1 + hitCount